@@ -102,7 +102,7 @@ def _(md_initial, mo, sys, use_mocked_data, validate_form):
 
 
 @app.cell
-def _(datetime, strava_client):
+def _(datetime):
     def sanitize_form(form_value) -> dict[str | None, str | None]:
         # insert a fake expires at so that the client refreshes the token
         form_value["expires_at"] = int(
@@ -124,10 +124,13 @@ def _(datetime, strava_client):
                 errors.append(f"{' '.join(key.split('_'))} is required")
         if errors:
             return ", ".join(errors)
+        # Imported here, so that the form can be shown while packages are
+        # still being installed. They are there by the time it is submitted,
+        # as the kernel runs the submission after the imports cell.
+        from strava_client.models.settings import StravaSettings
+
         try:
-            strava_client.models.settings.StravaSettings.model_validate(
-                sanitize_form(form_value)
-            )
+            StravaSettings.model_validate(sanitize_form(form_value))
         except Exception as e:
             return str(e)
     return sanitize_form, validate_form
@@ -142,6 +145,7 @@ async def _(
     sanitize_form,
     starting_form,
     strava_client,
+    tracer,
 ):
     mo.stop(not can_instantiate_client)
 
@@ -184,7 +188,8 @@ async def _(
 
                 # Make a call to understand if values are correct
                 try:
-                    client.get_activities(page=1, per_page=1)
+                    with tracer.span("validate credentials", "network"):
+                        client.get_activities(page=1, per_page=1)
                     _spinner.update("Done!")
                     client_ready = True
                 except Exception as e:
@@ -200,17 +205,19 @@ async def _(
 
 
 @app.cell(hide_code=True)
-def _(end_date, filtered_df, heatmap_chart, mo, start_date):
+def _(end_date, filtered_days, heatmap_chart, mo, route_filter, start_date):
     _range = mo.md(
         f"""
-        Select a time range to filter activities. The dashboard will update automatically 😉.
+        Select a time range to filter activities, and a route to only see the runs on it. The dashboard will update automatically 😉.
 
         {start_date} - {end_date}
+
+        {route_filter}
         """
     )
 
     # Define heatmap here as it can't be where its value is used
-    heatmap_selection = heatmap_chart(filtered_df)
+    heatmap_selection = heatmap_chart(filtered_days)
 
     _range
     return (heatmap_selection,)
@@ -218,32 +225,40 @@ def _(end_date, filtered_df, heatmap_chart, mo, start_date):
 
 @app.cell
 def _(
+    activity_index,
+    filtered_days,
     filtered_df,
-    get_average_column,
-    get_average_speed,
-    get_column_sum,
-    get_nice_duration,
     heatmap_selection,
     mo,
     pl,
+    summarize_rollup,
 ):
-    _selected_activities = heatmap_selection.value
-
     # If nothing was selected, we use all data
-    if (_selected_activities := heatmap_selection.value).height == 0:
+    if heatmap_selection.value.height == 0:
+        _selected_days = filtered_days
         displayed_activities = filtered_df
     else:
-        # We might have more than one activity for each block
-        # hence we explode on ids to have a row for each activity
-        _exploded_activities = _selected_activities.explode("id")
+        # The chart only knows the start date of each day,
+        # which is enough to find the selected days back
+        _selected_days = filtered_days.join(
+            heatmap_selection.value.select(start_date="Date"),
+            on="start_date",
+            how="semi",
+        )
 
-        displayed_activities = filtered_df.join(_exploded_activities, on="id")
+        # We might have more than one activity for each block,
+        # their rows are looked up by id
+        displayed_activities = activity_index.gather(
+            _selected_days["id"].explode()
+        )
 
     displayed_activities = displayed_activities.with_columns(
         start_date_str=pl.col("start_date").dt.strftime("%Y/%m/%d %H:%M:%S")
     )
 
-    n_activities = len(displayed_activities)
+    # Stats are derived from the selected days, which are already aggregated
+    _stats = summarize_rollup(_selected_days)
+    n_activities = _stats["count"]
 
     n_activities_stat = mo.stat(
         label="Number of activities",
@@ -254,25 +269,25 @@ def _(
     total_kms_stat = mo.stat(
         label="Total Kilometers",
         bordered=True,
-        value=f"{get_column_sum(displayed_activities, 'kms'):.0f}",
+        value=f"{_stats['kms']:.0f}",
     )
 
     average_kms_stat = mo.stat(
         label="Average Distance" if n_activities > 1 else "Distance",
         bordered=True,
-        value=f"{get_average_column(displayed_activities, 'kms'):.2f}",
+        value=f"{_stats['average_kms']:.2f}",
     )
 
     average_run_duration = mo.stat(
         label="Average Duration" if n_activities > 1 else "Duration",
         bordered=True,
-        value=f"{get_nice_duration(get_average_column(displayed_activities, 'elapsed_time'))}",
+        value=f"{_stats['average_duration']}",
     )
 
     average_speed = mo.stat(
         label="Average Speed (min / km)" if n_activities > 1 else "Speed (min/km)",
         bordered=True,
-        value=f"{get_average_speed(displayed_activities)}",
+        value=f"{_stats['average_speed']}",
     )
 
     mo.vstack(
@@ -299,8 +314,11 @@ def _(
     activity_focus,
     bar_chart_distance,
     bar_chart_speed,
+    best_efforts_tab,
     displayed_activities,
     mo,
+    pace_curve_tab,
+    splits_tab,
 ):
     mo.vstack(
         [
@@ -314,19 +332,37 @@ def _(
 
         📊 **Speed**: see how your activity speeds are distributed.
 
+        📈 **Pace Curve**: find the best pace you ever held for any duration from 10 seconds to 3 hours, all time and year by year.
+
         📏 **Distance**: view the distance distribution across your selected activities.
 
+        🏆 **Best Efforts**: follow your personal records over 400m, 1k, 5k, 10k and more, across all of your runs.
+
+        ⏱️ **Splits**: check the time of every kilometer of your selected activities.
+
 
         """),
             mo.ui.tabs(
                 {
-                    "::lucide:focus:: Activity Focus": activity_focus(),
+                    # Rendered, and plotly loaded, when the tab is shown
+                    "::lucide:focus:: Activity Focus": mo.lazy(
+                        activity_focus, show_loading_indicator=True
+                    ),
                     "::lucide:wind:: Speed": bar_chart_speed(
                         _df=displayed_activities
                     ),
+                    "::lucide:chart-spline:: Pace Curve": mo.lazy(
+                        pace_curve_tab, show_loading_indicator=True
+                    ),
                     "::lucide:land-plot:: Distance": bar_chart_distance(
                         _df=displayed_activities,
                     ),
+                    "::lucide:trophy:: Best Efforts": mo.lazy(
+                        best_efforts_tab, show_loading_indicator=True
+                    ),
+                    "::lucide:list-ordered:: Splits": mo.lazy(
+                        splits_tab, show_loading_indicator=True
+                    ),
                 }
             ),
         ]
@@ -334,654 +370,5146 @@ def _(
     return
 
 
+@app.cell
+def _(TimeIndex, mo, training_load):
+    # Each metric is a partition: date ranges are slices of the series
+    training_index = TimeIndex(training_load, "period", partition_by="metric")
+
+    load_metric = mo.ui.dropdown(
+        options={
+            "Distance (km)": "distance",
+            "Moving time (hours)": "time",
+            "Heart rate (TRIMP)": "trimp",
+        },
+        value="Distance (km)",
+        label="Training load from",
+    )
+    return load_metric, training_index
+
+
 @app.cell
 def _(
-    displayed_activities,
-    dropdown_activities,
-    fetch_activity_stream,
-    fetch_mocked_activity_stream,
-    get_mt_km_speed,
-    get_mt_km_speed_float,
-    load_mocked_activities,
+    get_end_date,
+    get_start_date,
+    load_metric,
     mo,
-    np,
-    pl,
-    plotly,
-    px,
-    strava_client,
+    training_index,
+    training_load_chart,
 ):
-    def activity_focus():
-        if not dropdown_activities.value:
-            return mo.vstack(
-                [
-                    dropdown_activities,
-                    mo.callout("Select at least one activity!"),
-                ]
-            )
-
-        fig = plotly.graph_objects.Figure()
+    _series = training_index.slice(
+        load_metric.value, get_start_date(), get_end_date()
+    )
 
-        selected_activities = displayed_activities.filter(
-            pl.col("start_date_str").is_in(dropdown_activities.value)
-        )
+    mo.vstack(
+        [
+            mo.md(
+                """
+                ---
 
-        min_velocity = None
-        max_velocity = None
+                ## Training Load 📈
 
-        # preload mocked activites
-        if load_mocked_activities:
-            mocked_streams = fetch_mocked_activity_stream()
+                **Fitness** is the load of your runs over the last six weeks, **fatigue** over the last week, both weighted towards recent days. **Form** is how much fitter than tired you are going into each day: negative when building up, positive when rested.
+                """
+            ),
+            load_metric,
+            training_load_chart(_series),
+        ]
+    )
+    return
 
-        for i, _id in enumerate(selected_activities["id"].to_list()):
-            if load_mocked_activities:
-                # a bit of an hack, data is not structured in the best way possible unfortunately
-                stream = strava_client.models.api.StravaActivityStream.model_validate_json(
-                    list(
-                        next(
-                            stream
-                            for stream in mocked_streams
-                            if int(list(stream.keys())[0]) == _id
-                        ).values()
-                    )[0]
-                )
-            else:
-                stream = fetch_activity_stream(
-                    activity_id=_id, keys=["velocity_smooth"]
-                )
 
-            # Sample every 3rd point to increase smoothness
-            df = pl.DataFrame(
-                {
-                    "Distance": list(
-                        map(
-                            lambda x: round(x / 1000, 2), stream.distance.data[::3]
-                        )
-                    ),
-                    "Velocity (minkm)": list(
-                        map(get_mt_km_speed, stream.velocity_smooth.data[::3])
-                    ),
-                    "Velocity": stream.velocity_smooth.data[::3],
-                }
-            )
+@app.cell
+def _(MAX_ZOOM, MIN_ZOOM, displayed_activities, fit_zoom, mo, np, pl):
+    # Size of the map, in pixels
+    MAP_WIDTH, MAP_HEIGHT = 960, 600
+
+    # The map is centered on where the selected runs started. Activities
+    # without GPS start at (0, 0) or nowhere
+    map_starts = np.array(
+        displayed_activities.filter(
+            pl.col("start_latlng").list.len() == 2,
+            pl.col("start_latlng") != [0.0, 0.0],
+        )["start_latlng"].to_list(),
+        dtype=np.float64,
+    ).reshape(-1, 2)
+
+    map_zoom = mo.ui.slider(
+        start=MIN_ZOOM,
+        stop=MAX_ZOOM,
+        # Streets are only legible from there, a single run would fit higher
+        value=fit_zoom(map_starts, MAP_WIDTH, MAP_HEIGHT, max_zoom=14)
+        if len(map_starts)
+        else MIN_ZOOM,
+        label="Zoom",
+        show_value=True,
+    )
+    return MAP_HEIGHT, MAP_WIDTH, map_starts, map_zoom
 
-            # Filter out unreal Velocity values
-            df = df.filter(pl.col("Velocity") >= 1.0)
 
-            min_velocity = (
-                df["Velocity"].min()
-                if not min_velocity
-                else min(min_velocity, df["Velocity"].min())
-            )
-            max_velocity = (
-                df["Velocity"].max()
-                if not max_velocity
-                else max(max_velocity, df["Velocity"].max())
+@app.cell
+def _(
+    MAP_HEIGHT,
+    MAP_WIDTH,
+    density_grid,
+    density_png,
+    load_route_tiles,
+    map_starts,
+    map_zoom,
+    mo,
+):
+    def _route_map():
+        _tiles = load_route_tiles()
+        items = []
+
+        if not len(map_starts):
+            items.append(mo.callout("None of the selected runs has a GPS track!"))
+        else:
+            _grid = density_grid(
+                _tiles["pyramid"],
+                map_zoom.value,
+                # Middle of the start points, as they are close to each other
+                (map_starts.min(axis=0) + map_starts.max(axis=0)) / 2,
+                MAP_WIDTH,
+                MAP_HEIGHT,
             )
 
-            activity_date = selected_activities.filter(pl.col("id") == _id)[
-                "start_date_str"
-            ].item()
-
-            fig.add_trace(
-                plotly.graph_objects.Scatter(
-                    x=df["Distance"],
-                    y=df["Velocity"],
-                    mode="lines",
-                    marker=dict(
-                        color=px.colors.qualitative.Dark24[
-                            i % len(px.colors.qualitative.Dark24)
-                        ]
-                    ),
-                    name=activity_date,
-                    hovertemplate=(
-                        "<b>%{meta}</b><br><br>"
-                        + "<b>Distance:</b> %{x:.2f} km<br>"
-                        + "<b>Speed:</b> %{customdata} min/km<br>"
-                        + "<extra></extra>"
-                    ),
-                    customdata=df["Velocity (minkm)"],
-                    meta=activity_date,
+            if _grid.any():
+                # A single image of the pixels in view, never the tracks
+                items.append(mo.image(density_png(_grid), width=MAP_WIDTH))
+            else:
+                items.append(mo.callout("No GPS points around the selected runs!"))
+
+        if _tiles["pending"]:
+            items.append(
+                mo.callout(
+                    f"{_tiles['pending']} older runs are not on the map yet:"
+                    " more are added every time the dashboard is opened, or"
+                    " all at once with `python -m engine.backfill`.",
+                    kind="info",
                 )
             )
 
-        fig.update_layout(
-            title={
-                "text": "Speed",
-                "font": {"size": 24},
-                "x": 0.5,
-                "xanchor": "center",
-            },
-            xaxis_title={"text": "Distance (km)", "font": {"size": 18}},
-            plot_bgcolor="rgba(0,0,0,0)",
-            paper_bgcolor="rgba(0,0,0,0)",
-            legend={
-                "bgcolor": "rgba(255,255,255,0.5)",
-                "bordercolor": "rgba(200,200,200,0.5)",
-                "borderwidth": 1,
-                "font": {"size": 12},
-                "orientation": "v",
-                "yanchor": "middle",
-                "y": 0.5,
-                "xanchor": "left",
-                "x": 1.01,
-            },
-            font={"family": "Arial"},
-            hovermode="closest",
-        )
+        return mo.vstack(items)
 
-        # Add grid lines but make them light
-        fig.update_xaxes(
-            showgrid=True,
-            gridwidth=1,
-            gridcolor="rgba(200,200,200,0.2)",
-            zeroline=False,
-        )
-        fig.update_yaxes(
-            showgrid=True,
-            gridwidth=1,
-            gridcolor="rgba(200,200,200,0.2)",
-            zeroline=False,
-        )
 
-        # Create custom tick positions and labels
-        velocity_ticks = np.arange(int(min_velocity), int(max_velocity) + 1, 0.25)
-        velocity_labels = [
-            f"{get_mt_km_speed_float(v):.2f}" for v in velocity_ticks
+    mo.vstack(
+        [
+            mo.md(
+                """
+                ---
+
+                ## Where I Run 🗺️
+
+                Every GPS point of your runs, counted per pixel: the deeper the color, the more often you ran there. The map is centered on the selected runs.
+                """
+            ),
+            map_zoom,
+            mo.lazy(_route_map, show_loading_indicator=True),
         ]
+    )
+    return
 
-        fig.update_layout(
-            yaxis=dict(
-                tickmode="array",
-                tickvals=velocity_ticks,  # Raw velocity values as tick positions
-                ticktext=velocity_labels,  # Converted min/km values as tick labels
-                title={
-                    "text": "Speed (min/km)",
-                    "font": {"size": 18, "color": "#333333"},
-                },
-            )
+
+@app.cell
+def _(CLUB_FILE, ingest_club, json, local, merge_club, mo):
+    # === Club ===
+
+    # Members' credentials and exports can only be read from disk
+    mo.stop(not local or not CLUB_FILE.exists())
+
+    _members = json.loads(CLUB_FILE.read_text())
+
+    with mo.status.progress_bar(
+        total=len(_members), title="Syncing club members...", remove_on_exit=True
+    ) as _bar:
+        _synced, _errors = ingest_club(
+            _members, on_member=lambda name: _bar.update(subtitle=name)
         )
 
-        return mo.vstack(
-            [
-                dropdown_activities,
-                mo.ui.plotly(fig),
-            ]
+    _failed = None
+
+    if _errors:
+        _failed = mo.callout(
+            mo.md(
+                "Some members could not be synced: "
+                + ", ".join(f"**{name}** ({error})" for name, error in _errors.items())
+            ),
+            kind="warn",
         )
-    return (activity_focus,)
+
+    mo.stop(not _synced, _failed)
+
+    club_df, member_days, club_days = merge_club(_synced)
+
+    _failed
+    return club_days, club_df, member_days
 
 
 @app.cell
-def _(alt, get_mt_km_speed, mo, pl):
-    # We need a specific function to handle speed conversion
-    # Moreover, since min/km distance is not interpretable as numbers
-    # we plot a standard bar chart and manually produce bins
-    def bar_chart_speed(_df):
-        if _df.height == 1:
-            return mo.callout(
-                "Select more than one activity to view speed distribution!"
-            )
+def _(TimeIndex, club_days, club_df, member_days, mo):
+    # Each member is a partition of the club frames: switching athlete
+    # is a slice, nothing is fetched or aggregated again
+    club_activity_index = TimeIndex(
+        club_df,
+        "start_date",
+        descending=True,
+        partition_by=["athlete", "sport_type"],
+    )
+    member_day_index = TimeIndex(
+        member_days, "period", partition_by=["athlete", "sport_type"]
+    )
+    club_day_index = TimeIndex(club_days, "period")
 
-        _df = (
-            _df["average_speed"]
-            .hist()
-            .with_columns(
-                extremes=pl.col("category")
-                .cast(pl.String)
-                .str.extract_all(r"([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)")
-            )
-        )
+    club_members = list(club_df.schema["athlete"].categories)
 
-        # here we invert max and min since higher km/h means lower min/km
-        _df = (
-            _df.with_columns(
-                max=pl.col("extremes")
-                .list.get(0)
-                .cast(pl.Float32)
-                .map_elements(get_mt_km_speed, return_dtype=pl.String),
-                min=pl.col("extremes")
-                .list.get(1)
-                .cast(pl.Float32)
-                .map_elements(get_mt_km_speed, return_dtype=pl.String),
-            )
-            .sort("min")
-            .with_columns(
-                range=pl.concat_str(pl.col("min"), pl.col("max"), separator=" - ")
-            )
+    club_athlete = mo.ui.dropdown(
+        options=["Whole club", *club_members],
+        value="Whole club",
+        label="Athlete",
+    )
+    return (
+        club_activity_index,
+        club_athlete,
+        club_day_index,
+        club_members,
+        member_day_index,
+    )
+
+
+@app.cell
+def _(
+    bar_chart_distance,
+    bar_chart_speed,
+    club_activity_index,
+    club_athlete,
+    club_day_index,
+    club_df,
+    club_members,
+    get_end_date,
+    get_start_date,
+    heatmap_chart,
+    leaderboard,
+    member_day_index,
+    member_days,
+    mo,
+    pl,
+):
+    _start = get_start_date()
+    _end = get_end_date()
+
+    _end_of_day = _end.replace(hour=23, minute=59, second=59)
+
+    # Running activities, in the same date range as the personal dashboard
+    if club_athlete.value == "Whole club":
+        # Spanning every partition, a single pass is faster than a slice
+        # of each member
+        _days = club_day_index.slice("Run", _start, _end)
+        _member_days = member_days.filter(
+            pl.col("sport_type") == "Run", pl.col("period").is_between(_start, _end)
+        )
+        _activities = club_df.filter(
+            pl.col("sport_type") == "Run",
+            pl.col("start_date").is_between(_start, _end_of_day),
         )
+    else:
+        _partition = (club_athlete.value, "Run")
+        _days = member_day_index.slice(_partition, _start, _end)
+        _member_days = _days
+        _activities = club_activity_index.slice(_partition, _start, _end_of_day)
 
-        return (
-            alt.Chart(
-                _df,
-                title=alt.TitleParams(
-                    "Speed Distribution", anchor="middle", fontSize=18
-                ),
-            )
-            .mark_bar()
-            .encode(
-                x=alt.X(
-                    "range:O",
-                    title="Speed (min/km)",
-                    axis=alt.Axis(
-                        labelAngle=0, labelFontSize=12, titleFontSize=15
-                    ),
+    if _activities.height == 0:
+        _views = mo.callout("No activities in the selected range!")
+    else:
+        _views = mo.ui.tabs(
+            {
+                "::lucide:calendar:: Heatmap": heatmap_chart(_days),
+                "::lucide:trophy:: Leaderboard": mo.ui.table(
+                    leaderboard(_member_days), selection=None
                 ),
-                y=alt.Y(
-                    "count",
-                    title="Counts",
-                    axis=alt.Axis(
-                        titleFontSize=15, labelAngle=0, labelFontSize=12
-                    ),
+                "::lucide:wind:: Speed": bar_chart_speed(_df=_activities),
+                "::lucide:land-plot:: Distance": bar_chart_distance(
+                    _df=_activities
                 ),
-            )
+            }
         )
 
+    mo.vstack(
+        [
+            mo.md(
+                f"""
+                ---
 
-    def bar_chart_distance(_df):
-        if _df.height == 1:
-            return mo.callout(
-                "Select more than one activity to view speed distribution!"
-            )
+                ## Club 👥
 
-        _df = (
-            _df["kms"]
-            .hist()
-            .with_columns(
-                extremes=pl.col("category")
-                .cast(pl.String)
-                .str.extract_all(r"([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)")
-            )
-        )
+                {len(club_members)} members, {_activities.height} runs and {_activities["kms"].sum():.0f} kilometers in the selected range.
+                """
+            ),
+            club_athlete,
+            _views,
+        ]
+    )
+    return
 
-        # Duplicate some code but fine, we are doing different things after all
-        _df = (
-            _df.with_columns(
-                min=pl.col("extremes").list.get(0).cast(pl.Float32).round(2),
-                max=pl.col("extremes").list.get(1).cast(pl.Float32).round(2),
-            )
-            .sort("min")
-            .with_columns(
-                range=pl.concat_str(pl.col("min"), pl.col("max"), separator=" - ")
-            )
-        )
 
-        return (
-            alt.Chart(
-                _df,
-                title=alt.TitleParams(
+@app.cell
+def _(mo, tracer):
+    # Recording can be turned on and off without running anything again
+    perf_switch = mo.ui.switch(
+        value=tracer.enabled,
+        label="Record timings",
+        on_change=lambda value: setattr(tracer, "enabled", value),
+    )
+    perf_refresh = mo.ui.run_button(label="Refresh")
+    return perf_refresh, perf_switch
+
+
+@app.cell
+def _(mo, perf_refresh, perf_switch, pl, stream_cache, tracer):
+    # Shown again whenever refreshed, timings keep being recorded meanwhile
+    perf_refresh.value
+
+    _summary = tracer.summary()
+    _, _counts = tracer.snapshot()
+    _counters = pl.DataFrame(
+        {"counter": list(_counts), "count": list(_counts.values())},
+        schema={"counter": pl.String, "count": pl.Int64},
+    ).sort("counter")
+
+    # Counted even while recording is off, since the session started
+    with stream_cache.lock:
+        _cache_stats = dict(stream_cache.stats) | {
+            "entries": len(stream_cache.entries),
+            "max bytes": stream_cache.max_bytes,
+        }
+    _cache_stats = pl.DataFrame(
+        {"stream cache": list(_cache_stats), "value": list(_cache_stats.values())},
+        schema={"stream cache": pl.String, "value": pl.Int64},
+    )
+
+    mo.accordion(
+        {
+            "::lucide:timer:: Performance": mo.vstack(
+                [
+                    mo.hstack(
+                        [
+                            perf_switch,
+                            perf_refresh,
+                            mo.download(
+                                data=lambda: tracer.chrome_trace().encode(),
+                                filename="strava_trace.json",
+                                mimetype="application/json",
+                                label="Chrome trace",
+                            ),
+                            mo.download(
+                                data=lambda: tracer.summary().write_csv().encode(),
+                                filename="strava_perf_summary.csv",
+                                mimetype="text/csv",
+                                label="Summary",
+                            ),
+                        ],
+                        justify="start",
+                        gap=1,
+                    ),
+                    mo.md(
+                        "Time spent in each stage of the dashboard, slowest first."
+                        " The trace opens in `chrome://tracing` or"
+                        " [Perfetto](https://ui.perfetto.dev)."
+                    ),
+                    mo.ui.table(_summary, selection=None)
+                    if _summary.height
+                    else mo.callout(
+                        "Nothing recorded yet: turn recording on, use the"
+                        " dashboard and refresh!"
+                    ),
+                    mo.ui.table(_counters, selection=None),
+                    mo.ui.table(_cache_stats, selection=None),
+                ]
+            )
+        }
+    )
+    return
+
+
+@app.cell
+def decimation(np):
+    # === DECIMATION ===
+
+    # Above this many points per output point, LTTB runs on the min-max
+    # decimated trace, which keeps its extremes at a fraction of the cost
+    MINMAX_RATIO = 4
+
+
+    def minmax_indices(x, y, n_out):
+        """
+        Indices of the lowest and highest point of (at most) `n_out // 2`
+        equally sized buckets, plus the first and last point.
+        """
+        n = len(y)
+        if n <= n_out:
+            return np.arange(n)
+
+        size = -(-n // max(n_out // 2, 1))
+        n_buckets = -(-n // size)
+
+        # One bucket per row, padded so that padding is never an extreme
+        lows = np.full(n_buckets * size, np.inf)
+        lows[:n] = y
+        highs = np.full(n_buckets * size, -np.inf)
+        highs[:n] = y
+
+        starts = np.arange(n_buckets) * size
+        argmins = starts + lows.reshape(n_buckets, size).argmin(axis=1)
+        argmaxs = starts + highs.reshape(n_buckets, size).argmax(axis=1)
+
+        return np.unique(np.concatenate([[0, n - 1], argmins, argmaxs]))
+
+
+    def _lttb(x, y, n_out):
+        n = len(y)
+        if n <= n_out:
+            return np.arange(n)
+
+        # The first and last points are buckets of their own
+        edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+        counts = np.diff(edges)
+        average_x = np.add.reduceat(x[: n - 1], edges[:-1]) / counts
+        average_y = np.add.reduceat(y[: n - 1], edges[:-1]) / counts
+
+        # The last bucket looks ahead at the last point
+        next_x = np.append(average_x[1:], x[n - 1])
+        next_y = np.append(average_y[1:], y[n - 1])
+
+        kept = np.empty(n_out, dtype=np.int64)
+        kept[0], kept[-1] = 0, n - 1
+
+        # Each pick depends on the previous one, only buckets are looped on
+        previous = 0
+        for i in range(n_out - 2):
+            low, high = edges[i], edges[i + 1]
+            previous_x, previous_y = x[previous], y[previous]
+
+            areas = np.abs(
+                (previous_x - next_x[i]) * (y[low:high] - previous_y)
+                - (previous_x - x[low:high]) * (next_y[i] - previous_y)
+            )
+            previous = low + np.argmax(areas)
+            kept[i + 1] = previous
+
+        return kept
+
+
+    def lttb_indices(x, y, n_out):
+        """
+        Indices of the points kept by Largest-Triangle-Three-Buckets, which
+        picks in each bucket the point forming the largest triangle with
+        the previous pick and the average of the next bucket.
+        """
+        n = len(y)
+        if n <= n_out:
+            return np.arange(n)
+        if n_out < 3:
+            return np.array([0, n - 1])[:n_out]
+
+        if n > MINMAX_RATIO * n_out:
+            kept = minmax_indices(x, y, MINMAX_RATIO * n_out)
+            return kept[_lttb(x[kept], y[kept], n_out)]
+
+        return _lttb(x, y, n_out)
+
+
+    def split_budget(lengths, budget, min_points=50):
+        """
+        Share a total number of points between traces, proportionally to
+        their length. Each trace gets at least `min_points`, less when there
+        are too many traces for the budget, which the shares never exceed.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if lengths.sum() <= budget:
+            return lengths
+
+        # Floors take up to half the budget, the rest is proportional
+        floor = np.minimum(lengths, min(min_points, budget // (2 * len(lengths))))
+
+        extra = lengths - floor
+        return floor + (budget - floor.sum()) * extra // extra.sum()
+
+
+    DECIMATORS = {"lttb": lttb_indices, "minmax": minmax_indices}
+    return DECIMATORS, split_budget
+
+
+@app.cell
+def focus_transforms(DECIMATORS, pace_expr, pl, tracer):
+    # Decimated traces are kept for the latest (activity, budget) pairs
+    TRACE_CACHE_SIZE = 64
+
+    _trace_cache = {}
+
+
+    def stream_to_trace(stream, n_points=None, min_velocity=1.0, method="lttb"):
+        """
+        Turn the distance and velocity streams of an activity into the
+        data of its Activity Focus trace: distance in km, velocity in m/s
+        and velocity as min/km labels, all computed at once by polars.
+        The trace is decimated to at most `n_points` points.
+        """
+        velocity = pl.col("velocity_smooth").cast(pl.Float64)
+
+        trace = (
+            # Filter out unreal Velocity values
+            stream.filter(velocity >= min_velocity, pl.col("distance").is_not_null())
+            .select(
+                Distance=pl.col("distance").cast(pl.Float64) / 1000,
+                Velocity=velocity,
+            )
+        )
+
+        if n_points is not None and trace.height > n_points:
+            trace = trace[
+                DECIMATORS[method](
+                    trace["Distance"].to_numpy(),
+                    trace["Velocity"].to_numpy(),
+                    n_points,
+                )
+            ]
+
+        # Labels are only computed for the points that are plotted
+        return trace.with_columns(
+            pl.col("Distance").round(2),
+            pace_expr(pl.col("Velocity")).alias("Velocity (minkm)"),
+        )
+
+
+    def activity_trace(activity_id, stream, n_points, method="lttb"):
+        """
+        Cached `stream_to_trace` of an activity.
+        """
+        key = (activity_id, n_points, method)
+
+        if key in _trace_cache:
+            tracer.count("trace cache hits")
+
+        else:
+            tracer.count("trace cache misses")
+
+            if len(_trace_cache) >= TRACE_CACHE_SIZE:
+                # Dicts are ordered, the first key is the oldest one
+                _trace_cache.pop(next(iter(_trace_cache)))
+
+            with tracer.span("stream to trace", rows=stream.height):
+                _trace_cache[key] = stream_to_trace(stream, n_points, method=method)
+
+        return _trace_cache[key]
+    return (activity_trace,)
+
+
+@app.cell
+def focus_comparison(np, pl, tracer):
+    # === DISTANCE RESAMPLING ===
+
+    # Streams the Activity Focus compares activities on
+    COMPARE_KEYS = ["time", "distance", "velocity_smooth"]
+
+    # Meters between two points of the distance grid activities share
+    GRID_STEP = 10.0
+
+    # Percentiles of the speed envelope
+    ENVELOPE_PERCENTILES = (10, 90)
+
+
+    def resample_streams(streams, step=GRID_STEP):
+        """
+        Time and velocity of each stream every `step` meters from its start,
+        as two (activities, grid) arrays, along with the grid. Points past
+        the end of an activity are NaN.
+        """
+        n_activities = len(streams)
+
+        # One frame of all the samples, without a query per stream
+        samples = (
+            pl.concat(
+                [stream[COMPARE_KEYS] for stream in streams], how="vertical_relaxed"
+            )
+            .with_columns(
+                activity=np.repeat(
+                    np.arange(n_activities, dtype=np.int32),
+                    [stream.height for stream in streams],
+                )
+            )
+            .filter(pl.col("distance").is_not_null())
+        )
+
+        if samples.is_empty():
+            return np.empty(0), np.empty((n_activities, 0)), np.empty((n_activities, 0))
+
+        with tracer.span("resample streams", "charts", rows=samples.height):
+            # Samples of an activity are contiguous: index of its first one
+            activity = samples["activity"].to_numpy()
+            counts = np.bincount(activity, minlength=n_activities)
+            first = (np.cumsum(counts) - counts)[activity]
+            is_first = first == np.arange(len(activity))
+
+            distance = samples["distance"].cast(pl.Float64).to_numpy()
+            distance = (distance - distance[first]).clip(0)
+
+            # Activities are laid end to end on one axis, each one past the
+            # end of the previous, so that running maxima and interpolation
+            # go through all of them at once
+            span = distance.max() + step
+            offsets = activity * span
+
+            # Distance never decreases, as GPS noise sometimes makes it do
+            distance = np.maximum.accumulate(distance + offsets) - offsets
+
+            velocity = samples["velocity_smooth"].cast(pl.Float64).fill_null(0.0)
+            velocity = velocity.to_numpy()
+
+            # Streams without a time stream are timed from their velocity
+            time = samples["time"].cast(pl.Float64).fill_null(np.nan).to_numpy()
+            untimed = np.bincount(activity, ~np.isnan(time), n_activities) == 0
+
+            elapsed = np.where(is_first, 0.0, np.diff(distance, prepend=0.0))
+            elapsed = np.cumsum(elapsed / velocity.clip(0.5))
+            time = np.where(
+                untimed[activity], elapsed - elapsed[first], time - time[first]
+            )
+
+            # The last sample of an activity is its furthest
+            last = np.flatnonzero(np.diff(activity, append=n_activities))
+            lengths = np.zeros(n_activities)
+            lengths[activity[last]] = distance[last]
+
+            grid = np.arange(lengths.max() // step + 1) * step
+            grid_x = (grid + span * np.arange(n_activities)[:, None]).ravel()
+            past_end = grid > lengths[:, None]
+
+            resampled = []
+            for values in [time, velocity]:
+                values = np.interp(grid_x, distance + offsets, values)
+                values = values.reshape(n_activities, len(grid))
+                values[past_end] = np.nan
+                resampled.append(values)
+
+        return grid, *resampled
+
+
+    def nan_percentiles(values, percentiles):
+        """
+        Percentiles of each column of `values` ignoring NaNs, interpolated
+        like `np.nanpercentile`, which loops over columns in python.
+        """
+        # NaNs are sorted last, the valid values of a column come first
+        ordered = np.sort(values, axis=0)
+        counts = (~np.isnan(values)).sum(axis=0)
+        positions = (
+            np.asarray(percentiles, dtype=np.float64)[:, None] / 100 * (counts - 1)
+        )
+
+        below = np.floor(positions).astype(np.int64).clip(0)
+        above = np.minimum(below + 1, len(values) - 1)
+        share = positions - below
+
+        low = np.take_along_axis(ordered, below, axis=0)
+        high = np.take_along_axis(ordered, above, axis=0)
+
+        # The value above is NaN at the top of a column, where it has no weight
+        return np.where(share > 0, low + share * (high - low), low)
+
+
+    def compare_streams(grid, times, velocities, percentiles=ENVELOPE_PERCENTILES):
+        """
+        Gap of each activity to the first one, in seconds and positive when
+        behind it, and the mean velocity, its standard deviation and its
+        percentiles at every point of the grid over the activities that got
+        there.
+        """
+        gaps = times - times[:1]
+
+        # Every point of the grid is reached by the longest activity
+        low, high = nan_percentiles(velocities, percentiles)
+        band = pl.DataFrame(
+            {
+                "distance": grid,
+                "activities": (~np.isnan(velocities)).sum(axis=0),
+                "mean": np.nanmean(velocities, axis=0),
+                "std": np.nanstd(velocities, axis=0),
+                "low": low,
+                "high": high,
+            }
+        )
+
+        return gaps, band
+    return COMPARE_KEYS, compare_streams, resample_streams
+
+
+@app.cell
+def _(
+    COMPARE_KEYS,
+    activity_trace,
+    compare_streams,
+    displayed_activities,
+    dropdown_activities,
+    fetch_activity_streams,
+    get_mocked_activity_stream,
+    load_mocked_activities,
+    load_plotly,
+    mo,
+    np,
+    pace_expr,
+    pl,
+    resample_streams,
+    split_budget,
+    tracer,
+):
+    # Total number of points of the Activity Focus traces
+    FOCUS_POINTS = 4000
+
+
+    def _gap_figure(plotly, grid, gaps, names, colors):
+        # Gaps are cumulative and smooth: every few points are enough
+        step = max(-(-gaps[1:].size // FOCUS_POINTS), 1)
+        fig = plotly.graph_objects.Figure()
+
+        for gap, name, color in zip(gaps[1:], names[1:], colors[1:]):
+            fig.add_trace(
+                plotly.graph_objects.Scatter(
+                    x=grid[::step] / 1000,
+                    y=gap[::step],
+                    mode="lines",
+                    marker=dict(color=color),
+                    name=name,
+                    hovertemplate=(
+                        "<b>%{meta}</b><br><br>"
+                        + "<b>Distance:</b> %{x:.2f} km<br>"
+                        + "<b>Gap:</b> %{y:+.0f} s<br>"
+                        + "<extra></extra>"
+                    ),
+                    meta=name,
+                )
+            )
+
+        fig.add_hline(y=0, line={"color": colors[0], "dash": "dot"})
+        fig.update_layout(
+            title={
+                "text": f"Gap to {names[0]}",
+                "font": {"size": 24},
+                "x": 0.5,
+                "xanchor": "center",
+            },
+            xaxis_title={"text": "Distance (km)", "font": {"size": 18}},
+            yaxis_title={"text": "Seconds behind", "font": {"size": 18}},
+            plot_bgcolor="rgba(0,0,0,0)",
+            paper_bgcolor="rgba(0,0,0,0)",
+            font={"family": "Arial"},
+            hovermode="closest",
+        )
+        fig.update_xaxes(showgrid=True, gridcolor="rgba(200,200,200,0.2)")
+        fig.update_yaxes(showgrid=True, gridcolor="rgba(200,200,200,0.2)")
+
+        return fig
+
+
+    async def activity_focus():
+        if not dropdown_activities.value:
+            return mo.vstack(
+                [
+                    dropdown_activities,
+                    mo.callout("Select at least one activity!"),
+                ]
+            )
+
+        with tracer.span("load plotly", "startup"):
+            plotly = await load_plotly()
+
+        fig = plotly.graph_objects.Figure()
+
+        selected_activities = displayed_activities.filter(
+            pl.col("start_date_str").is_in(dropdown_activities.value)
+        )
+
+        min_velocity = None
+        max_velocity = None
+
+        selected_ids = selected_activities["id"].to_list()
+
+        # All streams are downloaded at once, concurrently
+        with tracer.span("focus streams", "network", activities=len(selected_ids)):
+            if load_mocked_activities:
+                streams = {
+                    _id: get_mocked_activity_stream(_id, keys=COMPARE_KEYS)
+                    for _id in selected_ids
+                }
+            else:
+                streams = dict(fetch_activity_streams(selected_ids, keys=COMPARE_KEYS))
+
+        streams = {
+            _id: streams[_id] for _id in selected_ids if streams[_id] is not None
+        }
+
+        # However many and long the activities are, their speed
+        # traces never hold more than FOCUS_POINTS points together
+        budgets = dict(
+            zip(
+                streams,
+                split_budget(
+                    [stream.height for stream in streams.values()], FOCUS_POINTS
+                ).tolist(),
+            )
+        )
+
+        # Failed streams, and traces without any real velocity, are left out
+        traces = {
+            _id: activity_trace(_id, stream, budgets[_id])
+            for _id, stream in streams.items()
+        }
+        traces = {_id: df for _id, df in traces.items() if not df.is_empty()}
+        streams = {_id: streams[_id] for _id in traces}
+
+        if not traces:
+            return mo.vstack(
+                [
+                    dropdown_activities,
+                    mo.callout(
+                        "No speed data for the selected activities!", kind="warn"
+                    ),
+                ]
+            )
+
+        dates = dict(
+            zip(selected_activities["id"], selected_activities["start_date_str"])
+        )
+        colors = {
+            _id: plotly.colors.qualitative.Dark24[
+                i % len(plotly.colors.qualitative.Dark24)
+            ]
+            for i, _id in enumerate(streams)
+        }
+
+        # Activities are compared with the first one picked, on the distances
+        # they have in common
+        picked = {date: _id for _id, date in dates.items() if _id in streams}
+        compared_ids = [
+            picked[date] for date in dropdown_activities.value if date in picked
+        ]
+        gap_plot = None
+
+        if len(compared_ids) > 1:
+            grid, times, velocities = resample_streams(
+                [streams[_id] for _id in compared_ids]
+            )
+            gaps, band = compare_streams(grid, times, velocities)
+
+            # Speed envelope behind the traces, every few points
+            band = band.gather_every(max(-(-band.height // (FOCUS_POINTS // 4)), 1))
+            fig.add_trace(
+                plotly.graph_objects.Scatter(
+                    x=band["distance"] / 1000,
+                    y=band["high"],
+                    mode="lines",
+                    line={"width": 0},
+                    hoverinfo="skip",
+                    showlegend=False,
+                )
+            )
+            fig.add_trace(
+                plotly.graph_objects.Scatter(
+                    x=band["distance"] / 1000,
+                    y=band["low"],
+                    mode="lines",
+                    line={"width": 0},
+                    fill="tonexty",
+                    fillcolor="rgba(150,150,150,0.2)",
+                    name="10th-90th percentile",
+                    hoverinfo="skip",
+                )
+            )
+            fig.add_trace(
+                plotly.graph_objects.Scatter(
+                    x=band["distance"] / 1000,
+                    y=band["mean"],
+                    mode="lines",
+                    line={"color": "rgba(100,100,100,0.8)", "dash": "dash"},
+                    name="Mean",
+                    hovertemplate=(
+                        "<b>Mean</b><br><br>"
+                        + "<b>Distance:</b> %{x:.2f} km<br>"
+                        + "<b>Speed:</b> %{customdata} min/km<br>"
+                        + "<extra></extra>"
+                    ),
+                    customdata=band.select(pace_expr(pl.col("mean"))).to_series(),
+                )
+            )
+
+            with tracer.span("focus serialize", "charts"):
+                gap_plot = mo.ui.plotly(
+                    _gap_figure(
+                        plotly,
+                        grid,
+                        gaps,
+                        [dates[_id] for _id in compared_ids],
+                        [colors[_id] for _id in compared_ids],
+                    )
+                )
+
+        for _id, df in traces.items():
+            min_velocity = (
+                df["Velocity"].min()
+                if not min_velocity
+                else min(min_velocity, df["Velocity"].min())
+            )
+            max_velocity = (
+                df["Velocity"].max()
+                if not max_velocity
+                else max(max_velocity, df["Velocity"].max())
+            )
+
+            activity_date = dates[_id]
+
+            fig.add_trace(
+                plotly.graph_objects.Scatter(
+                    x=df["Distance"],
+                    y=df["Velocity"],
+                    mode="lines",
+                    marker=dict(color=colors[_id]),
+                    name=activity_date,
+                    hovertemplate=(
+                        "<b>%{meta}</b><br><br>"
+                        + "<b>Distance:</b> %{x:.2f} km<br>"
+                        + "<b>Speed:</b> %{customdata} min/km<br>"
+                        + "<extra></extra>"
+                    ),
+                    customdata=df["Velocity (minkm)"],
+                    meta=activity_date,
+                )
+            )
+
+        fig.update_layout(
+            title={
+                "text": "Speed",
+                "font": {"size": 24},
+                "x": 0.5,
+                "xanchor": "center",
+            },
+            xaxis_title={"text": "Distance (km)", "font": {"size": 18}},
+            plot_bgcolor="rgba(0,0,0,0)",
+            paper_bgcolor="rgba(0,0,0,0)",
+            legend={
+                "bgcolor": "rgba(255,255,255,0.5)",
+                "bordercolor": "rgba(200,200,200,0.5)",
+                "borderwidth": 1,
+                "font": {"size": 12},
+                "orientation": "v",
+                "yanchor": "middle",
+                "y": 0.5,
+                "xanchor": "left",
+                "x": 1.01,
+            },
+            font={"family": "Arial"},
+            hovermode="closest",
+        )
+
+        # Add grid lines but make them light
+        fig.update_xaxes(
+            showgrid=True,
+            gridwidth=1,
+            gridcolor="rgba(200,200,200,0.2)",
+            zeroline=False,
+        )
+        fig.update_yaxes(
+            showgrid=True,
+            gridwidth=1,
+            gridcolor="rgba(200,200,200,0.2)",
+            zeroline=False,
+        )
+
+        # Create custom tick positions and labels
+        velocity_ticks = np.arange(int(min_velocity), int(max_velocity) + 1, 0.25)
+        velocity_labels = pl.select(
+            pace_expr(pl.lit(velocity_ticks), pad_minutes=False, separator=".")
+        ).to_series()
+
+        fig.update_layout(
+            yaxis=dict(
+                tickmode="array",
+                tickvals=velocity_ticks,  # Raw velocity values as tick positions
+                ticktext=velocity_labels,  # Converted min/km values as tick labels
+                title={
+                    "text": "Speed (min/km)",
+                    "font": {"size": 18, "color": "#333333"},
+                },
+            )
+        )
+
+        # The figure is serialized for the browser when the element is created
+        with tracer.span("focus serialize", "charts"):
+            plot = mo.ui.plotly(fig)
+
+        return mo.vstack(
+            [
+                dropdown_activities,
+                plot,
+                *([gap_plot] if gap_plot is not None else []),
+            ]
+        )
+    return (activity_focus,)
+
+
+@app.cell
+def _(
+    EFFORT_KEYS,
+    EFFORT_SPORTS,
+    activities,
+    analyze_activities,
+    analyze_curves,
+    displayed_activities,
+    dropdown_activities,
+    fetch_activity_streams,
+    get_mocked_activity_stream,
+    load_mocked_activities,
+    mo,
+    pace_curve,
+    pace_curve_chart,
+    pl,
+    pr_chart,
+    pr_progression,
+    pr_table,
+    splits_table,
+    sync_curves,
+    sync_efforts,
+):
+    # === BEST EFFORTS AND SPLITS ===
+
+    # Runs processed per session, newest first: each one may need its
+    # streams downloaded. `python -m engine.backfill` processes the rest
+    EFFORTS_BATCH = 50
+
+    # Computed the first time one of the tabs is opened
+    _efforts = {}
+    _curves = {}
+
+
+    def _get_streams(activity_ids):
+        if load_mocked_activities:
+            return (
+                (_id, get_mocked_activity_stream(_id, keys=EFFORT_KEYS))
+                for _id in activity_ids
+            )
+
+        # Runs whose streams failed are not stored as processed, and are
+        # processed again next time
+        return fetch_activity_streams(activity_ids, keys=EFFORT_KEYS, skip_failed=True)
+
+
+    def _load_efforts():
+        if not _efforts:
+            if load_mocked_activities:
+                # Nothing is stored for the mocked data
+                _efforts["efforts"], _efforts["splits"] = analyze_activities(
+                    activities.filter(pl.col("sport_type").is_in(EFFORT_SPORTS))[
+                        "id"
+                    ].to_list(),
+                    _get_streams,
+                )
+                _efforts["pending"] = 0
+            else:
+                (
+                    _efforts["efforts"],
+                    _efforts["splits"],
+                    _efforts["pending"],
+                ) = sync_efforts(activities, _get_streams, limit=EFFORTS_BATCH)
+
+        return _efforts
+
+
+    def _load_curves():
+        if not _curves:
+            if load_mocked_activities:
+                _curves["curves"] = analyze_curves(
+                    activities.filter(pl.col("sport_type").is_in(EFFORT_SPORTS))[
+                        "id"
+                    ].to_list(),
+                    _get_streams,
+                )
+                _curves["pending"] = 0
+            else:
+                _curves["curves"], _curves["pending"] = sync_curves(
+                    activities, _get_streams, limit=EFFORTS_BATCH
+                )
+
+        return _curves
+
+
+    def best_efforts_tab():
+        _results = _load_efforts()
+        progression = pr_progression(_results["efforts"], activities)
+
+        items = [
+            pr_chart(progression),
+            mo.ui.table(pr_table(progression), selection=None),
+        ]
+
+        if _results["pending"]:
+            items.append(
+                mo.callout(
+                    f"{_results['pending']} older runs have no best efforts yet:"
+                    " more are processed every time the dashboard is opened, or"
+                    " all at once with `python -m engine.backfill`.",
+                    kind="info",
+                )
+            )
+
+        return mo.vstack(items)
+
+
+    def pace_curve_tab():
+        _results = _load_curves()
+        items = [pace_curve_chart(pace_curve(_results["curves"], activities))]
+
+        if _results["pending"]:
+            items.append(
+                mo.callout(
+                    f"{_results['pending']} older runs are not in the curve yet:"
+                    " more are added every time the dashboard is opened, or"
+                    " all at once with `python -m engine.backfill`.",
+                    kind="info",
+                )
+            )
+
+        return mo.vstack(items)
+
+
+    def splits_tab():
+        if not dropdown_activities.value:
+            return mo.vstack(
+                [
+                    dropdown_activities,
+                    mo.callout("Select at least one activity!"),
+                ]
+            )
+
+        selected = displayed_activities.filter(
+            pl.col("start_date_str").is_in(dropdown_activities.value)
+        )
+        splits = _load_efforts()["splits"].filter(
+            pl.col("activity_id").is_in(selected["id"].implode())
+        )
+
+        # Runs not processed yet are split on the fly
+        _missing = selected.filter(
+            ~pl.col("id").is_in(splits["activity_id"].implode())
+        )
+        if _missing.height:
+            splits = pl.concat(
+                [splits, analyze_activities(_missing["id"].to_list(), _get_streams)[1]]
+            )
+
+        return mo.vstack(
+            [
+                dropdown_activities,
+                mo.ui.table(splits_table(splits, selected), selection=None),
+            ]
+        )
+    return EFFORTS_BATCH, best_efforts_tab, pace_curve_tab, splits_tab
+
+
+@app.cell
+def _(
+    EFFORTS_BATCH,
+    TILE_KEYS,
+    TILE_SPORTS,
+    activities,
+    build_pyramid,
+    fetch_activity_streams,
+    get_mocked_activity_stream,
+    load_mocked_activities,
+    load_tiles,
+    pl,
+    rasterize_activities,
+    sync_tiles,
+):
+    # === ROUTE TILES ===
+
+    # Synced the first time the map is shown, then kept for the session
+    _tiles = {}
+
+
+    def _get_streams(activity_ids):
+        if load_mocked_activities:
+            return (
+                (_id, get_mocked_activity_stream(_id, keys=TILE_KEYS))
+                for _id in activity_ids
+            )
+
+        # Runs whose streams failed are not marked as tiled, and are
+        # rasterized again next time
+        return fetch_activity_streams(activity_ids, keys=TILE_KEYS, skip_failed=True)
+
+
+    def load_route_tiles():
+        """
+        Tile pyramid of the runs, and the number of runs not in it yet.
+        """
+        if not _tiles:
+            if load_mocked_activities:
+                # Nothing is stored for the mocked data
+                _pixels, _ = rasterize_activities(
+                    activities.filter(pl.col("sport_type").is_in(TILE_SPORTS))[
+                        "id"
+                    ].to_list(),
+                    _get_streams,
+                )
+                _tiles["pyramid"] = build_pyramid(_pixels)
+                _tiles["pending"] = 0
+            else:
+                _tiles["pending"] = sync_tiles(
+                    activities, _get_streams, limit=EFFORTS_BATCH
+                )
+                _tiles["pyramid"] = load_tiles()
+
+        return _tiles
+    return (load_route_tiles,)
+
+
+@app.cell
+def histograms(alt, mo, pace_expr, pl, tracer):
+    # We need a specific function to handle speed conversion
+    # Moreover, since min/km distance is not interpretable as numbers
+    # we plot a standard bar chart and manually produce bins
+    def speed_histogram(_df):
+        _df = (
+            _df["average_speed"]
+            .hist()
+            .with_columns(
+                extremes=pl.col("category")
+                .cast(pl.String)
+                .str.extract_all(r"([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)")
+            )
+        )
+
+        # here we invert max and min since higher km/h means lower min/km
+        return (
+            _df.with_columns(
+                max=pace_expr(pl.col("extremes").list.get(0).cast(pl.Float32)),
+                min=pace_expr(pl.col("extremes").list.get(1).cast(pl.Float32)),
+            )
+            .sort("min")
+            # Only the encoded columns are sent to the browser
+            .select(
+                range=pl.concat_str(pl.col("min"), pl.col("max"), separator=" - "),
+                count="count",
+            )
+        )
+
+
+    def bar_chart_speed(_df):
+        if _df.height == 1:
+            return mo.callout(
+                "Select more than one activity to view speed distribution!"
+            )
+
+        with tracer.span("speed histogram", "charts", rows=_df.height):
+            _df = speed_histogram(_df)
+
+        return (
+            alt.Chart(
+                _df,
+                title=alt.TitleParams(
+                    "Speed Distribution", anchor="middle", fontSize=18
+                ),
+            )
+            .mark_bar()
+            .encode(
+                x=alt.X(
+                    "range:O",
+                    title="Speed (min/km)",
+                    axis=alt.Axis(
+                        labelAngle=0, labelFontSize=12, titleFontSize=15
+                    ),
+                ),
+                y=alt.Y(
+                    "count",
+                    title="Counts",
+                    axis=alt.Axis(
+                        titleFontSize=15, labelAngle=0, labelFontSize=12
+                    ),
+                ),
+            )
+        )
+
+
+    def distance_histogram(_df):
+        _df = (
+            _df["kms"]
+            .hist()
+            .with_columns(
+                extremes=pl.col("category")
+                .cast(pl.String)
+                .str.extract_all(r"([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)")
+            )
+        )
+
+        # Duplicate some code but fine, we are doing different things after all
+        return (
+            _df.with_columns(
+                min=pl.col("extremes").list.get(0).cast(pl.Float32).round(2),
+                max=pl.col("extremes").list.get(1).cast(pl.Float32).round(2),
+            )
+            .sort("min")
+            # Only the encoded columns are sent to the browser
+            .select(
+                range=pl.concat_str(pl.col("min"), pl.col("max"), separator=" - "),
+                count="count",
+            )
+        )
+
+
+    def bar_chart_distance(_df):
+        if _df.height == 1:
+            return mo.callout(
+                "Select more than one activity to view speed distribution!"
+            )
+
+        with tracer.span("distance histogram", "charts", rows=_df.height):
+            _df = distance_histogram(_df)
+
+        return (
+            alt.Chart(
+                _df,
+                title=alt.TitleParams(
                     "Distance Distribution", anchor="middle", fontSize=18
                 ),
             )
-            .mark_bar()
-            .encode(
-                x=alt.X(
-                    "range:O",
-                    title="Distance (km)",
-                    sort=None,  # prevent sorting otherwise "9" > "1"
-                    axis=alt.Axis(
-                        labelAngle=0, labelFontSize=12, titleFontSize=15
+            .mark_bar()
+            .encode(
+                x=alt.X(
+                    "range:O",
+                    title="Distance (km)",
+                    sort=None,  # prevent sorting otherwise "9" > "1"
+                    axis=alt.Axis(
+                        labelAngle=0, labelFontSize=12, titleFontSize=15
+                    ),
+                ),
+                y=alt.Y(
+                    "count",
+                    title="Counts",
+                    axis=alt.Axis(
+                        titleFontSize=15, labelAngle=0, labelFontSize=12
+                    ),
+                ),
+            )
+        )
+    return bar_chart_distance, bar_chart_speed
+
+
+@app.cell
+def effort_charts(
+    EFFORT_DISTANCES,
+    alt,
+    duration_expr,
+    mo,
+    pace_expr,
+    pl,
+    tracer,
+):
+    # Paces are plotted as minutes per km, labelled as MM:SS
+    _PACE_LABEL = (
+        "floor(datum.value) + ':'"
+        " + (floor(datum.value % 1 * 60) < 10 ? '0' : '')"
+        " + floor(datum.value % 1 * 60)"
+    )
+
+
+    def pr_chart(progression):
+        """
+        Best time over each distance as it improved, as a pace so that
+        all distances share the same axis.
+        """
+        if progression.height == 0:
+            return mo.callout("No best efforts yet!")
+
+        with tracer.span("pr chart", "charts", rows=progression.height):
+            speed = pl.col("distance") / pl.col("elapsed_time")
+
+            # Only the encoded columns are sent to the browser
+            _df = progression.select(
+                Effort="effort",
+                Date="start_date",
+                Activity="name",
+                Minutes=1 / (speed * 0.06),
+                Time=duration_expr(pl.col("elapsed_time")),
+                Pace=pace_expr(speed),
+            )
+
+        return (
+            alt.Chart(
+                _df,
+                title=alt.TitleParams(
+                    "Personal Records", anchor="middle", fontSize=18
+                ),
+            )
+            .mark_line(interpolate="step-after", point=True)
+            .encode(
+                x=alt.X(
+                    "Date:T",
+                    axis=alt.Axis(labelFontSize=12, titleFontSize=15),
+                ),
+                y=alt.Y(
+                    "Minutes:Q",
+                    title="Pace (min/km)",
+                    # Faster is higher
+                    scale=alt.Scale(zero=False, reverse=True),
+                    axis=alt.Axis(
+                        labelExpr=_PACE_LABEL, labelFontSize=12, titleFontSize=15
+                    ),
+                ),
+                color=alt.Color("Effort:N", sort=list(EFFORT_DISTANCES)),
+                tooltip=["Effort", "Date:T", "Activity", "Time", "Pace"],
+            )
+        )
+
+
+    def pr_table(progression):
+        """
+        Current best time over each distance.
+        """
+        return (
+            progression.sort("elapsed_time")
+            .unique("effort", keep="first")
+            .sort(
+                pl.col("effort").replace_strict(
+                    {name: i for i, name in enumerate(EFFORT_DISTANCES)},
+                    default=len(EFFORT_DISTANCES),
+                )
+            )
+            .select(
+                Effort="effort",
+                Time=duration_expr(pl.col("elapsed_time")),
+                Pace=pace_expr(pl.col("distance") / pl.col("elapsed_time")),
+                Date=pl.col("start_date").dt.strftime("%Y/%m/%d"),
+                Activity="name",
+            )
+        )
+
+
+    def splits_table(splits, activities):
+        """
+        Splits of the given activities, one row per split.
+        """
+        return (
+            splits.join(
+                activities.select(activity_id="id", start_date_str="start_date_str"),
+                on="activity_id",
+            )
+            .sort("start_date_str", "split")
+            .select(
+                Activity="start_date_str",
+                Split="split",
+                Distance=(pl.col("distance") / 1000).round(2),
+                Time=duration_expr(pl.col("elapsed_time")),
+                Pace=pace_expr(pl.col("distance") / pl.col("elapsed_time")),
+            )
+        )
+
+    def pace_curve_chart(curve):
+        """
+        Best pace held over each duration, of all time and of each year,
+        durations on a log scale.
+        """
+        if curve.height == 0:
+            return mo.callout("No pace curve yet!")
+
+        with tracer.span("pace curve chart", "charts", rows=curve.height):
+            # Only the encoded columns are sent to the browser
+            _df = curve.select(
+                Season="season",
+                Seconds="duration",
+                Minutes=1 / (pl.col("speed") * 0.06),
+                Duration=duration_expr(pl.col("duration")),
+                Pace=pace_expr(pl.col("speed")),
+                Date=pl.col("start_date").dt.strftime("%Y/%m/%d"),
+                Activity="name",
+            )
+
+        seasons = sorted(set(_df["Season"]) - {"All time"}, reverse=True)
+        # Years can be hidden by clicking on the legend
+        season = alt.selection_point(fields=["Season"], bind="legend")
+
+        return (
+            alt.Chart(
+                _df,
+                title=alt.TitleParams(
+                    "Mean-Maximal Pace", anchor="middle", fontSize=18
+                ),
+            )
+            .mark_line(point=True)
+            .encode(
+                x=alt.X(
+                    "Seconds:Q",
+                    title="Duration",
+                    scale=alt.Scale(type="log"),
+                    axis=alt.Axis(
+                        values=[10, 30, 60, 300, 600, 1800, 3600, 10800],
+                        labelExpr=(
+                            "datum.value < 60 ? datum.value + ' s'"
+                            " : datum.value < 3600 ? datum.value / 60 + ' min'"
+                            " : datum.value / 3600 + ' h'"
+                        ),
+                        labelFontSize=12,
+                        titleFontSize=15,
+                    ),
+                ),
+                y=alt.Y(
+                    "Minutes:Q",
+                    title="Pace (min/km)",
+                    # Faster is higher
+                    scale=alt.Scale(zero=False, reverse=True),
+                    axis=alt.Axis(
+                        labelExpr=_PACE_LABEL, labelFontSize=12, titleFontSize=15
+                    ),
+                ),
+                color=alt.Color("Season:N", sort=["All time", *seasons]),
+                opacity=alt.condition(season, alt.value(1.0), alt.value(0.1)),
+                tooltip=["Season", "Duration", "Pace", "Date", "Activity"],
+            )
+            .add_params(season)
+        )
+    return pace_curve_chart, pr_chart, pr_table, splits_table
+
+
+@app.cell
+def load_charts(alt, mo, pl, tracer):
+    # Names and colors of the training load series
+    LOAD_SERIES = {
+        "ctl": ("Fitness", "#1f77b4"),
+        "atl": ("Fatigue", "#d62728"),
+        "tsb": ("Form", "#2ca02c"),
+    }
+
+
+    def training_load_chart(series):
+        """
+        Fitness, fatigue and form over a slice of the training load of
+        a metric.
+        """
+        if series.height == 0:
+            return mo.callout("No training load in the selected range!")
+
+        with tracer.span("training load chart", "charts", rows=series.height):
+            # Only the encoded columns are sent to the browser
+            _df = series.unpivot(
+                on=list(LOAD_SERIES), index="period", variable_name="series"
+            ).select(
+                Date="period",
+                Series=pl.col("series").replace_strict(
+                    {key: name for key, (name, _) in LOAD_SERIES.items()}
+                ),
+                Value=pl.col("value").round(1),
+            )
+
+        names = [name for name, _ in LOAD_SERIES.values()]
+
+        return (
+            alt.Chart(
+                _df,
+                title=alt.TitleParams(
+                    "Fitness, Fatigue and Form", anchor="middle", fontSize=18
+                ),
+            )
+            .mark_line()
+            .encode(
+                x=alt.X(
+                    "Date:T",
+                    axis=alt.Axis(labelFontSize=12, titleFontSize=15),
+                ),
+                y=alt.Y(
+                    "Value:Q",
+                    title="Load",
+                    axis=alt.Axis(labelFontSize=12, titleFontSize=15),
+                ),
+                color=alt.Color(
+                    "Series:N",
+                    scale=alt.Scale(
+                        domain=names,
+                        range=[color for _, color in LOAD_SERIES.values()],
+                    ),
+                ),
+                tooltip=["Date:T", "Series", "Value"],
+            )
+            .properties(width="container")
+        )
+    return (training_load_chart,)
+
+
+@app.cell
+def heatmap(alt, days, mo, pl, tracer):
+    # unused because I ended up liking more the result of polars.hist
+    def _bar_chart(_df, _column_name, _display_name, _unit_measure):
+        if _df.height == 1:
+            return mo.callout(
+                f"Select more than one activity to view {_display_name} distribution!"
+            )
+
+        return (
+            alt.Chart(
+                _df,
+                title=alt.TitleParams(
+                    f"{_display_name.capitalize()} Distribution",
+                    anchor="middle",
+                    fontSize=18,
+                ),
+            )
+            .mark_bar()
+            .encode(
+                x=alt.X(
+                    f"{_column_name}:Q",
+                    bin=True,
+                    title=f"{_display_name.capitalize()} ({_unit_measure})",
+                    axis=alt.Axis(
+                        labelAngle=0, labelFontSize=12, titleFontSize=15
+                    ),
+                ),
+                y=alt.Y(
+                    "count()",
+                    title="Counts",
+                    axis=alt.Axis(
+                        titleFontSize=15, labelAngle=0, labelFontSize=12
+                    ),
+                ),
+            )
+        )
+
+
+    def heatmap_chart(_df):
+        # Days come already aggregated from the per day rollup
+        # 1. Sort weeks from the most recent one
+        # 2. Replace each day with its name
+        # 3. Round kilometers to 2 decimal digits
+        # Only the columns of the encoding are sent to the browser, with
+        # compact types: the data is shipped as Arrow and repeated
+        # strings are dictionary encoded
+
+        with tracer.span("heatmap spec", "charts", rows=_df.height):
+            sorted_years_week = (
+                _df.sort("year", "week", descending=True)
+                .select(pl.concat_str(pl.col("year"), pl.col("week"), separator=" - "))
+                .to_series()
+                .unique(maintain_order=True)
+                .to_list()
+            )
+
+            source = _df.select(
+                day=pl.col("day").replace_strict(
+                    days, return_dtype=pl.Enum(list(days.values()))
+                ),
+                year_week=pl.concat_str(
+                    pl.col("year"), pl.col("week"), separator=" - "
+                ).cast(pl.Categorical),
+                Kilometers=pl.col("kms").round(2).cast(pl.Float32),
+                Date=pl.col("start_date"),  # keep also start date to show it in plot
+            )
+
+            altair_chart = (
+                alt.Chart(source)
+                .mark_rect()
+                .encode(
+                    x=alt.X(
+                        "day:O",
+                        title="Day of Week",
+                        sort=list(days.values()),
+                        axis=alt.Axis(
+                            labelAngle=0, labelFontSize=12, titleFontSize=15, titleY=28
+                        ),
+                    ),
+                    y=alt.Y(
+                        "year_week:O",
+                        title="Week",
+                        sort=sorted_years_week,
+                        axis=alt.Axis(labels=False, tickSize=0, titleFontSize=15),
+                    ),
+                    color=alt.Color(
+                        "Kilometers:Q",
+                        title="Kilometers",
+                        legend=alt.Legend(labelFontSize=12, titleFontSize=14),
+                    ).scale(),
+                    tooltip=["Date", "Kilometers"],
+                )
+            )
+
+        # The data is serialized for the browser when the element is created
+        with tracer.span("heatmap serialize", "charts"):
+            return mo.ui.altair_chart(chart=altair_chart, chart_selection=True)
+    return (heatmap_chart,)
+
+
+@app.cell
+def _(displayed_activities, mo):
+    _options = displayed_activities["start_date_str"].to_list()
+    dropdown_activities = mo.ui.multiselect(
+        options=_options,
+        label="Select activity",
+        value=_options[:1],
+        max_selections=100,
+    )
+    return (dropdown_activities,)
+
+
+@app.cell
+def _(
+    COMPARE_KEYS,
+    displayed_activities,
+    load_mocked_activities,
+    prefetch_activity_streams,
+    sys,
+):
+    # Start downloading in the background the streams that are most likely
+    # to be picked in the Activity Focus tab, i.e. the ones of the latest
+    # activities of the heatmap selection.
+    # Threads are not available in WASM, where this would block instead
+    if not load_mocked_activities and "pyodide" not in sys.modules:
+        prefetch_activity_streams(
+            displayed_activities["id"].head(10).to_list(),
+            keys=COMPARE_KEYS,
+        )
+    return
+
+
+@app.cell
+def perf(collections, json, os, pl, threading, time):
+    # === PERFORMANCE ===
+
+    # Timings are recorded when this variable is set, or from the
+    # performance panel at the bottom of the dashboard
+    PERF_ENV = "STRAVA_PERF"
+
+    # The oldest events are dropped past this, so that tracing a long
+    # session holds a bounded amount of memory
+    MAX_EVENTS = 100_000
+
+
+    class _NoSpan:
+        # Returned by every span while tracing is disabled, so that
+        # nothing is allocated nor timed
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def set(self, **args):
+            pass
+
+
+    _NO_SPAN = _NoSpan()
+
+
+    class _Span:
+        def __init__(self, tracer, name, category, args):
+            self.tracer = tracer
+            self.name = name
+            self.category = category
+            self.args = args
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            end = time.perf_counter()
+
+            if exc_type is not None:
+                self.args["error"] = exc_type.__name__
+
+            self.tracer._append(
+                {
+                    "name": self.name,
+                    "cat": self.category,
+                    "ph": "X",
+                    "ts": (self.start - self.tracer.origin) * 1e6,
+                    "dur": (end - self.start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": self.args,
+                }
+            )
+            return False
+
+        def set(self, **args):
+            """
+            Attach values to the span, e.g. the rows or bytes processed.
+            """
+            self.args.update(args)
+
+
+    class Tracer:
+        """
+        Timings and counters of the pipeline, recorded as Chrome trace
+        events. Spans time a stage or a request, counters count retries,
+        cache hits and misses. While disabled, both return right away.
+        """
+
+        def __init__(self, enabled=False, max_events=MAX_EVENTS):
+            self.enabled = enabled
+            self.origin = time.perf_counter()
+            self.events = collections.deque(maxlen=max_events)
+            self.counters = collections.Counter()
+            self._lock = threading.Lock()
+
+        def span(self, name, category="pipeline", **args):
+            if not self.enabled:
+                return _NO_SPAN
+
+            return _Span(self, name, category, args)
+
+        def count(self, name, value=1):
+            if not self.enabled:
+                return
+
+            with self._lock:
+                self.counters[name] += value
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "C",
+                        "ts": (time.perf_counter() - self.origin) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": {name: self.counters[name]},
+                    }
+                )
+
+        def _append(self, event):
+            # Stages run in worker threads too, while the panel reads events
+            with self._lock:
+                self.events.append(event)
+
+        def clear(self):
+            with self._lock:
+                self.events.clear()
+                self.counters.clear()
+
+        def snapshot(self):
+            """
+            Copies of the events and counters, safe to go through while
+            other threads keep recording.
+            """
+            with self._lock:
+                return list(self.events), dict(self.counters)
+
+        def summary(self):
+            """
+            Calls, total, mean and max milliseconds of every stage, with
+            the rows and bytes it processed, slowest stages first.
+            """
+            events, _ = self.snapshot()
+            spans = [event for event in events if event["ph"] == "X"]
+
+            return (
+                pl.DataFrame(
+                    {
+                        "category": [span["cat"] for span in spans],
+                        "stage": [span["name"] for span in spans],
+                        "ms": [span["dur"] / 1e3 for span in spans],
+                        "rows": [span["args"].get("rows") for span in spans],
+                        "bytes": [span["args"].get("bytes") for span in spans],
+                    },
+                    schema={
+                        "category": pl.String,
+                        "stage": pl.String,
+                        "ms": pl.Float64,
+                        "rows": pl.Int64,
+                        "bytes": pl.Int64,
+                    },
+                )
+                .group_by("category", "stage")
+                .agg(
+                    calls=pl.len(),
+                    total_ms=pl.col("ms").sum(),
+                    mean_ms=pl.col("ms").mean(),
+                    max_ms=pl.col("ms").max(),
+                    rows=pl.col("rows").sum(),
+                    bytes=pl.col("bytes").sum(),
+                )
+                .sort("total_ms", descending=True)
+            )
+
+        def chrome_trace(self):
+            """
+            Events in the Chrome trace-event JSON format, which
+            chrome://tracing and Perfetto open.
+            """
+            events, _ = self.snapshot()
+            return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+
+    # Shared by every cell of the session
+    tracer = Tracer(enabled=os.environ.get(PERF_ENV, "") not in ("", "0"))
+    return (tracer,)
+
+
+@app.cell
+def formatting(pl):
+    # Formatting is done with polars expressions, so that whole columns
+    # are formatted at once instead of calling python on every value
+
+
+    def duration_expr(expr):
+        """
+        Format durations in seconds as HH:MM:SS.
+        """
+        secs = expr.cast(pl.Int64)
+
+        return pl.concat_str(
+            (secs // 3600).cast(pl.String).str.zfill(2),
+            (secs % 3600 // 60).cast(pl.String).str.zfill(2),
+            (secs % 60).cast(pl.String).str.zfill(2),
+            separator=":",
+        )
+
+
+    def pace_expr(expr, pad_minutes=True, separator=":"):
+        """
+        Format speeds in m/s as paces in min/km (MM:SS). A speed of
+        zero is formatted as 00:00.
+        """
+        # Stava returns speed as mt / s
+        # Let's convert it to min / km, in double precision
+        speed = expr.cast(pl.Float64)
+        min_per_km = pl.when(speed == 0).then(0.0).otherwise(1 / (speed * 0.06))
+
+        minutes = min_per_km.floor().cast(pl.Int64).cast(pl.String)
+        seconds = (min_per_km % 1 * 60).floor().cast(pl.Int64).cast(pl.String)
+
+        return pl.concat_str(
+            minutes.str.zfill(2) if pad_minutes else minutes,
+            seconds.str.zfill(2),
+            separator=separator,
+        )
+
+
+    return duration_expr, pace_expr
+
+
+@app.cell
+def _(
+    SIGNATURES_SCHEMA,
+    activities,
+    activity_tracks,
+    assign_routes,
+    load_mocked_activities,
+    mo,
+    pl,
+    route_index,
+    sync_routes,
+):
+    # === ROUTES ===
+
+    if load_mocked_activities:
+        # Nothing is stored for the mocked data
+        _routes, _signatures = assign_routes(
+            activity_tracks(activities), pl.DataFrame(schema=SIGNATURES_SCHEMA)
+        )
+    else:
+        # Only runs new since the last time are assigned a route
+        _routes, _signatures = sync_routes(activities)
+
+    route_runs = route_index(_routes, _signatures)
+
+    route_filter = mo.ui.dropdown(
+        options={label: route for route, (label, _) in route_runs.items()},
+        allow_select_none=True,
+        searchable=True,
+        label="Route",
+    )
+    return route_filter, route_runs
+
+
+@app.cell
+def _(route_filter, route_runs):
+    # Runs of the selected route, looked up in the index, None for all runs
+    route_ids = (
+        None if route_filter.value is None else route_runs[route_filter.value][1]
+    )
+    return (route_ids,)
+
+
+@app.cell
+def _(TimeIndex, rollups, whole_df):
+    # Built once per sync, the indexes make each date range change a
+    # couple of binary searches
+    activity_index = TimeIndex(whole_df, "start_date", descending=True)
+    day_index = TimeIndex(rollups["day"], "period")
+    return activity_index, day_index
+
+
+@app.cell
+def date_range_filter(
+    activity_index,
+    build_rollups,
+    day_index,
+    get_end_date,
+    get_start_date,
+    pl,
+    route_ids,
+    tracer,
+):
+    with tracer.span("date range filter") as _span:
+        # Add 23:59:59 to end date
+        # in order to make it "inclusive"
+
+        _end_of_day = get_end_date().replace(hour=23, minute=59, second=59)
+
+        if route_ids is None:
+            # We keep only running activities.
+            # This can easily be extended to other activity types
+            filtered_df = activity_index.slice("Run", get_start_date(), _end_of_day)
+
+            # Same range over the per day rollup, which the heatmap and stats use
+            filtered_days = day_index.slice("Run", get_start_date(), get_end_date())
+        else:
+            # Runs of a route (only runs have one) are looked up by id, and
+            # their few days rolled up again
+            filtered_df = activity_index.gather(route_ids).filter(
+                pl.col("start_date").is_between(get_start_date(), _end_of_day)
+            )
+            filtered_days = build_rollups(filtered_df)["day"]
+
+        _span.set(rows=filtered_df.height)
+    return filtered_days, filtered_df
+
+
+@app.cell
+def activity_frame(activities, pl):
+    whole_df = pl.DataFrame(activities)
+
+    # Add a km column since we'll need that often
+    whole_df = whole_df.with_columns(kms=pl.col("distance") / 1000)
+
+    # Keep activities partitioned by sport and newest first, so that
+    # date ranges can be sliced through the time index
+    whole_df = whole_df.sort(
+        "sport_type", "start_date", descending=[False, True], maintain_order=True
+    )
+    return (whole_df,)
+
+
+@app.cell
+def time_index(pl):
+    # === TIME INDEX ===
+
+
+    class TimeIndex:
+        """
+        Index over a frame sorted by sport type and then by time, so that
+        the activities of a sport within a date range are a slice of the
+        frame found by binary search, instead of a scan of every row.
+
+        Frames sorted by other columns first, e.g. athlete and sport type,
+        are indexed with `partition_by`: partitions are then tuples.
+        """
+
+        def __init__(
+            self, df, time_column, descending=False, partition_by="sport_type"
+        ):
+            self.df = df
+            self.descending = descending
+
+            # Partitions are contiguous: each run is a (offset, length) partition
+            runs = df.select(
+                partition=pl.struct(
+                    [partition_by] if isinstance(partition_by, str) else partition_by
+                ).rle()
+            ).unnest("partition")
+            values = runs["value"].struct.unnest().rows()
+            if isinstance(partition_by, str):
+                values = [value for (value,) in values]
+
+            offsets = runs["len"].cum_sum() - runs["len"]
+            self.partitions = {
+                value: (offset, length)
+                for value, offset, length in zip(values, offsets, runs["len"])
+            }
+
+            # search_sorted needs ascending keys, descending times are negated
+            self.dtype = df.schema[time_column]
+            keys = df[time_column].to_physical().cast(pl.Int64)
+            self.keys = -keys if descending else keys
+
+            self._id_rows = None
+
+        def _key(self, value):
+            key = pl.Series([value]).cast(self.dtype).to_physical().cast(pl.Int64)
+            return -key[0] if self.descending else key[0]
+
+        def slice(self, partition, start, end):
+            """
+            Zero-copy slice of the rows of `partition` (a sport, by default)
+            between `start` and `end`, both inclusive.
+            """
+            offset, length = self.partitions.get(partition, (0, 0))
+            keys = self.keys.slice(offset, length)
+
+            low, high = self._key(start), self._key(end)
+            if self.descending:
+                low, high = high, low
+
+            first = keys.search_sorted(low, side="left")
+            last = keys.search_sorted(high, side="right")
+
+            return self.df.slice(offset + first, max(last - first, 0))
+
+        def gather(self, ids):
+            """
+            Rows of the given activity ids, in frame order.
+            """
+            if self._id_rows is None:
+                self._id_rows = self.df.select(
+                    "id", row=pl.int_range(pl.len(), dtype=pl.UInt32)
+                ).sort("id")
+
+            positions = self._id_rows["id"].search_sorted(pl.Series(ids))
+            rows = self._id_rows["row"].gather(positions).sort()
+
+            return self.df[rows]
+    return (TimeIndex,)
+
+
+@app.cell
+def stream_storage(
+    collections,
+    json,
+    os,
+    pl,
+    strava_client,
+    sys,
+    tempfile,
+    threading,
+    tracer,
+):
+    # === STREAM STORAGE ===
+
+    # Streams are stored in Arrow IPC files, one row per sample and one
+    # record batch per activity, with a typed column for each stream.
+    # Files are uncompressed so that they can be memory mapped.
+    STREAM_SCHEMA = {
+        "time": pl.Int32,
+        "distance": pl.Float32,
+        "velocity_smooth": pl.Float32,
+        "heartrate": pl.Int16,
+        "latlng": pl.Array(pl.Float64, 2),
+    }
+
+
+    def stream_to_frame(activity_id, stream, keys=None):
+        """
+        Convert a StravaActivityStream into a frame with a column for each
+        stream. Requested keys missing from the stream are kept as null
+        columns, so that we remember Strava doesn't have them.
+        """
+        keys = set(keys or []) | {
+            key for key in STREAM_SCHEMA if getattr(stream, key) is not None
+        }
+
+        size = max(
+            (
+                getattr(stream, key).original_size
+                for key in keys
+                if getattr(stream, key) is not None
+            ),
+            default=0,
+        )
+
+        return pl.DataFrame(
+            {
+                "activity_id": pl.repeat(activity_id, size, dtype=pl.Int64, eager=True),
+                **{
+                    key: pl.Series(
+                        key,
+                        getattr(stream, key).data
+                        if getattr(stream, key) is not None
+                        else [None] * size,
+                        dtype=dtype,
+                        strict=False,
+                    )
+                    for key, dtype in STREAM_SCHEMA.items()
+                    if key in keys
+                },
+            }
+        )
+
+
+    def write_streams(path, frames):
+        # Chunks are not merged, so that each activity is a record batch
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # A file of its own, so that concurrent writes never mix
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=path.stem, suffix=".tmp", delete=False
+        ) as tmp:
+            try:
+                pl.concat(frames, how="diagonal", rechunk=False).write_ipc(
+                    tmp, compression="uncompressed"
+                )
+            except BaseException:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise
+
+        os.replace(tmp.name, path)
+
+
+    class MappedStreams:
+        """
+        Streams file mapped in memory: activities and keys are sliced
+        out of it without copying nor parsing anything.
+        """
+
+        def __init__(self, path):
+            self.frame = pl.read_ipc(
+                path,
+                # Memory mapping is not available in WASM
+                memory_map="pyodide" not in sys.modules,
+                rechunk=False,
+            )
+
+            # Samples of an activity are contiguous: index where they start
+            runs = self.frame.select(pl.col("activity_id").rle()).unnest(
+                "activity_id"
+            )
+            offsets = runs["len"].cum_sum() - runs["len"]
+
+            self.index = dict(
+                zip(
+                    runs["value"].to_list(),
+                    zip(offsets.to_list(), runs["len"].to_list()),
+                )
+            )
+
+        def __contains__(self, activity_id):
+            return activity_id in self.index
+
+        def has_keys(self, keys):
+            return set(keys or []) <= set(self.frame.columns)
+
+        def get(self, activity_id, keys=None):
+            if activity_id not in self.index:
+                return None
+
+            offset, length = self.index[activity_id]
+            stream = self.frame.slice(offset, length)
+
+            if keys:
+                stream = stream.select(keys)
+
+            return stream
+
+
+    class StreamCache:
+        """
+        Streams of the latest activities used, kept in memory up to
+        `max_bytes` and evicted least recently used first. Each activity
+        has a single entry holding all of its keys, so that asking for
+        other keys only misses on the ones it doesn't have. Hits, misses,
+        evictions and bytes are counted in `stats`, and by the tracer.
+        """
+
+        def __init__(self, max_bytes):
+            self.max_bytes = max_bytes
+            self.size = 0
+            self.entries = collections.OrderedDict()
+            self.stats = collections.Counter()
+            self.lock = threading.Lock()
+
+        def _count(self, name, value=1):
+            self.stats[name] += value
+            tracer.count(f"stream memory {name}", value)
+
+        def get(self, activity_id, keys=None):
+            with self.lock:
+                entry = self.entries.get(activity_id)
+
+                if entry is None or not set(keys or []) <= set(entry[0].columns):
+                    self._count("misses")
+                    return None
+
+                self._count("hits")
+                self.entries.move_to_end(activity_id)
+
+            return entry[0].select(keys) if keys else entry[0]
+
+        def put(self, activity_id, stream):
+            size = stream.estimated_size()
+
+            with self.lock:
+                if activity_id in self.entries:
+                    self._remove(activity_id)
+
+                # Streams bigger than the whole cache are not kept at all
+                if size > self.max_bytes:
+                    return
+
+                self.entries[activity_id] = (stream, size)
+                self.size += size
+                self._count("bytes", size)
+
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+                    self._count("evictions")
+
+        def _remove(self, activity_id):
+            _, size = self.entries.pop(activity_id)
+            self.size -= size
+            self._count("bytes", -size)
+
+
+    def convert_json_streams(json_path, ipc_path):
+        """
+        Convert the legacy json streams file, a list of single key dicts
+        from the activity id to its stream serialized as json.
+        """
+        frames = [
+            stream_to_frame(
+                int(activity_id),
+                strava_client.models.api.StravaActivityStream.model_validate_json(
+                    raw_stream
+                ),
+            )
+            for streams in json.loads(json_path.read_text())
+            for activity_id, raw_stream in streams.items()
+        ]
+
+        write_streams(ipc_path, frames)
+    return MappedStreams, StreamCache, stream_to_frame, write_streams
+
+
+@app.cell
+def _(
+    MappedStreams,
+    STORE_DIR,
+    StreamCache,
+    client,
+    concurrent,
+    download_file,
+    get_auth_headers,
+    make_executor,
+    mo,
+    pl,
+    rate_limited_get,
+    rate_limiter,
+    strava_client,
+    stream_to_frame,
+    sys,
+    threading,
+    tracer,
+    write_streams,
+):
+    # === ACTIVITY STREAM FUNCTION ===
+
+    # Streams fetched from the API are kept on disk, a file per activity
+    STREAMS_DIR = STORE_DIR / "streams"
+
+    # Bytes of streams kept in memory. In WASM files are not memory mapped
+    # and the whole tab shares a few GB, so fewer streams are kept
+    STREAM_CACHE_BYTES = (32 if "pyodide" in sys.modules else 256) * 2**20
+
+    stream_cache = StreamCache(STREAM_CACHE_BYTES)
+
+    # Streams being fetched, by activity and keys
+    _stream_futures = {}
+    _stream_futures_lock = threading.Lock()
+
+    # Fetches of the same activity, e.g. for different keys, take turns so
+    # that each one merges its keys with those the previous one stored.
+    # Activities share a few locks rather than having one each
+    _stream_locks = [threading.Lock() for _ in range(64)]
+
+    _stream_executor = make_executor()
+
+
+    def _request_stream(activity_id, keys):
+        tracer.count("stream disk misses")
+
+        response = rate_limited_get(
+            rate_limiter,
+            f"{client.BASE_SERVER_URL}/activities/{activity_id}/streams",
+            headers=get_auth_headers(),
+            params={"keys": keys, "key_by_type": True},
+        )
+
+        if response.status_code != 200:
+            raise ValueError(
+                f"Failed to retrieve activity streams. Status code: {response.status_code}."
+                f" Response: {response.text}"
+            )
+
+        with tracer.span("parse stream") as span:
+            stream = stream_to_frame(
+                activity_id,
+                strava_client.models.api.StravaActivityStream.model_validate(
+                    response.json()
+                ),
+                keys=keys,
+            )
+            span.set(rows=stream.height)
+
+        return stream
+
+
+    def _fetch_stored_stream(activity_id, keys):
+        path = STREAMS_DIR / f"{activity_id}.arrow"
+        stored = None
+
+        if path.exists():
+            # Without samples the file still tells the keys Strava doesn't have
+            mapped = MappedStreams(path)
+            stored = mapped.get(activity_id)
+            stored = mapped.frame.clear() if stored is None else stored
+
+        if stored is not None and set(keys or []) <= set(stored.columns):
+            tracer.count("stream disk hits")
+
+        else:
+            stored_keys = [
+                key
+                for key in (stored.columns if stored is not None else [])
+                if key != "activity_id"
+            ]
+
+            # Only the keys we don't have are fetched, then merged with the others
+            stream = _request_stream(
+                activity_id, sorted(set(keys or []) - set(stored_keys))
+            )
+
+            if stored is not None and stream.height == stored.height:
+                stream = pl.concat(
+                    [stored, stream.select(pl.exclude(stored.columns))],
+                    how="horizontal",
+                )
+            elif stored is not None:
+                # Samples don't line up, e.g. the activity was cropped since
+                stream = _request_stream(
+                    activity_id, sorted(set(keys or []) | set(stored_keys))
+                )
+
+            write_streams(path, [stream])
+            stored = MappedStreams(path).get(activity_id)
+
+        # Strava has no samples for the activity
+        if stored is None or stored.is_empty():
+            return None
+
+        stream_cache.put(activity_id, stored)
+
+        return stored.select(keys) if keys else stored
+
+
+    def fetch_activity_stream(activity_id: str, keys: list[str] | None = None):
+        stream = stream_cache.get(activity_id, keys)
+        if stream is not None:
+            return stream
+
+        with _stream_locks[hash(activity_id) % len(_stream_locks)]:
+            return _fetch_stored_stream(activity_id, keys)
+
+
+    def _forget_future(cache_key):
+        with _stream_futures_lock:
+            _stream_futures.pop(cache_key, None)
+
+
+    def prefetch_activity_streams(activity_ids, keys: list[str] | None = None):
+        """
+        Start fetching the streams of the given activities in the
+        background, skipping those being fetched. Streams already fetched
+        are then read from memory or from disk.
+        """
+        futures = {}
+
+        with _stream_futures_lock:
+            for activity_id in activity_ids:
+                cache_key = (activity_id, tuple(keys or []))
+
+                if cache_key in _stream_futures:
+                    # Being fetched already, e.g. by the prefetch
+                    tracer.count("stream prefetch hits")
+                else:
+                    _stream_futures[cache_key] = _stream_executor.submit(
+                        fetch_activity_stream, *cache_key
+                    )
+
+                futures[activity_id] = _stream_futures[cache_key]
+
+        # Fetched streams are only kept by the stream cache, within its
+        # bounds, and failures are retried next time
+        for activity_id, future in futures.items():
+            future.add_done_callback(
+                lambda _, cache_key=(activity_id, tuple(keys or [])): _forget_future(
+                    cache_key
+                )
+            )
+
+        return futures
+
+
+    def fetch_activity_streams(
+        activity_ids, keys: list[str] | None = None, skip_failed=False
+    ):
+        """
+        Fetch the streams of the given activities concurrently, yielding
+        `(activity_id, stream)` pairs as soon as each one is available.
+        The stream is None if Strava has no samples for the activity, or if
+        it could not be retrieved, unless `skip_failed` leaves those out.
+        """
+        futures = {
+            future: activity_id
+            for activity_id, future in prefetch_activity_streams(
+                activity_ids, keys
+            ).items()
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            activity_id = futures[future]
+
+            try:
+                yield activity_id, future.result()
+
+            except Exception:
+                if not skip_failed:
+                    yield activity_id, None
+
+
+    @mo.cache
+    def fetch_mocked_activity_stream():
+        url = "https://raw.githubusercontent.com/GiovanniGiacometti/strava-marimo-analyzer/main/mocked_data/mocked_streams.arrow"
+
+        # The file is quite big and the download often fails: it is resumed
+        # where it stopped, and kept across sessions while it is unchanged
+        return MappedStreams(download_file(url, STORE_DIR / "mocked_streams.arrow"))
+
+
+    def get_mocked_activity_stream(activity_id: int, keys: list[str] | None = None):
+        # Streams are sliced out of the mapped file, nothing is parsed
+        return fetch_mocked_activity_stream().get(activity_id, keys)
+    return (
+        fetch_activity_streams,
+        get_mocked_activity_stream,
+        prefetch_activity_streams,
+        stream_cache,
+    )
+
+
+@app.cell
+def _(requests, time, tracer):
+    # === DOWNLOADS ===
+
+    # Large files are written to disk as they arrive, in chunks of this size
+    CHUNK_SIZE = 1 << 16
+
+
+    def download_file(url, path, n_retries=5, chunk_size=CHUNK_SIZE):
+        """
+        Download `url` to `path` and return the path.
+
+        Chunks are appended to a `.part` file next to `path`, so that a
+        failed download resumes where it stopped with an HTTP Range
+        request, even from another session. The ETag of the file is kept
+        too: a local copy that is still up to date is not downloaded again.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(path.name + ".part")
+
+        # ETags of the local copy and of the partial download, which only
+        # replaces the former once complete
+        etag_path = path.with_name(path.name + ".etag")
+        part_etag_path = path.with_name(path.name + ".part.etag")
+
+        n_failures = 0
+
+        while True:
+            etag = etag_path.read_text() if etag_path.exists() else None
+            part_etag = part_etag_path.read_text() if part_etag_path.exists() else None
+            offset = part_path.stat().st_size if part_path.exists() else 0
+
+            # Ask for the raw bytes, so that sizes can be checked
+            headers = {"Accept-Encoding": "identity"}
+
+            if offset and part_etag:
+                # The server sends the whole file again if it changed
+                headers.update({"Range": f"bytes={offset}-", "If-Range": part_etag})
+            elif path.exists() and etag:
+                headers["If-None-Match"] = etag
+
+            span = tracer.span("download", "network", url=url)
+
+            try:
+                with span, requests.get(url, headers=headers, stream=True) as response:
+                    span.set(status=response.status_code, offset=offset)
+
+                    if response.status_code == 304:
+                        tracer.count("download not modified")
+                        return path
+
+                    if response.status_code == 416:
+                        # The partial download is not a prefix of the file
+                        part_path.unlink(missing_ok=True)
+                        continue
+
+                    response.raise_for_status()
+
+                    if response.status_code == 206:
+                        tracer.count("download resumed")
+
+                        # e.g. "bytes 1024-4095/4096"
+                        content_range = response.headers["Content-Range"]
+                        first = int(content_range.split()[1].split("-")[0])
+                        if first != offset:
+                            raise IOError(f"Unexpected range {content_range}")
+
+                        total = int(content_range.split("/")[1])
+                        mode = "ab"
+                    else:
+                        # Start over, the file is new or changed
+                        offset = 0
+                        total = response.headers.get("Content-Length")
+                        total = int(total) if total is not None else None
+                        mode = "wb"
+
+                        if new_etag := response.headers.get("ETag"):
+                            part_etag_path.write_text(new_etag)
+                        else:
+                            part_etag_path.unlink(missing_ok=True)
+
+                    encoding = response.headers.get("Content-Encoding", "identity")
+                    if encoding != "identity":
+                        # Sizes refer to the encoded bytes, which get decoded
+                        total = None
+
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+
+                    span.set(bytes=part_path.stat().st_size - offset)
+
+                size = part_path.stat().st_size
+
+                if total is not None and size != total:
+                    raise IOError(f"Downloaded {size} bytes out of {total}")
+
+                part_path.replace(path)
+
+                if part_etag_path.exists():
+                    part_etag_path.replace(etag_path)
+                else:
+                    etag_path.unlink(missing_ok=True)
+
+                return path
+
+            except Exception:
+                n_failures += 1
+                tracer.count("download retries")
+
+                if n_failures > n_retries:
+                    raise
+                else:
+                    time.sleep(2**n_failures)
+    return (download_file,)
+
+
+@app.cell
+def api_limits(concurrent, requests, sys, threading, time, tracer):
+    # === API RATE LIMITS ===
+
+    # Number of requests that can be in flight at the same time
+    MAX_WORKERS = 8
+
+    # Pages that can fail before giving up on a collection
+    MAX_FAILURES = 3
+
+
+    class StravaRateLimiter:
+        """
+        Token bucket over Strava's 15 minutes and daily quotas.
+
+        The bucket is refilled from the usage reported in the response
+        headers, so requests made by other sessions of the same
+        application are taken into account as well.
+        """
+
+        # Strava quotas reset every quarter of an hour and at midnight UTC
+        WINDOWS = (15 * 60, 24 * 60 * 60)
+
+        def __init__(self, reserve=MAX_WORKERS):
+            # Tokens kept aside, so that a burst of requests never
+            # overshoots the quota
+            self.reserve = reserve
+            self.limits = None
+            self.usage = None
+            self.in_flight = 0
+            self._starts = None
+            self._condition = threading.Condition()
+
+        @property
+        def headroom(self):
+            with self._condition:
+                self._roll_windows()
+                if self.limits is None:
+                    return None
+                return {
+                    "15min": self.limits[0] - self.usage[0],
+                    "daily": self.limits[1] - self.usage[1],
+                }
+
+        def acquire(self):
+            with self._condition:
+                while (available := self._available()) <= 0:
+                    self._condition.wait(self._seconds_to_refill(available))
+                self.in_flight += 1
+
+        def release(self, headers, throttled=False):
+            with self._condition:
+                self.in_flight -= 1
+                self._update(headers)
+
+                if throttled and self.limits is not None:
+                    # Quota exhausted, wait for the next window
+                    self.usage = (max(self.usage[0], self.limits[0]), self.usage[1])
+
+                self._condition.notify_all()
+
+        def _update(self, headers):
+            limits, usage = None, None
+
+            # Read requests have their own, stricter, quotas:
+            # the most constraining ones are kept
+            for prefix in ("X-RateLimit", "X-ReadRateLimit"):
+                limit_header = headers.get(f"{prefix}-Limit")
+                usage_header = headers.get(f"{prefix}-Usage")
+
+                if not limit_header or not usage_header:
+                    continue
+
+                _limits = tuple(map(int, limit_header.split(",")))
+                _usage = tuple(map(int, usage_header.split(",")))
+
+                if limits is None:
+                    limits, usage = _limits, _usage
+                else:
+                    # Keep, for each window, the one with less headroom
+                    limits, usage = zip(
+                        *(
+                            min(pair, _pair, key=lambda p: p[0] - p[1])
+                            for pair, _pair in zip(
+                                zip(limits, usage), zip(_limits, _usage)
+                            )
+                        )
+                    )
+
+            if limits is None:
+                return
+
+            self.limits, self.usage = tuple(limits), tuple(usage)
+            self._starts = self._window_starts()
+
+        def _window_starts(self):
+            now = time.time()
+            return tuple(now - now % window for window in self.WINDOWS)
+
+        def _roll_windows(self):
+            if self._starts is None:
+                return
+
+            starts = self._window_starts()
+            self.usage = tuple(
+                0 if start != previous else used
+                for start, previous, used in zip(starts, self._starts, self.usage)
+            )
+            self._starts = starts
+
+        def _available(self):
+            # Until the first response, a single request is let through
+            # to discover the actual usage
+            if self.limits is None:
+                return 1 - self.in_flight
+
+            self._roll_windows()
+            return (
+                min(limit - used for limit, used in zip(self.limits, self.usage))
+                - self.in_flight
+                - self.reserve
+            )
+
+        def _seconds_to_refill(self, available):
+            # Waiting on requests in flight: they will notify us
+            if self.limits is None or available + self.in_flight > self.reserve:
+                return None
+
+            now = time.time()
+            # Wait for the daily window if that one is exhausted
+            window = (
+                self.WINDOWS[1]
+                if self.limits[1] - self.usage[1] <= self.reserve
+                else self.WINDOWS[0]
+            )
+            return window - now % window + 1
+
+
+    def rate_limited_get(limiter, url, n_retries=3, **kwargs):
+        attempt = 0
+
+        while True:
+            with tracer.span("rate limit wait", "network"):
+                limiter.acquire()
+
+            try:
+                with tracer.span("GET", "network", url=url) as span:
+                    response = requests.get(url, **kwargs)
+                    span.set(
+                        status=response.status_code, bytes=len(response.content)
+                    )
+            except Exception:
+                limiter.release({})
+                tracer.count("http retries")
+
+                attempt += 1
+                if attempt > n_retries:
+                    raise
+
+                time.sleep(2**attempt)
+                continue
+
+            # Too many requests: the limiter makes us wait for the next
+            # window, if the headers tell it the quotas
+            if response.status_code == 429:
+                limiter.release(response.headers, throttled=True)
+                tracer.count("http throttled")
+
+                attempt += 1
+                if attempt > n_retries:
+                    return response
+
+                # Otherwise we back off, as long as the server asks if it does
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    time.sleep(int(retry_after))
+                elif limiter.limits is None:
+                    time.sleep(2**attempt)
+                continue
+
+            limiter.release(response.headers)
+
+            if response.status_code >= 500 and attempt < n_retries:
+                tracer.count("http retries")
+                attempt += 1
+                time.sleep(2**attempt)
+                continue
+
+            return response
+
+
+    class _SequentialExecutor(concurrent.futures.Executor):
+        # Threads are not available in WASM: run each task when submitted
+        def submit(self, fn, /, *args, **kwargs):
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+
+    def make_executor(max_workers=MAX_WORKERS):
+        if "pyodide" in sys.modules:
+            return _SequentialExecutor()
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+
+    def _flatten(pages):
+        return [item for items in pages for item in items]
+
+
+    def fetch_pages(
+        fetch_page, per_page, max_workers=MAX_WORKERS, on_page=None, merge=_flatten
+    ):
+        """
+        Fetch pages 1, 2, ... concurrently, stopping at the first page
+        holding less than `per_page` items.
+
+        `fetch_page(page)` returns the page items, or None if the page
+        could not be retrieved. Returns the items in page order, merged
+        by `merge` (a list by default), whether every page was retrieved,
+        and the throughput.
+        """
+        results = {}
+        failures = 0
+        last_page = None
+
+        # Start with a single page and double the pages in flight after each
+        # full one, so that short histories don't request useless pages
+        window = 1
+        next_page = 1
+        started = time.perf_counter()
+
+        with make_executor(max_workers) as executor:
+            pending = {}
+
+            while True:
+                # Keep the pool busy until the end of the collection is known
+                while last_page is None and len(pending) < window:
+                    pending[executor.submit(fetch_page, next_page)] = next_page
+                    next_page += 1
+
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+
+                for future in done:
+                    page = pending.pop(future)
+
+                    try:
+                        items = future.result()
+                    except Exception:
+                        items = None
+
+                    results[page] = items
+
+                    if items is None:
+                        failures += 1
+                    elif len(items) == per_page:
+                        window = min(window * 2, max_workers)
+
+                    # A short page is the last one. After too many failures
+                    # we stop as well, rather than requesting pages forever
+                    if (items is not None and len(items) < per_page) or (
+                        failures >= MAX_FAILURES
+                    ):
+                        last_page = page if last_page is None else min(last_page, page)
+
+                    if on_page is not None:
+                        elapsed = time.perf_counter() - started
+                        on_page(len(results), len(results) / elapsed)
+
+        elapsed = time.perf_counter() - started
+
+        # Pages requested after the last one are necessarily empty
+        pages = [results[page] for page in sorted(results) if page <= last_page]
+
+        return (
+            merge([items for items in pages if items is not None]),
+            all(items is not None for items in pages),
+            {
+                "pages": len(results),
+                "seconds": elapsed,
+                "pages_per_s": len(results) / elapsed if elapsed else 0.0,
+            },
+        )
+
+
+    # Shared by every request of the session, quotas are per application anyway
+    rate_limiter = StravaRateLimiter()
+    return fetch_pages, make_executor, rate_limited_get, rate_limiter
+
+
+@app.cell
+def activity_store(datetime, json, pathlib, pl, tracer):
+    # === ACTIVITY STORE ===
+
+    # Activities are persisted on disk so that reopening the dashboard
+    # only downloads what changed since the last sync
+    STORE_DIR = pathlib.Path(".strava_store")
+
+    # Activities started less than this before the watermark are always
+    # refetched, so that recent edits and deletions are reconciled too
+    RECONCILE_WINDOW = datetime.timedelta(days=7)
+
+
+    def load_activity_store(store_dir=STORE_DIR):
+        """
+        Stored activities and their watermark, None if some activities may
+        be missing from the store, e.g. pages of the first sync failed.
+        """
+        activities_path = store_dir / "activities.parquet"
+        state_path = store_dir / "sync_state.json"
+
+        if not activities_path.exists() or not state_path.exists():
+            return None, None
+
+        state = json.loads(state_path.read_text())
+
+        return (
+            pl.read_parquet(activities_path),
+            None
+            if state.get("watermark") is None
+            else datetime.datetime.fromisoformat(state["watermark"]),
+        )
+
+
+    def save_activity_store(
+        activities, store_dir=STORE_DIR, complete=True, watermark=None
+    ):
+        """
+        Store the activities, every one started before the watermark being
+        among them. After a complete sync it is the latest start date,
+        otherwise the given `watermark`, the one of the last complete sync,
+        so that the pages that failed are fetched again next time.
+        """
+        store_dir.mkdir(parents=True, exist_ok=True)
+
+        activities_path = store_dir / "activities.parquet"
+
+        # Write to a temporary file first, so that an interrupted sync
+        # never leaves a corrupted store behind
+        tmp_path = activities_path.with_suffix(".parquet.tmp")
+        activities.write_parquet(tmp_path)
+        tmp_path.replace(activities_path)
+
+        if complete:
+            watermark = activities["start_date"].max() if activities.height else None
+
+        (store_dir / "sync_state.json").write_text(
+            json.dumps(
+                {
+                    "watermark": watermark.isoformat() if watermark else None,
+                    "complete": complete,
+                    "synced_at": datetime.datetime.now().isoformat(),
+                }
+            )
+        )
+
+
+    def sync_activities(
+        fetch_activities,
+        store_dir=STORE_DIR,
+        reconcile_window=RECONCILE_WINDOW,
+        schema=None,
+    ):
+        """
+        Bring the local store up to date and return all activities.
+
+        `fetch_activities(after)` must return the activities started after
+        the given datetime (all of them if None) and whether every page
+        was retrieved successfully. Stores missing some columns of `schema`,
+        written before they were added, are synced again from scratch.
+        """
+        with tracer.span("load store") as span:
+            stored, watermark = load_activity_store(store_dir)
+            span.set(rows=0 if stored is None else stored.height)
+
+        if stored is not None and schema is not None:
+            if not set(schema) <= set(stored.columns):
+                stored, watermark = None, None
+
+        if stored is None:
+            watermark = None
+
+        # Without a watermark, e.g. when pages of the first sync failed,
+        # everything is fetched again
+        window_start = None if watermark is None else watermark - reconcile_window
+
+        # Strava start dates are in UTC, polars stores them as naive datetimes
+        activities, complete = fetch_activities(
+            after=None
+            if window_start is None
+            else window_start.replace(tzinfo=datetime.timezone.utc)
+        )
+
+        if stored is None:
+            if len(activities) == 0 and not complete:
+                raise ValueError("Failed to retrieve activities, nothing was stored")
+
+            synced = pl.DataFrame(activities)
+
+        else:
+            fetched = pl.DataFrame(activities)
+
+            if complete:
+                # The whole window was refetched: whatever is missing
+                # from the response has been deleted in the meantime
+                kept = (
+                    stored.clear()
+                    if window_start is None
+                    else stored.filter(pl.col("start_date") < window_start)
+                )
+            elif fetched.height:
+                # Some pages failed, we can only update what we got back
+                kept = stored.filter(~pl.col("id").is_in(fetched["id"]))
+            else:
+                kept = stored
+
+            synced = (
+                pl.concat([kept, fetched], how="diagonal_relaxed")
+                if fetched.height
+                else kept
+            )
+
+        if synced.height:
+            # Newest first, as returned by the API
+            synced = synced.unique("id", keep="last").sort(
+                "start_date", descending=True
+            )
+
+        # After a partial sync the watermark stays where it was, so that
+        # the range that failed is fetched again next time
+        with tracer.span("save store", rows=synced.height):
+            save_activity_store(synced, store_dir, complete, watermark)
+
+        # Only activities started after the window start may have changed,
+        # derived data can be updated from there (everything if None)
+        return synced, None if stored is None else window_start
+    return STORE_DIR, load_activity_store, save_activity_store, sync_activities
+
+
+@app.cell
+def rollup_functions(STORE_DIR, duration_expr, pace_expr, pl, tracer):
+    # === ROLLUPS ===
+
+    # Activities are pre-aggregated per sport at several granularities,
+    # so that the heatmap and stats slice small tables instead of
+    # regrouping every activity whenever the date range changes
+    ROLLUP_PERIODS = {"day": "1d", "week": "1w", "month": "1mo", "year": "1y"}
+
+    # Heart rates (bpm) at rest and at maximum effort, to weight training
+    # impulses: set them to your own for meaningful training loads
+    REST_HEARTRATE = 60
+    MAX_HEARTRATE = 190
+
+
+    def trimp_expr():
+        """
+        Banister's training impulse of each activity, from its moving time
+        and average heart rate: null without a heart rate.
+        """
+        reserve = (
+            (pl.col("average_heartrate") - REST_HEARTRATE)
+            / (MAX_HEARTRATE - REST_HEARTRATE)
+        ).clip(0, 1)
+
+        return pl.col("moving_time") / 60 * reserve * 0.64 * (1.92 * reserve).exp()
+
+
+    def _rollup(activities, every):
+        if "average_heartrate" not in activities.columns:
+            # Activities stored before heart rates were
+            activities = activities.with_columns(
+                average_heartrate=pl.lit(None, dtype=pl.Float64)
+            )
+
+        rollup = (
+            activities.with_columns(
+                period=pl.col("start_date").dt.truncate(every).dt.date()
+            )
+            .group_by("sport_type", "period")
+            .agg(
+                count=pl.len(),
+                kms=(pl.col("distance") / 1000).sum(),
+                moving_time=pl.col("moving_time").sum(),
+                elapsed_time=pl.col("elapsed_time").sum(),
+                # Summed so that averages can be derived from any slice
+                average_speed_sum=pl.col("average_speed").sum(),
+                trimp=trimp_expr().sum(),
+                start_date=pl.col("start_date").min(),
+                id=pl.col("id"),
+            )
+            .sort("sport_type", "period")
+        )
+
+        if every == ROLLUP_PERIODS["day"]:
+            # Heatmap coordinates
+            rollup = rollup.with_columns(
+                year=pl.col("period").dt.iso_year(),
+                week=pl.col("period").dt.week(),
+                day=pl.col("period").dt.weekday(),
+            )
+
+        return rollup
+
+
+    def build_rollups(activities):
+        with tracer.span("build rollups", rows=activities.height):
+            return {
+                name: _rollup(activities, every)
+                for name, every in ROLLUP_PERIODS.items()
+            }
+
+
+    def update_rollups(rollups, activities, since):
+        """
+        Re-aggregate only the periods that contain activities started
+        after `since`, older periods are kept as they are.
+        """
+        updated = {}
+
+        for name, every in ROLLUP_PERIODS.items():
+            period_start = (
+                pl.select(pl.lit(since).dt.truncate(every).dt.date()).item()
+            )
+
+            updated[name] = pl.concat(
+                [
+                    rollups[name].filter(pl.col("period") < period_start),
+                    _rollup(
+                        activities.filter(pl.col("start_date") >= period_start),
+                        every,
+                    ),
+                ],
+                how="vertical_relaxed",
+            ).sort("sport_type", "period")
+
+        return updated
+
+
+    def _is_current(rollup, every):
+        # Rollups stored before a column was added are built again
+        empty = pl.DataFrame(
+            schema={
+                "id": pl.Int64,
+                "sport_type": pl.String,
+                "start_date": pl.Datetime("us"),
+                "distance": pl.Float64,
+                "moving_time": pl.Int64,
+                "elapsed_time": pl.Int64,
+                "average_speed": pl.Float64,
+            }
+        )
+        return rollup.columns == _rollup(empty, every).columns
+
+
+    def load_rollups(store_dir=STORE_DIR):
+        """
+        Rollups stored by `sync_rollups`, None if any of them is missing
+        or out of date.
+        """
+        paths = {
+            name: store_dir / "rollups" / f"{name}.parquet" for name in ROLLUP_PERIODS
+        }
+
+        if not all(path.exists() for path in paths.values()):
+            return None
+
+        rollups = {name: pl.read_parquet(path) for name, path in paths.items()}
+
+        if not all(
+            _is_current(rollups[name], every) for name, every in ROLLUP_PERIODS.items()
+        ):
+            return None
+
+        return rollups
+
+
+    def sync_rollups(activities, since, store_dir=STORE_DIR):
+        """
+        Bring the stored rollups up to date with `activities`, see
+        `sync_activities` for the meaning of `since`.
+        """
+        rollups_dir = store_dir / "rollups"
+        paths = {name: rollups_dir / f"{name}.parquet" for name in ROLLUP_PERIODS}
+
+        stored = load_rollups(store_dir) if since is not None else None
+
+        if stored is not None:
+            with tracer.span("update rollups", rows=activities.height):
+                rollups = update_rollups(stored, activities, since)
+        else:
+            rollups = build_rollups(activities)
+
+        rollups_dir.mkdir(parents=True, exist_ok=True)
+
+        for name, path in paths.items():
+            tmp_path = path.with_suffix(".parquet.tmp")
+            rollups[name].write_parquet(tmp_path)
+            tmp_path.replace(path)
+
+        return rollups
+
+
+    def summarize_rollup(rollup):
+        """
+        Compute the stat cards values from a slice of any rollup.
+        """
+        n_activities = rollup["count"].sum()
+
+        if n_activities == 0:
+            return {
+                "count": 0,
+                "kms": 0.0,
+                "average_kms": 0.0,
+                "average_duration": "00:00:00",
+                "average_speed": 0.0,
+            }
+
+        return rollup.select(
+            count=pl.col("count").sum(),
+            kms=pl.col("kms").sum(),
+            average_kms=pl.col("kms").sum() / n_activities,
+            average_duration=duration_expr(pl.col("elapsed_time").sum() / n_activities),
+            average_speed=pace_expr(
+                pl.col("average_speed_sum").sum() / n_activities, pad_minutes=False
+            ),
+        ).row(0, named=True)
+    return build_rollups, load_rollups, summarize_rollup, sync_rollups
+
+
+@app.cell
+def training_load(STORE_DIR, datetime, pl, tracer):
+    # === TRAINING LOAD ===
+
+    # Daily load of each metric, from the per day rollup
+    LOAD_METRICS = {
+        "distance": pl.col("kms"),
+        "time": pl.col("moving_time") / 3600,
+        "trimp": pl.col("trimp"),
+    }
+
+    # Loads are summed over these sports, as in the rest of the dashboard
+    LOAD_SPORTS = ["Run"]
+
+    # Time constants (days) of the fatigue (acute) and fitness (chronic) loads
+    ATL_DAYS = 7
+    CTL_DAYS = 42
+
+
+    def _daily_loads(day_rollup, start, end):
+        """
+        Load of each metric on every day from `start` to `end`, both
+        included, zero on days without activities.
+        """
+        days = pl.DataFrame({"period": pl.date_range(start, end, "1d", eager=True)})
+
+        loads = (
+            day_rollup.filter(
+                pl.col("sport_type").is_in(LOAD_SPORTS),
+                pl.col("period").is_between(start, end),
+            )
+            .group_by("period")
+            .agg(**{metric: expr.sum() for metric, expr in LOAD_METRICS.items()})
+        )
+
+        return (
+            days.join(loads, on="period", how="left")
+            .fill_null(0.0)
+            .unpivot(index="period", variable_name="metric", value_name="load")
+        )
+
+
+    def _exponential_loads(loads, seed):
+        """
+        Acute and chronic loads of `loads`, carried on from the values of
+        `seed` on the day before they start.
+
+        With `adjust=False`, `ewm_mean` starts from its first value: the
+        seed is prepended as that value, and dropped once the series is
+        computed.
+        """
+        first_day = loads["period"].min() - datetime.timedelta(days=1)
+
+        return (
+            pl.concat(
+                [
+                    seed.select(
+                        period=pl.lit(first_day),
+                        metric="metric",
+                        load=pl.lit(None, dtype=pl.Float64),
+                        atl_input="atl",
+                        ctl_input="ctl",
                     ),
+                    loads.with_columns(atl_input="load", ctl_input="load"),
+                ]
+            )
+            .sort("metric", "period")
+            .with_columns(
+                atl=pl.col("atl_input")
+                .ewm_mean(alpha=1 / ATL_DAYS, adjust=False)
+                .over("metric"),
+                ctl=pl.col("ctl_input")
+                .ewm_mean(alpha=1 / CTL_DAYS, adjust=False)
+                .over("metric"),
+            )
+            # Form going into the day, from the loads of the day before
+            .with_columns(tsb=(pl.col("ctl") - pl.col("atl")).shift(1).over("metric"))
+            .filter(pl.col("period") > first_day)
+            .select("metric", "period", "load", "atl", "ctl", "tsb")
+        )
+
+
+    def build_training_load(day_rollup, end=None):
+        """
+        Fatigue (ATL), fitness (CTL) and form (TSB) of each metric on every
+        day from the first activity to `end` (today by default), sorted by
+        metric and day.
+        """
+        end = end or datetime.date.today()
+        runs = day_rollup.filter(pl.col("sport_type").is_in(LOAD_SPORTS))
+
+        if runs.height == 0:
+            return pl.DataFrame(
+                schema={
+                    "metric": pl.String,
+                    "period": pl.Date,
+                    "load": pl.Float64,
+                    "atl": pl.Float64,
+                    "ctl": pl.Float64,
+                    "tsb": pl.Float64,
+                }
+            )
+
+        with tracer.span("build training load", rows=runs.height):
+            return _exponential_loads(
+                _daily_loads(day_rollup, runs["period"].min(), end),
+                # Nothing before the first activity
+                pl.DataFrame(
+                    {"metric": list(LOAD_METRICS), "atl": 0.0, "ctl": 0.0}
+                ),
+            )
+
+
+    def update_training_load(training_load, day_rollup, since, end=None):
+        """
+        Resume the training load from its stored state: only days from
+        `since` on, or from the day after the last stored one, are
+        computed again.
+        """
+        end = end or datetime.date.today()
+        last_day = training_load["period"].max()
+
+        start = min(since.date(), last_day + datetime.timedelta(days=1))
+        seed = training_load.filter(
+            pl.col("period") == start - datetime.timedelta(days=1)
+        )
+
+        # Nothing stored before, or other metrics: start over
+        if start > end or set(seed["metric"]) != set(LOAD_METRICS):
+            return build_training_load(day_rollup, end)
+
+        with tracer.span("update training load", days=(end - start).days + 1):
+            return pl.concat(
+                [
+                    training_load.filter(pl.col("period") < start),
+                    _exponential_loads(_daily_loads(day_rollup, start, end), seed),
+                ]
+            ).sort("metric", "period")
+
+
+    def sync_training_load(day_rollup, since, store_dir=STORE_DIR, end=None):
+        """
+        Bring the stored training load up to date with the per day rollup,
+        see `sync_activities` for the meaning of `since`.
+        """
+        path = store_dir / "training_load.parquet"
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        if since is not None and path.exists():
+            training_load = update_training_load(
+                pl.read_parquet(path), day_rollup, since, end
+            )
+        else:
+            training_load = build_training_load(day_rollup, end)
+
+        tmp_path = path.with_suffix(".parquet.tmp")
+        training_load.write_parquet(tmp_path)
+        tmp_path.replace(path)
+
+        return training_load
+    return build_training_load, sync_training_load
+
+
+@app.cell
+def efforts(STORE_DIR, np, pl, tracer):
+    # === BEST EFFORTS ===
+
+    # Fastest time over each of these distances (m) within a run. Others can
+    # be added: runs missing some of them are processed again
+    EFFORT_DISTANCES = {
+        "400m": 400.0,
+        "1k": 1000.0,
+        "1 mile": 1609.344,
+        "5k": 5000.0,
+        "10k": 10000.0,
+        "Half Marathon": 21097.5,
+        "Marathon": 42195.0,
+    }
+
+    # Only runs are analyzed, as in the rest of the dashboard
+    EFFORT_SPORTS = ["Run"]
+
+    # Streams efforts and splits are computed from
+    EFFORT_KEYS = ["time", "distance"]
+
+    SPLIT_DISTANCE = 1000.0
+
+    # Efforts longer than the run are kept as nulls, so that every
+    # processed run has a row for each distance
+    EFFORTS_SCHEMA = {
+        "activity_id": pl.Int64,
+        "effort": pl.String,
+        "distance": pl.Float64,
+        "elapsed_time": pl.Float64,
+        # Where the effort started, from the start of the run
+        "start_time": pl.Float64,
+        "start_distance": pl.Float64,
+    }
+
+    SPLITS_SCHEMA = {
+        "activity_id": pl.Int64,
+        "split": pl.Int32,
+        "distance": pl.Float64,
+        "elapsed_time": pl.Float64,
+    }
+
+
+    def time_and_distance(stream):
+        """
+        Time and distance samples as arrays, without missing samples and
+        with a distance that never decreases, as GPS noise sometimes does.
+        """
+        if not set(EFFORT_KEYS) <= set(stream.columns):
+            return np.empty(0), np.empty(0)
+
+        stream = stream.select(EFFORT_KEYS).drop_nulls()
+
+        return (
+            stream["time"].to_numpy().astype(np.float64),
+            np.maximum.accumulate(stream["distance"].to_numpy().astype(np.float64)),
+        )
+
+
+    def _time_at(time, distance, targets, side):
+        """
+        Time at which each of the `targets` distances was reached,
+        interpolated between samples. With side="right" it is the last
+        time the athlete was there, so that stops are left out.
+        """
+        after = np.searchsorted(distance, targets, side=side).clip(1, len(distance) - 1)
+        before = after - 1
+
+        share = (targets - distance[before]) / np.maximum(
+            distance[after] - distance[before], np.finfo(np.float64).eps
+        )
+
+        return time[before] + share.clip(0, 1) * (time[after] - time[before])
+
+
+    def best_efforts(stream, distances=EFFORT_DISTANCES):
+        """
+        Fastest time over each of `distances` in a stream, and where it
+        started. Distances longer than the stream have null times.
+
+        An effort ending at sample `j` starts where the distance was
+        `distance[j] - d`: as distances never decrease, the start of every
+        window is found in a single vectorized search, instead of moving
+        two pointers along the stream one sample at a time.
+        """
+        time, distance = time_and_distance(stream)
+        rows = []
+
+        for name, target in distances.items():
+            row = {"effort": name, "distance": target}
+
+            if len(distance) > 1 and distance[-1] - distance[0] >= target:
+                # First sample an effort can end at
+                first = np.searchsorted(distance, distance[0] + target, side="left")
+
+                starts = distance[first:] - target
+                start_times = _time_at(time, distance, starts, side="right")
+                elapsed = time[first:] - start_times
+
+                best = int(np.argmin(elapsed))
+                row |= {
+                    "elapsed_time": float(elapsed[best]),
+                    "start_time": float(start_times[best] - time[0]),
+                    "start_distance": float(starts[best] - distance[0]),
+                }
+
+            rows.append(row)
+
+        return pl.DataFrame(
+            rows,
+            schema={
+                key: EFFORTS_SCHEMA[key]
+                for key in EFFORTS_SCHEMA
+                if key != "activity_id"
+            },
+        )
+
+
+    def km_splits(stream, split_distance=SPLIT_DISTANCE):
+        """
+        Time taken by each kilometer (or `split_distance`) of a stream, the
+        last split being whatever is left.
+        """
+        time, distance = time_and_distance(stream)
+        schema = {
+            key: SPLITS_SCHEMA[key] for key in SPLITS_SCHEMA if key != "activity_id"
+        }
+
+        if len(distance) < 2 or distance[-1] <= distance[0]:
+            return pl.DataFrame(schema=schema)
+
+        total = distance[-1] - distance[0]
+        marks = np.append(np.arange(split_distance, total, split_distance), total)
+        times = _time_at(time, distance, distance[0] + marks, side="left")
+
+        return pl.DataFrame(
+            {
+                "split": np.arange(1, len(marks) + 1),
+                "distance": np.diff(marks, prepend=0.0),
+                "elapsed_time": np.diff(times, prepend=time[0]),
+            },
+            schema=schema,
+        )
+
+
+    def analyze_activities(activity_ids, get_streams, distances=EFFORT_DISTANCES):
+        """
+        Best efforts and splits of the given activities. `get_streams(ids)`
+        must yield `(activity_id, stream)` pairs, as `fetch_activity_streams`
+        does. Activities without samples, whose stream is None, get null
+        efforts so that they are not processed again, while those that are
+        not yielded, e.g. as their streams failed, are left out.
+        """
+        efforts, splits = [], []
+
+        with tracer.span("analyze efforts", rows=len(activity_ids)):
+            for activity_id, stream in get_streams(activity_ids):
+                if stream is None:
+                    stream = pl.DataFrame()
+
+                efforts.append(
+                    best_efforts(stream, distances).select(
+                        pl.lit(activity_id, dtype=pl.Int64).alias("activity_id"),
+                        pl.all(),
+                    )
+                )
+                splits.append(
+                    km_splits(stream).select(
+                        pl.lit(activity_id, dtype=pl.Int64).alias("activity_id"),
+                        pl.all(),
+                    )
+                )
+
+        return (
+            pl.concat([pl.DataFrame(schema=EFFORTS_SCHEMA), *efforts]),
+            pl.concat([pl.DataFrame(schema=SPLITS_SCHEMA), *splits]),
+        )
+
+
+    def load_efforts(store_dir=STORE_DIR):
+        """
+        Stored efforts and splits, empty if there are none yet.
+        """
+        efforts_path = store_dir / "efforts" / "efforts.parquet"
+        splits_path = store_dir / "efforts" / "splits.parquet"
+
+        if not efforts_path.exists() or not splits_path.exists():
+            return (
+                pl.DataFrame(schema=EFFORTS_SCHEMA),
+                pl.DataFrame(schema=SPLITS_SCHEMA),
+            )
+
+        return pl.read_parquet(efforts_path), pl.read_parquet(splits_path)
+
+
+    def save_efforts(efforts, splits, store_dir=STORE_DIR):
+        efforts_dir = store_dir / "efforts"
+        efforts_dir.mkdir(parents=True, exist_ok=True)
+
+        with tracer.span("save efforts", rows=efforts.height):
+            for name, frame in [("efforts", efforts), ("splits", splits)]:
+                path = efforts_dir / f"{name}.parquet"
+                tmp_path = path.with_suffix(".parquet.tmp")
+                frame.write_parquet(tmp_path)
+                tmp_path.replace(path)
+
+
+    def pending_efforts(activities, efforts, distances=EFFORT_DISTANCES):
+        """
+        Ids of the runs missing some of the `distances`, newest first.
+        """
+        done = (
+            efforts.filter(pl.col("effort").is_in(list(distances)))
+            .group_by("activity_id")
+            .agg(pl.col("effort").n_unique())
+            .filter(pl.col("effort") == len(distances))["activity_id"]
+            .implode()
+        )
+
+        return (
+            activities.filter(
+                pl.col("sport_type").is_in(EFFORT_SPORTS), ~pl.col("id").is_in(done)
+            )
+            .sort("start_date", descending=True)["id"]
+            .to_list()
+        )
+
+
+    def update_efforts(efforts, splits, new_efforts, new_splits, activities):
+        """
+        Add newly processed runs to the efforts and splits, replacing what
+        they had before, and drop the runs that have been deleted.
+        """
+        kept = pl.col("activity_id").is_in(activities["id"].implode()) & ~pl.col(
+            "activity_id"
+        ).is_in(new_efforts["activity_id"].implode())
+
+        return (
+            pl.concat([efforts.filter(kept), new_efforts]),
+            pl.concat([splits.filter(kept), new_splits]),
+        )
+
+
+    def sync_efforts(
+        activities,
+        get_streams,
+        store_dir=STORE_DIR,
+        distances=EFFORT_DISTANCES,
+        limit=None,
+    ):
+        """
+        Bring the stored efforts and splits up to date with `activities`
+        and return them, with the number of runs left to process.
+
+        Only runs without efforts are processed, at most the `limit` newest
+        ones, as each of them may need its streams to be downloaded. See
+        `analyze_activities` for `get_streams`.
+        """
+        efforts, splits = load_efforts(store_dir)
+        pending = pending_efforts(activities, efforts, distances)
+
+        new_efforts, new_splits = analyze_activities(
+            pending[:limit], get_streams, distances
+        )
+        updated_efforts, updated_splits = update_efforts(
+            efforts, splits, new_efforts, new_splits, activities
+        )
+
+        if new_efforts.height or updated_efforts.height != efforts.height:
+            save_efforts(updated_efforts, updated_splits, store_dir)
+
+        n_processed = new_efforts["activity_id"].n_unique()
+
+        return updated_efforts, updated_splits, len(pending) - n_processed
+
+
+    def pr_progression(efforts, activities):
+        """
+        Runs that set a new best time over each distance, oldest first.
+        """
+        return (
+            efforts.drop_nulls("elapsed_time")
+            .join(
+                activities.select(
+                    activity_id="id", name="name", start_date="start_date"
+                ),
+                on="activity_id",
+            )
+            .sort("start_date")
+            .filter(
+                pl.col("elapsed_time")
+                < pl.col("elapsed_time")
+                .cum_min()
+                .shift(1, fill_value=float("inf"))
+                .over("effort")
+            )
+        )
+    return (
+        EFFORT_DISTANCES,
+        EFFORT_KEYS,
+        EFFORT_SPORTS,
+        analyze_activities,
+        pr_progression,
+        sync_efforts,
+        time_and_distance,
+    )
+
+
+@app.cell
+def pace_curves(EFFORT_SPORTS, STORE_DIR, np, pl, time_and_distance, tracer):
+    # === MEAN-MAXIMAL PACE CURVE ===
+
+    # Durations (s) of the curve, evenly spaced on a log scale from 10 s to
+    # 3 h. Others can be used: runs missing some of them are processed again
+    CURVE_DURATIONS = (
+        np.unique(np.geomspace(10, 3 * 3600, 48).round()).astype(int).tolist()
+    )
+
+    # Durations longer than the run are kept as nulls, so that every
+    # processed run has a row for each duration
+    CURVES_SCHEMA = {
+        "activity_id": pl.Int64,
+        "duration": pl.Int32,
+        # Best average speed held for the duration (m/s)
+        "speed": pl.Float64,
+    }
+
+
+    def mean_max_speeds(stream, durations=CURVE_DURATIONS):
+        """
+        Best average speed held over each of `durations` in a stream,
+        null for durations longer than the stream.
+
+        Distance is piecewise linear in time between samples, so the best
+        window of a given duration starts or ends at a sample: the distance
+        at the other end of every such window is interpolated at once, in
+        O(n log n) per duration instead of comparing every pair of samples.
+        """
+        time, distance = time_and_distance(stream)
+
+        # Interpolation needs strictly increasing times
+        increasing = np.diff(time, prepend=-np.inf) > 0
+        time, distance = time[increasing], distance[increasing]
+
+        speeds = []
+
+        for duration in durations:
+            if len(time) < 2 or time[-1] - time[0] < duration:
+                speeds.append(None)
+                continue
+
+            # Windows starting at a sample, then windows ending at one
+            n_starts = np.searchsorted(time, time[-1] - duration, side="right")
+            first_end = np.searchsorted(time, time[0] + duration, side="left")
+
+            gained = max(
+                np.max(
+                    np.interp(time[:n_starts] + duration, time, distance)
+                    - distance[:n_starts]
                 ),
-                y=alt.Y(
-                    "count",
-                    title="Counts",
-                    axis=alt.Axis(
-                        titleFontSize=15, labelAngle=0, labelFontSize=12
-                    ),
+                np.max(
+                    distance[first_end:]
+                    - np.interp(time[first_end:] - duration, time, distance)
                 ),
             )
+            speeds.append(float(gained) / duration)
+
+        return pl.DataFrame(
+            {"duration": durations, "speed": speeds},
+            schema={
+                key: CURVES_SCHEMA[key] for key in CURVES_SCHEMA if key != "activity_id"
+            },
         )
-    return bar_chart_distance, bar_chart_speed
+
+
+    def analyze_curves(activity_ids, get_streams, durations=CURVE_DURATIONS):
+        """
+        Mean-maximal speeds of the given activities, see `analyze_activities`
+        for `get_streams`. Activities without samples get null speeds.
+        """
+        curves = []
+
+        with tracer.span("analyze pace curves", rows=len(activity_ids)):
+            for activity_id, stream in get_streams(activity_ids):
+                if stream is None:
+                    stream = pl.DataFrame()
+
+                curves.append(
+                    mean_max_speeds(stream, durations).select(
+                        pl.lit(activity_id, dtype=pl.Int64).alias("activity_id"),
+                        pl.all(),
+                    )
+                )
+
+        return pl.concat([pl.DataFrame(schema=CURVES_SCHEMA), *curves])
+
+
+    def load_curves(store_dir=STORE_DIR):
+        """
+        Stored mean-maximal speeds of each run, empty if there are none yet.
+        """
+        path = store_dir / "efforts" / "curves.parquet"
+
+        if not path.exists():
+            return pl.DataFrame(schema=CURVES_SCHEMA)
+
+        return pl.read_parquet(path)
+
+
+    def save_curves(curves, store_dir=STORE_DIR):
+        path = store_dir / "efforts" / "curves.parquet"
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with tracer.span("save pace curves", rows=curves.height):
+            tmp_path = path.with_suffix(".parquet.tmp")
+            curves.write_parquet(tmp_path)
+            tmp_path.replace(path)
+
+
+    def pending_curves(activities, curves, durations=CURVE_DURATIONS):
+        """
+        Ids of the runs missing some of the `durations`, newest first.
+        """
+        done = (
+            curves.filter(pl.col("duration").is_in(durations))
+            .group_by("activity_id")
+            .agg(pl.col("duration").n_unique())
+            .filter(pl.col("duration") == len(durations))["activity_id"]
+            .implode()
+        )
+
+        return (
+            activities.filter(
+                pl.col("sport_type").is_in(EFFORT_SPORTS), ~pl.col("id").is_in(done)
+            )
+            .sort("start_date", descending=True)["id"]
+            .to_list()
+        )
+
+
+    def update_curves(curves, new_curves, activities):
+        """
+        Add newly processed runs to the curves, replacing what they had
+        before, and drop the runs that have been deleted.
+        """
+        return pl.concat(
+            [
+                curves.filter(
+                    pl.col("activity_id").is_in(activities["id"].implode()),
+                    ~pl.col("activity_id").is_in(new_curves["activity_id"].implode()),
+                ),
+                new_curves,
+            ]
+        )
+
+
+    def sync_curves(
+        activities,
+        get_streams,
+        store_dir=STORE_DIR,
+        durations=CURVE_DURATIONS,
+        limit=None,
+    ):
+        """
+        Fold the runs without a stored curve, at most the `limit` newest
+        ones, into the stored curves and return them, with the number of
+        runs left to process. See `sync_efforts`.
+        """
+        curves = load_curves(store_dir)
+        pending = pending_curves(activities, curves, durations)
+
+        new_curves = analyze_curves(pending[:limit], get_streams, durations)
+        updated = update_curves(curves, new_curves, activities)
+
+        if new_curves.height or updated.height != curves.height:
+            save_curves(updated, store_dir)
+
+        n_processed = new_curves["activity_id"].n_unique()
+
+        return updated, len(pending) - n_processed
+
+
+    def pace_curve(curves, activities):
+        """
+        Envelope of the curves: best average speed over each duration of
+        all time and of each year, with the run that held it.
+        """
+        with tracer.span("pace curve envelope", rows=curves.height):
+            held = curves.drop_nulls("speed").join(
+                activities.select(
+                    activity_id="id", name="name", start_date="start_date"
+                ),
+                on="activity_id",
+            )
+
+            return (
+                pl.concat(
+                    [
+                        held.with_columns(season=pl.lit("All time")),
+                        held.with_columns(
+                            season=pl.col("start_date").dt.year().cast(pl.String)
+                        ),
+                    ]
+                )
+                .sort("speed", descending=True)
+                .unique(["season", "duration"], keep="first")
+                .sort("season", "duration")
+            )
+    return analyze_curves, pace_curve, sync_curves
 
 
 @app.cell
-def _(alt, days, mo, pl):
-    # unused because I ended up liking more the result of polars.hist
-    def _bar_chart(_df, _column_name, _display_name, _unit_measure):
-        if _df.height == 1:
-            return mo.callout(
-                f"Select more than one activity to view {_display_name} distribution!"
+def route_tiles(STORE_DIR, np, pl, struct, tracer, zlib):
+    # === ROUTE DENSITY TILES ===
+
+    # GPS points are counted per pixel of web mercator tiles, at every zoom
+    # of the pyramid: from a whole region (8) to single streets (16)
+    TILE_SIZE = 256
+    MIN_ZOOM = 8
+    MAX_ZOOM = 16
+
+    # Tiles are stored in blocks of 16 x 16, a file each: syncs rewrite the
+    # blocks new runs went through and views read those they overlap
+    BLOCK_SIZE = 16 * TILE_SIZE
+
+    # Only runs are mapped, as in the rest of the dashboard
+    TILE_SPORTS = ["Run"]
+
+    TILE_KEYS = ["latlng"]
+
+    # Activities rasterized at once: only their streams are in memory
+    TILE_BATCH = 100
+
+    # Pixel coordinates from the top left corner of the world at the zoom
+    # of the block
+    PIXELS_SCHEMA = {"x": pl.UInt32, "y": pl.UInt32, "count": pl.UInt32}
+
+    # Intensity to RGBA, from the quietest pixels to the busiest, readable
+    # on light and dark themes. Pixels without points are transparent
+    _COLOR_STOPS = np.array(
+        [
+            [0.0, 255, 170, 0, 140],
+            [0.5, 240, 80, 0, 220],
+            [1.0, 140, 0, 60, 255],
+        ]
+    )
+    _COLORS = np.stack(
+        [
+            np.interp(np.linspace(0, 1, 256), _COLOR_STOPS[:, 0], _COLOR_STOPS[:, i])
+            for i in range(1, 5)
+        ],
+        axis=-1,
+    ).astype(np.uint8)
+
+
+    def project(latlng, zoom):
+        """
+        Web mercator pixel coordinates, as floats, of an `(n, 2)` array of
+        latitudes and longitudes.
+        """
+        scale = TILE_SIZE * 2**zoom
+        sin_lat = np.sin(np.radians(latlng[:, 0])).clip(-0.9999, 0.9999)
+
+        return (
+            (latlng[:, 1] + 180) / 360 * scale,
+            (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * scale,
+        )
+
+
+    def rasterize(latlng):
+        """
+        Points of an `(n, 2)` array of latitudes and longitudes counted
+        per pixel at MAX_ZOOM.
+
+        A dense grid over the area of a city at MAX_ZOOM would hold ~10⁸
+        pixels, so only those with points are counted, by grouping the
+        integer coordinates.
+        """
+        x, y = project(latlng, MAX_ZOOM)
+
+        return (
+            pl.DataFrame(
+                {"x": x.astype(np.uint32), "y": y.astype(np.uint32)},
+                schema={"x": pl.UInt32, "y": pl.UInt32},
+            )
+            .group_by("x", "y")
+            .agg(count=pl.len().cast(pl.UInt32))
+        )
+
+
+    def _merge_pixels(frames):
+        # Grouping by a single key is about twice as fast as by both columns
+        return (
+            pl.concat([pl.DataFrame(schema=PIXELS_SCHEMA), *frames])
+            .group_by(pixel=pl.col("x").cast(pl.UInt64) * 2**32 + pl.col("y"))
+            .agg(pl.col("count").sum())
+            .select(
+                x=(pl.col("pixel") // 2**32).cast(pl.UInt32),
+                y=(pl.col("pixel") % 2**32).cast(pl.UInt32),
+                count="count",
+            )
+        )
+
+
+    def rasterize_activities(activity_ids, get_streams):
+        """
+        Points of the given activities counted per pixel at MAX_ZOOM, and
+        the ids of those rasterized, see `analyze_activities` for
+        `get_streams`. Activities without GPS or without samples, whose
+        stream is None, are rasterized, to nothing.
+        """
+        frames, done = [], []
+
+        with tracer.span("rasterize routes", rows=len(activity_ids)) as span:
+            for activity_id, stream in get_streams(activity_ids):
+                done.append(activity_id)
+
+                if stream is not None and "latlng" in stream.columns:
+                    latlng = stream["latlng"].drop_nulls().to_numpy()
+
+                    if len(latlng):
+                        frames.append(rasterize(latlng))
+
+            pixels = _merge_pixels(frames)
+            span.set(pixels=pixels.height)
+
+        return pixels, done
+
+
+    def build_pyramid(pixels, pyramid=None):
+        """
+        Add pixel counts at MAX_ZOOM to a pyramid, a dict from the zoom to
+        a dict from the `(x, y)` block to its pixels, as frames or lazy
+        frames. The same pixel may be counted on several rows, e.g. by
+        different batches. Return the blocks the pixels fall in, at every
+        zoom: all of the pyramid if it was empty.
+        """
+        pyramid = pyramid or {}
+        blocks = {}
+
+        with tracer.span("build tile pyramid", rows=pixels.height):
+            for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
+                # Each pixel is 2 x 2 pixels of the zoom above
+                pixels = _merge_pixels(
+                    [
+                        pixels
+                        if zoom == MAX_ZOOM
+                        else pixels.with_columns(pl.col("x", "y") // 2)
+                    ]
+                )
+
+                blocks[zoom] = {}
+
+                for block, block_pixels in (
+                    pixels.with_columns(
+                        block_x=pl.col("x") // BLOCK_SIZE,
+                        block_y=pl.col("y") // BLOCK_SIZE,
+                    )
+                    .partition_by("block_x", "block_y", as_dict=True)
+                    .items()
+                ):
+                    stored = pyramid.get(zoom, {}).get(block)
+                    block_pixels = block_pixels.drop("block_x", "block_y")
+
+                    blocks[zoom][block] = (
+                        block_pixels
+                        if stored is None
+                        else _merge_pixels([stored.lazy().collect(), block_pixels])
+                    )
+
+        return blocks
+
+
+    def load_tiled(store_dir=STORE_DIR):
+        """
+        Ids of the activities already in the stored tiles.
+        """
+        path = store_dir / "tiles" / "activities.parquet"
+
+        if not path.exists():
+            return []
+
+        return pl.read_parquet(path)["activity_id"].to_list()
+
+
+    def load_tiles(store_dir=STORE_DIR):
+        """
+        Stored pyramid, blocks being scanned lazily from disk.
+        """
+        return {
+            zoom: {
+                tuple(map(int, path.stem.split("_"))): pl.scan_parquet(path)
+                for path in (store_dir / "tiles" / f"z{zoom}").glob("*.parquet")
+            }
+            for zoom in range(MIN_ZOOM, MAX_ZOOM + 1)
+        }
+
+
+    def save_tiles(blocks, tiled, store_dir=STORE_DIR):
+        """
+        Write the given blocks of the pyramid, then the ids of the
+        activities they hold.
+        """
+        tiles_dir = store_dir / "tiles"
+
+        def _write(frame, path):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".parquet.tmp")
+            frame.write_parquet(tmp_path)
+            tmp_path.replace(path)
+
+        with tracer.span("save tiles", rows=sum(map(len, blocks.values()))):
+            for zoom, zoom_blocks in blocks.items():
+                for (block_x, block_y), pixels in zoom_blocks.items():
+                    _write(
+                        pixels, tiles_dir / f"z{zoom}" / f"{block_x}_{block_y}.parquet"
+                    )
+
+            # Last, so that activities are only recorded once in the tiles
+            _write(
+                pl.DataFrame({"activity_id": tiled}, schema={"activity_id": pl.Int64}),
+                tiles_dir / "activities.parquet",
+            )
+
+
+    def pending_tiles(activities, tiled):
+        """
+        Ids of the runs not in the tiles yet, newest first.
+        """
+        return (
+            activities.filter(
+                pl.col("sport_type").is_in(TILE_SPORTS),
+                ~pl.col("id").is_in(pl.Series(tiled, dtype=pl.Int64).implode()),
+            )
+            .sort("start_date", descending=True)["id"]
+            .to_list()
+        )
+
+
+    def update_tiles(pixels, done, activities, store_dir=STORE_DIR):
+        """
+        Add the pixels of newly rasterized activities to the stored tiles.
+        Counts can't be taken back: if activities were deleted, the tiles
+        are emptied, to be rasterized again.
+        """
+        tiled = load_tiled(store_dir)
+
+        if not set(tiled) <= set(activities["id"].to_list()):
+            for path in (store_dir / "tiles").glob("**/*.parquet"):
+                path.unlink()
+
+            tiled, pixels, done = [], pixels.clear(), []
+
+        save_tiles(
+            build_pyramid(pixels, load_tiles(store_dir)), [*tiled, *done], store_dir
+        )
+
+
+    def sync_tiles(activities, get_streams, store_dir=STORE_DIR, limit=None):
+        """
+        Rasterize the runs not in the tiles yet, at most the `limit` newest
+        ones and TILE_BATCH at a time, into the stored tiles. Return the
+        number of runs left. See `analyze_activities` for `get_streams`.
+        """
+        tiled = load_tiled(store_dir)
+
+        if not set(tiled) <= set(activities["id"].to_list()):
+            # Deleted activities are in the tiles: start over
+            update_tiles(pl.DataFrame(schema=PIXELS_SCHEMA), [], activities, store_dir)
+            tiled = []
+
+        pending = pending_tiles(activities, tiled)
+        selected = pending[:limit]
+        frames, done = [], []
+
+        for start in range(0, len(selected), TILE_BATCH):
+            pixels, batch_done = rasterize_activities(
+                selected[start : start + TILE_BATCH], get_streams
+            )
+            frames.append(pixels)
+            done += batch_done
+
+        if done:
+            update_tiles(
+                pl.concat([pl.DataFrame(schema=PIXELS_SCHEMA), *frames]),
+                done,
+                activities,
+                store_dir,
+            )
+
+        return len(pending) - len(done)
+
+
+    def fit_zoom(latlng, width, height, max_zoom=MAX_ZOOM):
+        """
+        Highest zoom at which the points of an `(n, 2)` array fit in half
+        of a view, so that the routes around them are shown too.
+        """
+        for zoom in range(max_zoom, MIN_ZOOM, -1):
+            x, y = project(latlng, zoom)
+
+            if np.ptp(x) <= width / 2 and np.ptp(y) <= height / 2:
+                return zoom
+
+        return MIN_ZOOM
+
+
+    def density_grid(pyramid, zoom, center, width, height):
+        """
+        Counts of the pixels of a view of the pyramid at `zoom`, centered
+        on a `(lat, lng)` pair, as a `(height, width)` array. Only the
+        blocks overlapping the view are read.
+        """
+        x, y = project(np.array([center], dtype=np.float64), zoom)
+        left, top = int(x[0]) - width // 2, int(y[0]) - height // 2
+        grid = np.zeros((height, width), dtype=np.uint32)
+
+        blocks = [
+            frame.lazy()
+            for (block_x, block_y), frame in pyramid.get(zoom, {}).items()
+            if left // BLOCK_SIZE <= block_x <= (left + width - 1) // BLOCK_SIZE
+            and top // BLOCK_SIZE <= block_y <= (top + height - 1) // BLOCK_SIZE
+        ]
+
+        if not blocks:
+            return grid
+
+        with tracer.span("read tiles", zoom=zoom, blocks=len(blocks)) as span:
+            pixels = (
+                pl.concat(blocks)
+                .filter(
+                    pl.col("x").is_between(max(left, 0), left + width - 1),
+                    pl.col("y").is_between(max(top, 0), top + height - 1),
+                )
+                .collect()
+            )
+            span.set(rows=pixels.height)
+
+        grid[
+            pixels["y"].to_numpy().astype(np.int64) - top,
+            pixels["x"].to_numpy().astype(np.int64) - left,
+        ] = pixels["count"].to_numpy()
+
+        return grid
+
+
+    def density_png(grid):
+        """
+        PNG image of a density grid, on a log scale and transparent where
+        there are no points.
+        """
+        with tracer.span("encode density png", "charts", rows=grid.size):
+            levels = np.log1p(grid) / np.log1p(max(int(grid.max()), 1)) * 255
+            rgba = _COLORS[levels.astype(np.uint8)]
+            rgba[grid == 0] = 0
+
+            height, width, _ = rgba.shape
+
+            # Each row starts with its filter type, none
+            raw = np.concatenate(
+                [np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, -1)],
+                axis=1,
+            ).tobytes()
+
+            def _chunk(kind, data):
+                return (
+                    struct.pack(">I", len(data))
+                    + kind
+                    + data
+                    + struct.pack(">I", zlib.crc32(kind + data))
+                )
+
+            return (
+                b"\x89PNG\r\n\x1a\n"
+                + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+                # Encoded for each view: speed matters more than size
+                + _chunk(b"IDAT", zlib.compress(raw, 1))
+                + _chunk(b"IEND", b"")
             )
+    return (
+        MAX_ZOOM,
+        MIN_ZOOM,
+        TILE_KEYS,
+        TILE_SPORTS,
+        build_pyramid,
+        density_grid,
+        density_png,
+        fit_zoom,
+        load_tiles,
+        rasterize_activities,
+        sync_tiles,
+    )
+
+
+@app.cell
+def route_clusters(STORE_DIR, np, pl, tracer):
+    # === ROUTE CLUSTERS ===
+
+    # Only runs are grouped, as in the rest of the dashboard
+    ROUTE_SPORTS = ["Run"]
+
+    # Points are hashed to the cells of a grid of `size` degrees. Runs of a
+    # route start and end in the same cells of about 500 m, or neighbouring
+    # ones, and their tracks go through the same cells of about 100 m
+    ENDPOINT_CELL = 0.005
+    TRACK_CELL = 0.001
+
+    # Tracks are resampled every 100 m, with at most MAX_TRACK_POINTS points
+    # so that comparing two of them has a bounded cost
+    TRACK_STEP = 100.0
+    MAX_TRACK_POINTS = 500
+
+    # Runs are on the same route if this share of each track is within a
+    # cell of the other, and their lengths differ by less than 15%
+    ROUTE_SIMILARITY = 0.8
+    ROUTE_LENGTH_RATIO = 0.85
+
+    # Route of each run, null for runs without a GPS track
+    ROUTES_SCHEMA = {"activity_id": pl.Int64, "route": pl.Int32}
+
+    # Track of the first run of each route, which the others are compared to
+    SIGNATURES_SCHEMA = {
+        "route": pl.Int32,
+        "length": pl.Float64,
+        "start": pl.UInt64,
+        "end": pl.UInt64,
+        "cells": pl.List(pl.UInt64),
+    }
+
+    # Key offsets of the 3 x 3 cells around a cell
+    _NEIGHBOURS = np.array(
+        [lat * 2**32 + lng for lat in (-1, 0, 1) for lng in (-1, 0, 1)],
+        dtype=np.int64,
+    )
+
+
+    def cell_keys(lat, lng, size):
+        """
+        Key of the grid cell of `size` degrees of each point, the row in
+        the high 32 bits and the column in the low ones.
+        """
+        rows = np.floor((np.asarray(lat) + 90) / size).astype(np.int64)
+        columns = np.floor((np.asarray(lng) + 180) / size).astype(np.int64)
+
+        return rows * 2**32 + columns
+
+
+    def decode_polylines(polylines):
+        """
+        `(n, 2)` arrays of latitudes and longitudes of encoded polylines,
+        as in the summaries of activities, all decoded at once.
+        """
+        lengths = np.array([len(polyline) for polyline in polylines])
+
+        if not lengths.sum():
+            return [np.empty((0, 2)) for _ in polylines]
+
+        chars = np.frombuffer("".join(polylines).encode(), dtype=np.uint8) - 63
+
+        # Values are chunks of 5 bits, the last one without the 0x20 flag
+        last = (chars & 0x20) == 0
+        value_ids = np.concatenate([[0], np.cumsum(last)[:-1]])
+        value_starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+        shifts = 5 * (np.arange(len(chars)) - value_starts[value_ids])
+
+        values = np.bincount(
+            value_ids, weights=(chars & 0x1F).astype(np.float64) * 2.0**shifts
+        ).astype(np.int64)
+        # Zigzag encoded deltas
+        deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+
+        # Values of each polyline, alternating latitude and longitude deltas
+        counts = np.bincount(
+            np.repeat(np.arange(len(polylines)), lengths)[last],
+            minlength=len(polylines),
+        )
+        points = []
+
+        for chunk in np.split(deltas, np.cumsum(counts)[:-1]):
+            pairs = chunk[: len(chunk) // 2 * 2].reshape(-1, 2)
+            points.append(np.cumsum(pairs, axis=0) / 1e5)
+
+        return points
+
+
+    def track_signature(latlng):
+        """
+        Length of a track, keys of its start and end cells, and sorted keys
+        of the cells it goes through once resampled.
+        """
+        lat, lng = latlng[:, 0], latlng[:, 1]
+
+        # Equirectangular distances are plenty at this scale
+        north = np.diff(lat) * 111_195
+        east = np.diff(lng) * 111_195 * np.cos(np.radians(lat[:-1]))
+        along = np.concatenate([[0.0], np.cumsum(np.hypot(north, east))])
+
+        step = max(TRACK_STEP, along[-1] / MAX_TRACK_POINTS)
+        marks = np.append(np.arange(0, along[-1], step), along[-1])
+
+        return {
+            "length": float(along[-1]),
+            "start": int(cell_keys(lat[0], lng[0], ENDPOINT_CELL)),
+            "end": int(cell_keys(lat[-1], lng[-1], ENDPOINT_CELL)),
+            "cells": np.unique(
+                cell_keys(
+                    np.interp(marks, along, lat),
+                    np.interp(marks, along, lng),
+                    TRACK_CELL,
+                )
+            ),
+        }
+
+
+    def _near_cells(cells):
+        # Sorted keys of the cells within a cell of the track
+        return np.unique((cells.astype(np.int64)[:, None] + _NEIGHBOURS).ravel())
+
+
+    def track_similarity(signature, other):
+        """
+        Share of the cells of each track within a cell of the other, the
+        lowest of both. Signatures are completed with the cells near them.
+        """
+        for _signature in (signature, other):
+            if "near" not in _signature:
+                _signature["near"] = _near_cells(_signature["cells"])
+
+        def _share(cells, near):
+            cells = cells.astype(np.int64)
+            found = np.searchsorted(near, cells).clip(max=len(near) - 1)
+            return (near[found] == cells).mean()
+
+        return min(
+            _share(signature["cells"], other["near"]),
+            _share(other["cells"], signature["near"]),
+        )
+
+
+    def _candidate_keys(signature):
+        # A route is found from any of the cells around its start and end
+        starts = signature["start"] + _NEIGHBOURS
+        ends = signature["end"] + _NEIGHBOURS
+
+        return [(int(start), int(end)) for start in starts for end in ends]
+
+
+    def assign_routes(tracks, signatures):
+        """
+        Route of each of the `(activity_id, latlng)` tracks, in order, and
+        the signatures with those of new routes added.
+
+        Runs are only compared to the routes starting and ending in the
+        same cells, found in a hash table, instead of to every other run.
+        """
+        signatures = [
+            {**signature, "cells": np.asarray(signature["cells"], dtype=np.uint64)}
+            for signature in signatures.to_dicts()
+        ]
+
+        # Routes by the cells they start and end in. Route ids are positions
+        candidates = {}
+        for route, signature in enumerate(signatures):
+            for key in _candidate_keys(signature):
+                candidates.setdefault(key, []).append(route)
+
+        rows = []
+
+        with tracer.span("assign routes", rows=len(tracks)) as span:
+            for activity_id, latlng in tracks:
+                if latlng is None or len(latlng) < 2:
+                    rows.append({"activity_id": activity_id, "route": None})
+                    continue
+
+                signature = track_signature(latlng)
+                best, best_similarity = None, ROUTE_SIMILARITY
+
+                for route in candidates.get((signature["start"], signature["end"]), []):
+                    other = signatures[route]
+                    lengths = sorted([signature["length"], other["length"]])
+
+                    if lengths[0] < ROUTE_LENGTH_RATIO * lengths[1]:
+                        continue
+
+                    similarity = track_similarity(signature, other)
+                    if similarity >= best_similarity:
+                        best, best_similarity = route, similarity
+
+                if best is None:
+                    # First run of a new route
+                    best = len(signatures)
+                    signatures.append({**signature, "route": best})
+                    for key in _candidate_keys(signature):
+                        candidates.setdefault(key, []).append(best)
+
+                rows.append({"activity_id": activity_id, "route": best})
+
+            span.set(routes=len(signatures))
+
+        return (
+            pl.DataFrame(rows, schema=ROUTES_SCHEMA),
+            pl.DataFrame(
+                [
+                    {
+                        **{key: signature[key] for key in SIGNATURES_SCHEMA},
+                        "cells": signature["cells"].tolist(),
+                    }
+                    for signature in signatures
+                ],
+                schema=SIGNATURES_SCHEMA,
+            ),
+        )
+
+
+    def activity_tracks(activities):
+        """
+        `(activity_id, latlng)` of the runs, oldest first, from the summary
+        polylines of the activities, None for runs without one.
+        """
+        runs = activities.filter(pl.col("sport_type").is_in(ROUTE_SPORTS)).sort(
+            "start_date"
+        )
 
-        return (
-            alt.Chart(
-                _df,
-                title=alt.TitleParams(
-                    f"{_display_name.capitalize()} Distribution",
-                    anchor="middle",
-                    fontSize=18,
-                ),
-            )
-            .mark_bar()
-            .encode(
-                x=alt.X(
-                    f"{_column_name}:Q",
-                    bin=True,
-                    title=f"{_display_name.capitalize()} ({_unit_measure})",
-                    axis=alt.Axis(
-                        labelAngle=0, labelFontSize=12, titleFontSize=15
-                    ),
-                ),
-                y=alt.Y(
-                    "count()",
-                    title="Counts",
-                    axis=alt.Axis(
-                        titleFontSize=15, labelAngle=0, labelFontSize=12
-                    ),
+        if "map" not in runs.columns:
+            return [(activity_id, None) for activity_id in runs["id"]]
+
+        polylines = runs["map"].struct.field("summary_polyline").fill_null("")
+
+        return list(
+            zip(
+                runs["id"].to_list(),
+                (
+                    points if len(points) else None
+                    for points in decode_polylines(polylines.to_list())
                 ),
             )
         )
 
 
-    def heatmap_chart(_df):
-        # 1. Add day, week and year columns
-        # 2. Group by year, week and day, then agg on the sum
-        # of kms to get the kilometers done on a certain day
-        # 3. Sort by year, week and day to order entries
-        # 4. Replace each day with its name
-        # 5. Round kilometers to 2 decimal digits
-
-        source = (
-            _df.with_columns(
-                day=pl.col("start_date").dt.weekday(),
-                week=pl.col("start_date").dt.week(),
-                year=pl.col("start_date").dt.iso_year(),
-            )
-            .group_by([pl.col("year"), pl.col("week"), pl.col("day")])
-            .agg(
-                pl.col("kms").sum(), pl.col("start_date").min(), pl.col("id")
-            )  # keep also start date to show it in plot
-            .with_columns(
-                day=pl.col("day").replace_strict(days),
-                year_week=pl.concat_str(
-                    pl.col("year"), pl.col("week"), separator=" - "
-                ),
-                Date=pl.col("start_date"),
-                Kilometers=pl.col("kms").round(2),
+    def load_routes(store_dir=STORE_DIR):
+        """
+        Stored routes of the runs and signatures of the routes, empty if
+        there are none yet.
+        """
+        routes_path = store_dir / "routes" / "routes.parquet"
+        signatures_path = store_dir / "routes" / "signatures.parquet"
+
+        if not routes_path.exists() or not signatures_path.exists():
+            return (
+                pl.DataFrame(schema=ROUTES_SCHEMA),
+                pl.DataFrame(schema=SIGNATURES_SCHEMA),
             )
+
+        return pl.read_parquet(routes_path), pl.read_parquet(signatures_path)
+
+
+    def save_routes(routes, signatures, store_dir=STORE_DIR):
+        routes_dir = store_dir / "routes"
+        routes_dir.mkdir(parents=True, exist_ok=True)
+
+        with tracer.span("save routes", rows=routes.height):
+            for name, frame in [("signatures", signatures), ("routes", routes)]:
+                path = routes_dir / f"{name}.parquet"
+                tmp_path = path.with_suffix(".parquet.tmp")
+                frame.write_parquet(tmp_path)
+                tmp_path.replace(path)
+
+
+    def sync_routes(activities, store_dir=STORE_DIR):
+        """
+        Assign the runs without a route yet to one, new or stored, and
+        return the routes of all runs and their signatures. Deleted runs
+        are dropped, their routes are kept.
+        """
+        routes, signatures = load_routes(store_dir)
+        kept = routes.filter(pl.col("activity_id").is_in(activities["id"].implode()))
+
+        pending = activities.filter(
+            ~pl.col("id").is_in(routes["activity_id"].implode())
+        )
+        new_routes, new_signatures = assign_routes(
+            activity_tracks(pending), signatures
         )
 
-        sorted_years_week = sorted(
-            source["year_week"].to_list(),
-            key=lambda yw: tuple(map(lambda p: -int(p), yw.split(" - "))),
+        if new_routes.height or kept.height != routes.height:
+            routes = pl.concat([kept, new_routes])
+            signatures = new_signatures
+            save_routes(routes, signatures, store_dir)
+
+        return routes, signatures
+
+
+    def route_index(routes, signatures, min_runs=2):
+        """
+        Label and ids of the runs of every route run at least `min_runs`
+        times, by route, most run first. Labels hold the route, so that
+        routes of the same length and number of runs can be told apart.
+        """
+        counts = (
+            routes.drop_nulls("route")
+            .group_by("route")
+            .agg(pl.col("activity_id").sort())
+            .filter(pl.col("activity_id").list.len() >= min_runs)
+            .join(signatures.select("route", "length"), on="route")
+            .sort(pl.col("activity_id").list.len(), "route", descending=[True, False])
         )
 
-        altair_chart = (
-            alt.Chart(source)
-            .mark_rect()
-            .encode(
-                x=alt.X(
-                    "day:O",
-                    title="Day of Week",
-                    sort=list(days.values()),
-                    axis=alt.Axis(
-                        labelAngle=0, labelFontSize=12, titleFontSize=15, titleY=28
-                    ),
-                ),
-                y=alt.Y(
-                    "year_week:O",
-                    title="Week",
-                    sort=sorted_years_week,
-                    axis=alt.Axis(labels=False, tickSize=0, titleFontSize=15),
-                ),
-                color=alt.Color(
-                    "kms:Q",
-                    title="Kilometers",
-                    legend=alt.Legend(labelFontSize=12, titleFontSize=14),
-                ).scale(),
-                tooltip=["Date", "Kilometers"],
-            )
+        return {
+            route: (f"Route {route} · {length / 1000:.1f} km · {len(ids)} runs", ids)
+            for route, ids, length in counts.select(
+                "route", "activity_id", "length"
+            ).iter_rows()
+        }
+    return (
+        SIGNATURES_SCHEMA,
+        activity_tracks,
+        assign_routes,
+        route_index,
+        sync_routes,
+    )
+
+
+@app.cell
+def authentication(s_client, strava_client, threading):
+    def make_client(credentials):
+        """
+        Strava client of an athlete, from its client id, client secret,
+        access token and refresh token.
+        """
+        settings = strava_client.models.settings.StravaSettings.model_validate(
+            {
+                # Refresh the token before the first call if no expiry is known
+                "expires_at": 0,
+                **credentials,
+            }
         )
 
-        return mo.ui.altair_chart(chart=altair_chart, chart_selection=True)
-    return (heatmap_chart,)
+        return s_client.StravaClient(
+            scopes=[
+                strava_client.enums.auth.StravaScope.READ,
+                strava_client.enums.auth.StravaScope.ACTIVITY_READ,
+                strava_client.enums.auth.StravaScope.ACTIVITY_READ_ALL,
+            ],
+            settings=settings,
+            dump_settings=False,
+        )
+
+
+    def make_auth_headers(client):
+        """
+        Return a function giving the headers of requests authenticated
+        as the athlete of `client`.
+        """
+        token_lock = threading.Lock()
+
+        def get_auth_headers():
+            # Refresh the token if needed, as the client does before each call,
+            # but only once when requests are made from several threads
+            with token_lock:
+                client._verify_token()
+
+            return {"Authorization": f"Bearer {client.settings.access_token}"}
+
+        return get_auth_headers
+    return make_auth_headers, make_client
 
 
 @app.cell
-def _(displayed_activities, mo):
-    _options = displayed_activities["start_date_str"].to_list()
-    dropdown_activities = mo.ui.multiselect(
-        options=_options,
-        label="Select activity",
-        value=_options[:1],
-        max_selections=10,
-    )
-    return (dropdown_activities,)
+def _(client, client_ready, make_auth_headers):
+    # There is no client when mocked data is used
+    get_auth_headers = make_auth_headers(client) if client_ready else None
+    return (get_auth_headers,)
 
 
 @app.cell
-def _(math):
-    def _get_n_digits(_n):
-        if _n == 0:
-            return 1
+def activity_schema(pl, strava_client, tracer):
+    # === ACTIVITY SCHEMA ===
+
+    # Activities are decoded from JSON straight into columns, with the fields
+    # documented by the API: validating a model per activity costs more than
+    # the whole analysis on long histories
+    ACTIVITY_SCHEMA = pl.Schema(
+        {
+            "id": pl.Int64,
+            "external_id": pl.String,
+            "name": pl.String,
+            "athlete": pl.Struct({"id": pl.Int64}),
+            "distance": pl.Float64,
+            "moving_time": pl.Int64,
+            "elapsed_time": pl.Int64,
+            "total_elevation_gain": pl.Float64,
+            "elev_high": pl.Float64,
+            "elev_low": pl.Float64,
+            "sport_type": pl.String,
+            "start_date": pl.Datetime("us"),
+            "start_date_local": pl.Datetime("us"),
+            "timezone": pl.String,
+            "average_speed": pl.Float64,
+            "max_speed": pl.Float64,
+            # Only there for activities recorded with a heart rate monitor
+            "average_heartrate": pl.Float64,
+            "start_latlng": pl.List(pl.Float64),
+            "end_latlng": pl.List(pl.Float64),
+            # Simplified GPS track, empty for activities without one
+            "map": pl.Struct({"summary_polyline": pl.String}),
+        }
+    )
 
-        # https://stackoverflow.com/questions/2189800/how-to-find-length-of-digits-in-an-integer
-        return int(math.log10(_n)) + 1
+    # Fields that can be missing, every other one is required
+    OPTIONAL_FIELDS = [
+        "external_id",
+        "elev_high",
+        "elev_low",
+        "average_heartrate",
+        "map",
+    ]
 
+    SPORT_TYPES = [sport.value for sport in strava_client.enums.api.StravaSportType]
 
-    def get_nice_duration(_seconds):
-        secs = int(_seconds)
+    # Start dates are in UTC, local ones are marked as UTC as well
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
-        hours = secs // 3600
-        minutes = secs % 3600 // 60
-        seconds = secs % 3600 % 60
 
-        hours = hours if _get_n_digits(hours) >= 2 else f"0{hours}"
-        minutes = minutes if _get_n_digits(minutes) >= 2 else f"0{minutes}"
-        seconds = seconds if _get_n_digits(seconds) >= 2 else f"0{seconds}"
+    def read_activities_json(source):
+        """
+        Decode a JSON list of activities as returned by the API, as bytes
+        or from a path, into a frame with `ACTIVITY_SCHEMA`. Activities
+        are validated column by column, and any invalid one raises a
+        ValueError, as the API models would.
+        """
+        with tracer.span("parse activities") as span:
+            activities = pl.read_json(
+                source,
+                schema={
+                    **ACTIVITY_SCHEMA,
+                    "start_date": pl.String,
+                    "start_date_local": pl.String,
+                },
+            ).with_columns(
+                pl.col("start_date", "start_date_local").str.to_datetime(
+                    DATE_FORMAT, time_unit="us", strict=False
+                )
+            )
+            span.set(rows=activities.height)
+
+        # Missing dates and dates in another format are both null by now
+        checks = {
+            **{
+                f"invalid {name}": pl.col(name).is_null()
+                for name in ACTIVITY_SCHEMA
+                if name not in OPTIONAL_FIELDS
+            },
+            "invalid athlete id": pl.col("athlete").struct.field("id").is_null(),
+            "unknown sport_type": ~pl.col("sport_type").is_in(SPORT_TYPES),
+        }
 
-        return f"{hours}:{minutes}:{seconds}"
+        invalid = activities.select(
+            **{name: check.sum() for name, check in checks.items()}
+        ).row(0, named=True)
 
+        errors = [f"{count} with {name}" for name, count in invalid.items() if count]
 
-    def get_column_sum(_df, _column_name):
-        if _df.height == 0:
-            return 0.0
-        return _df[_column_name].sum()
+        if errors:
+            raise ValueError(f"Invalid activities: {', '.join(errors)}")
 
+        return activities
+    return ACTIVITY_SCHEMA, read_activities_json
 
-    def get_average_column(_df, _column_name):
-        if _df.height == 0:
-            return 0.0
-        return _df[_column_name].mean()
 
+@app.cell
+def activity_api(
+    ACTIVITY_SCHEMA,
+    fetch_pages,
+    pl,
+    rate_limited_get,
+    rate_limiter,
+    read_activities_json,
+    s_client,
+    tracer,
+):
+    # === ACTIVITY API ===
 
-    def _from_mt_s_to_min_km(v) -> tuple[int, int]:
-        if v == 0:
-            return 0, 0
+    PER_PAGE = 200
 
-        min_per_km_dec = 1 / (v * 0.06)
 
-        min_per_km_min = int(min_per_km_dec)
-        min_per_km_secs = min_per_km_dec % 1 * 60
+    def fetch_activities_page(get_headers, page, after=None):
+        response = rate_limited_get(
+            rate_limiter,
+            f"{s_client.StravaClient.BASE_SERVER_URL}/athlete/activities",
+            headers=get_headers(),
+            params={
+                "after": int(after.timestamp()) if after else None,
+                "page": page,
+                "per_page": PER_PAGE,
+            },
+        )
 
-        return min_per_km_min, min_per_km_secs
+        if response.status_code != 200:
+            raise ValueError(
+                f"Failed to retrieve activities. Status code: {response.status_code}."
+                f" Response: {response.text}"
+            )
 
+        return read_activities_json(response.content)
 
-    def get_mt_km_speed(v) -> str:
-        mins, secs = _from_mt_s_to_min_km(v)
 
-        mins = int(mins) if _get_n_digits(mins) >= 2 else f"0{int(mins)}"
-        secs = int(secs) if _get_n_digits(secs) >= 2 else f"0{int(secs)}"
+    def fetch_activities(get_headers, after=None, on_page=None):
+        """
+        Fetch the activities started after `after` (all of them if None)
+        with the headers given by `get_headers`. Returns them as a frame,
+        whether every page was retrieved and the throughput of the download.
+        """
+        with tracer.span("fetch activities", "network") as span:
+            activities, complete, stats = fetch_pages(
+                lambda page: fetch_activities_page(get_headers, page, after),
+                per_page=PER_PAGE,
+                on_page=on_page,
+                merge=lambda pages: pl.concat(
+                    [pl.DataFrame(schema=ACTIVITY_SCHEMA), *pages],
+                    how="vertical_relaxed",
+                ),
+            )
+            span.set(rows=activities.height, pages=stats["pages"])
 
-        return f"{mins}:{secs}"
+        return activities, complete, stats
+    return (fetch_activities,)
 
 
-    def get_mt_km_speed_float(v) -> str:
-        mins, secs = _from_mt_s_to_min_km(v)
+@app.cell
+def club(
+    ACTIVITY_SCHEMA,
+    STORE_DIR,
+    concurrent,
+    duration_expr,
+    fetch_activities,
+    load_activity_store,
+    load_rollups,
+    make_auth_headers,
+    make_client,
+    make_executor,
+    pace_expr,
+    pathlib,
+    pl,
+    read_activities_json,
+    save_activity_store,
+    sync_activities,
+    sync_rollups,
+    tracer,
+):
+    # === CLUB ===
+
+    # Club mode is enabled by listing the members in this file, see README
+    CLUB_FILE = pathlib.Path("club.json")
+
+    # Each member is synced into its own store, under this directory
+    CLUB_DIR = STORE_DIR / "club"
+
+    # Members synced at the same time. Their pages are fetched concurrently
+    # as well, every request going through the shared rate limiter
+    CLUB_WORKERS = 4
+
+    # The club views only need these: full activities stay in the stores
+    # and streams are never loaded, whatever the number of members
+    CLUB_COLUMNS = [
+        "id",
+        "sport_type",
+        "start_date",
+        "distance",
+        "moving_time",
+        "elapsed_time",
+        "average_speed",
+    ]
 
-        mins = int(mins) if _get_n_digits(mins) >= 2 else f"0{int(mins)}"
-        secs = int(secs) if _get_n_digits(secs) >= 2 else f"0{int(secs)}"
 
-        return float(f"{mins}.{secs}")
+    def read_export(path):
+        """
+        Activities of a local export: a JSON list of activities as returned
+        by the API, or a Parquet file as saved in a store.
+        """
+        path = pathlib.Path(path)
 
+        if path.suffix == ".parquet":
+            return pl.read_parquet(path)
 
-    def get_average_speed(_df):
-        if _df.height == 0:
-            return 0.0
+        return read_activities_json(path)
 
-        mean_mt_s = _df["average_speed"].mean()
 
-        # Stava returns speed as mt / s
-        # Let's convert it to min / km
+    def sync_member(member, members_dir=CLUB_DIR):
+        """
+        Activities and rollups of a club member, kept in its own store.
 
-        mins, secs = _from_mt_s_to_min_km(mean_mt_s)
+        Members with credentials are synced with Strava, those with an
+        `export` are loaded from it when it changed since the last time,
+        the others are only read from their store.
+        """
+        store_dir = members_dir / member["name"]
+        credentials = {
+            key: value
+            for key, value in member.items()
+            if key not in ("name", "export")
+        }
+
+        if credentials:
+            get_headers = make_auth_headers(make_client(credentials))
+
+            def _fetch(after):
+                activities, complete, _ = fetch_activities(get_headers, after)
+                return activities, complete
+
+            activities, since = sync_activities(
+                _fetch, store_dir, schema=ACTIVITY_SCHEMA
+            )
+            return activities, sync_rollups(activities, since, store_dir)
 
-        secs = int(secs) if _get_n_digits(secs) >= 2 else f"0{int(secs)}"
+        activities, watermark = load_activity_store(store_dir)
+        export = member.get("export")
 
-        return f"{mins}:{secs}"
-    return (
-        get_average_column,
-        get_average_speed,
-        get_column_sum,
-        get_mt_km_speed,
-        get_mt_km_speed_float,
-        get_nice_duration,
-    )
+        if export is not None and (
+            activities is None
+            or pathlib.Path(export).stat().st_mtime
+            > (store_dir / "activities.parquet").stat().st_mtime
+        ):
+            activities = read_export(export)
+            save_activity_store(activities, store_dir)
+            return activities, sync_rollups(activities, None, store_dir)
 
+        if activities is None:
+            raise FileNotFoundError(f"No activities stored in {store_dir}")
 
-@app.cell
-def _(get_end_date, get_start_date, pl, whole_df):
-    # Add 23:59:59 to end date
-    # in order to make it "inclusive"
+        # Nothing changed since the last sync
+        rollups = load_rollups(store_dir)
+        if rollups is None:
+            rollups = sync_rollups(activities, None, store_dir)
 
-    # We filter to keep only running activities.
-    # This can easily be extended to other activity types
-    filtered_df = whole_df.filter(pl.col("sport_type") == "Run").filter(
-        pl.col("start_date").is_between(
-            get_start_date(), get_end_date().replace(hour=23, minute=59, second=59)
-        )
-    )
-    return (filtered_df,)
+        return activities, rollups
 
 
-@app.cell
-def _(activities, pl):
-    whole_df = pl.DataFrame(activities)
+    def ingest_club(
+        members, members_dir=CLUB_DIR, max_workers=CLUB_WORKERS, on_member=None
+    ):
+        """
+        Sync every member concurrently, see `sync_member`. Returns the
+        activities and per day rollup of each member synced, trimmed to
+        what the club views need, and the error of every other member.
+        """
+        synced, errors = {}, {}
 
-    # Add a km column since we'll need that often
-    whole_df = whole_df.with_columns(kms=pl.col("distance") / 1000)
-    return (whole_df,)
+        span = tracer.span("ingest club", "network", members=len(members))
 
+        with span, make_executor(max_workers) as executor:
+            futures = {
+                executor.submit(sync_member, member, members_dir): member["name"]
+                for member in members
+            }
 
-@app.cell
-def _(client, json, mo, requests, time):
-    # === ACTIVITY STREAM FUNCTION ===
-    @mo.cache
-    def fetch_activity_stream(activity_id: str, keys: list[str] | None = None):
-        n_retries = 0
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
 
-        while True:
-            try:
-                streams = client.get_activity_stream(
-                    id=activity_id,
-                    keys=keys,
-                )
-                break  # Success - exit retry loop
+                try:
+                    activities, rollups = future.result()
+                except Exception as e:
+                    errors[name] = e
+                    tracer.count("club member errors")
+                else:
+                    # Members without activities have nothing to show
+                    if activities.height:
+                        synced[name] = (
+                            activities.select(CLUB_COLUMNS),
+                            rollups["day"].drop("id"),
+                        )
 
-            except Exception as e:
-                n_retries += 1
-                if n_retries > 3:
-                    return []
+                if on_member is not None:
+                    on_member(name)
 
-        return streams
+            span.set(rows=sum(frame.height for frame, _ in synced.values()))
 
+        return synced, errors
 
-    @mo.cache
-    def fetch_mocked_activity_stream():
-        url = "https://raw.githubusercontent.com/GiovanniGiacometti/strava-marimo-analyzer/main/mocked_data/mocked_streams.json"
 
-        n_retries = 0
+    def merge_club(synced):
+        """
+        Frames of the whole club from the members synced: activities and
+        per day rollups of every member, with an `athlete` column, and the
+        per day rollup of the club.
 
-        # Retry loop for current page
-        while n_retries <= 3:
-            try:
+        Member frames are sorted by athlete first, so that each member is
+        a partition of them, and then as the frames of a single athlete.
+        """
+        athlete = pl.Enum(sorted(synced))
 
-                # The response is quite big and the request often fails. Thus we set stream=True
-                response = requests.get(url, stream=True)
-                content = b""
-                for chunk in response.iter_content(chunk_size=8192):
-                    content += chunk
-                data = content.decode('utf-8')
+        def _merge(frames):
+            return pl.concat(
+                [
+                    frame.with_columns(athlete=pl.lit(name, dtype=athlete))
+                    for name, frame in frames
+                ],
+                how="vertical_relaxed",
+            )
 
-                return json.loads(data)
+        club_df = (
+            _merge((name, activities) for name, (activities, _) in synced.items())
+            .with_columns(kms=pl.col("distance") / 1000)
+            .sort(
+                "athlete",
+                "sport_type",
+                "start_date",
+                descending=[False, False, True],
+                maintain_order=True,
+            )
+        )
 
-            except Exception as e:
-                n_retries += 1
+        member_days = _merge(
+            (name, days) for name, (_, days) in synced.items()
+        ).sort("athlete", "sport_type", "period")
 
-                if n_retries > 5:
-                    raise
-                else:
-                    wait_time = 2**n_retries
-                    time.sleep(wait_time)
-    return fetch_activity_stream, fetch_mocked_activity_stream
+        club_days = (
+            member_days.group_by("sport_type", "period", "year", "week", "day")
+            .agg(
+                pl.col(
+                    "count", "kms", "moving_time", "elapsed_time", "average_speed_sum"
+                ).sum(),
+                pl.col("start_date").min(),
+            )
+            .sort("sport_type", "period")
+        )
+
+        return club_df, member_days, club_days
+
+
+    def leaderboard(member_days):
+        """
+        Members ranked by kilometers, from a slice of their per day rollups.
+        """
+        return (
+            member_days.group_by("athlete")
+            .agg(pl.col("count", "kms", "moving_time", "average_speed_sum").sum())
+            .sort("kms", "athlete", descending=[True, False])
+            .select(
+                Rank=pl.int_range(1, pl.len() + 1),
+                Athlete=pl.col("athlete").cast(pl.String),
+                Activities="count",
+                Kilometers=pl.col("kms").round(1),
+                **{
+                    "Moving Time": duration_expr(pl.col("moving_time")),
+                    "Average Speed (min/km)": pace_expr(
+                        pl.col("average_speed_sum") / pl.col("count"),
+                        pad_minutes=False,
+                    ),
+                },
+            )
+        )
+    return CLUB_FILE, ingest_club, leaderboard, merge_club
 
 
 @app.cell
 def _(
-    client,
+    ACTIVITY_SCHEMA,
+    build_rollups,
+    build_training_load,
     client_ready,
+    fetch_activities,
+    get_auth_headers,
     load_mocked_activities,
     mo,
+    rate_limiter,
+    read_activities_json,
     requests,
-    strava_client,
+    sync_activities,
+    sync_rollups,
+    sync_training_load,
     time,
 ):
     # === Activities ===
 
+    # Throughput of the last sync, reported below
+    _sync_stats = {}
 
-    @mo.cache
-    def _fetch_activities():
-        n_retries = 0
 
+    def _fetch_activities(after=None):
         with mo.status.spinner(title="Fetching activities...") as _spinner:
-            _spinner.update("Fetching activities...")
-
-            page = 1
-            activities = []
-
-            while True:
-                if page > 30:  # Limit pages to avoid too many requests
-                    break
-
-                # Reset retry counter for each page
-                n_retries = 0
-                page_activities = None
-
-                # Retry loop for current page
-                while n_retries <= 3:
-                    try:
-                        page_activities = client.get_activities(
-                            page=page, per_page=200
-                        )
-                        break  # Success - exit retry loop
-
-                    except Exception as e:
-                        n_retries += 1
-
-                        if n_retries > 3:
-                            break
-                        else:
-                            wait_time = 2**n_retries
-                            time.sleep(wait_time)
 
-                # Check if we successfully got data for this page
-                if page_activities is None:
-                    page += 1
-                    continue
-
-                # Check if page is empty (no more activities)
-                if not page_activities:
-                    break
-
-                # Successfully got activities
-                activities.extend(page_activities)
+            def _report(n_pages, pages_per_s):
+                headroom = rate_limiter.headroom or {}
+                _spinner.update(
+                    f"Fetched {n_pages} pages ({pages_per_s:.1f} pages/s)."
+                    f" Requests left: {headroom.get('15min', '?')} in 15 minutes,"
+                    f" {headroom.get('daily', '?')} today"
+                )
 
-                # Move to next page
-                page += 1
+            activities, complete, stats = fetch_activities(
+                get_auth_headers, after, on_page=_report
+            )
 
-                # Small delay between successful requests
-                time.sleep(0.5)
+        _sync_stats.update(stats)
 
-            return activities
+        return activities, complete
 
 
     @mo.cache
@@ -993,14 +5521,11 @@ def _(
         # Retry loop for current page
         while n_retries <= 3:
             try:
-                activities = requests.get(url).json()
-
-                activities = [
-                    strava_client.models.api.StravaActivity.model_validate_json(
-                        act
-                    )
-                    for act in activities
-                ]
+                # Each activity is stored as a JSON string: they are joined
+                # into a single JSON list, decoded at once
+                activities = read_activities_json(
+                    f"[{','.join(requests.get(url).json())}]".encode()
+                )
 
                 return activities  # Success - exit retry loop
 
@@ -1018,32 +5543,57 @@ def _(
     # wait for the client to be ready
     mo.stop(not client_ready and not load_mocked_activities)
 
+    _sync_report = None
+
     if load_mocked_activities:
         activities = _load_mocked_activities()
+        rollups = build_rollups(activities)
+        training_load = build_training_load(rollups["day"])
     else:
-        # This should be optimized to load only necessary activities
-        activities = _fetch_activities()
-    return (activities,)
+        # Only activities changed since the last session are downloaded
+        activities, _synced_since = sync_activities(
+            _fetch_activities, schema=ACTIVITY_SCHEMA
+        )
+        rollups = sync_rollups(activities, _synced_since)
+        # Resumed from the stored state, only recent days are computed again
+        training_load = sync_training_load(rollups["day"], _synced_since)
+
+        _headroom = rate_limiter.headroom or {}
+        _sync_report = mo.md(
+            f"Synced {_sync_stats['pages']} pages of activities"
+            f" ({_sync_stats['pages_per_s']:.1f} pages/s)."
+            f" Strava requests left: {_headroom.get('15min', '?')} in 15 minutes,"
+            f" {_headroom.get('daily', '?')} today."
+        ).style({"font-size": "small", "opacity": "0.6"})
+
+    _sync_report
+    return activities, rollups, training_load
 
 
 @app.cell
-def _(datetime, mo, pd):
+def _(datetime, mo):
     # == CONSTANTS ==
 
-    min_date = "2025-01-01"
-    max_date = datetime.datetime.today().strftime("%Y-%m-%d")
-    get_start_date, set_start_date = mo.state(pd.to_datetime(min_date))
-    get_end_date, set_end_date = mo.state(pd.to_datetime(max_date))
+    min_date = datetime.datetime(2025, 1, 1)
+    max_date = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    get_start_date, set_start_date = mo.state(min_date)
+    get_end_date, set_end_date = mo.state(max_date)
+
+
+    def _to_datetime(date):
+        # The date inputs give dates, the filters compare datetimes
+        return datetime.datetime.combine(date, datetime.time.min)
+
 
     start_date = mo.ui.date(
         label="Start Date",
         value=get_start_date().strftime("%Y-%m-%d"),
-        on_change=lambda x: set_start_date(pd.to_datetime(x)),
+        on_change=lambda x: set_start_date(_to_datetime(x)),
     )
     end_date = mo.ui.date(
         label="End Date",
         value=get_end_date().strftime("%Y-%m-%d"),
-        on_change=lambda x: set_end_date(pd.to_datetime(x)),
+        on_change=lambda x: set_end_date(_to_datetime(x)),
     )
 
     # Mocked data switch
@@ -1077,65 +5627,96 @@ def _(datetime, mo, pd):
 
 
 @app.cell
-async def _():
+def _():
+    # Standard library only: the first screen waits for this cell
+    import collections
+    import concurrent.futures
+    import datetime
+    import json
+    import os
+    import pathlib
+    import struct
+    import sys
+    import tempfile
+    import threading
+    import time
+    import zlib
+    return (
+        collections,
+        concurrent,
+        datetime,
+        json,
+        os,
+        pathlib,
+        struct,
+        sys,
+        tempfile,
+        threading,
+        time,
+        zlib,
+    )
+
+
+@app.cell
+def _():
+    # Importing marimo alone should make loading the MD blocks faster
+    import marimo as mo
+    return (mo,)
+
+
+@app.cell
+async def _(sys):
+    # Last cell of the notebook: marimo runs independent cells in notebook
+    # order, so the header and the credentials form render before it, and
+    # packages are installed while the form is being filled in.
+
     # =========================================================
     # Necessary when running as a WASM notebook
 
-    import micropip
-
-    await micropip.install("plotly")
-    await micropip.install("python-dotenv")
+    if "pyodide" in sys.modules:
+        import micropip
 
-    # Workaround to make it work with micropip
-    micropip.uninstall("typing-extensions")
-    micropip.uninstall("requests")
+        # Workaround to make it work with micropip
+        micropip.uninstall("typing-extensions")
+        micropip.uninstall("requests")
 
-    await micropip.install("strava-client")
+        # Resolved and downloaded together
+        await micropip.install(["python-dotenv", "strava-client"])
 
     # =========================================================
 
     import strava_client
     from strava_client import client as s_client
-    import plotly
-    import plotly.express as px
     import polars as pl
-    import time
-    import json
 
     from dotenv import load_dotenv
 
     import altair as alt
-    import datetime
-    import pandas as pd
-    import math
     import numpy as np
-    import sys
     import requests
 
-    _ = load_dotenv()
-    return (
-        alt,
-        datetime,
-        json,
-        math,
-        np,
-        pd,
-        pl,
-        plotly,
-        px,
-        requests,
-        s_client,
-        strava_client,
-        sys,
-        time,
-    )
 
+    async def load_plotly():
+        """
+        Plotly, only needed by the Activity Focus tab, which loads it when
+        it is first opened.
+        """
+        if "pyodide" in sys.modules:
+            import importlib.util
 
-@app.cell
-def _():
-    # Importing marimo alone should make loading the MD blocks faster
-    import marimo as mo
-    return (mo,)
+            if importlib.util.find_spec("plotly") is None:
+                import micropip
+
+                await micropip.install("plotly")
+
+        import plotly.colors
+        import plotly.graph_objects
+
+        return plotly
+
+
+    _ = load_dotenv()
+    return alt, load_plotly, np, pl, requests, s_client, strava_client
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+"""
+Benchmark of the activity ingest: pages of the API decoded straight into
+columns, against a model validated for every activity and a frame built
+from the models, as before.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_activity_ingest
+"""
+
+import json
+import timeit
+
+import polars as pl
+import strava_client.models.api
+
+from benchmarks.synthetic import generate_activities
+from engine import load_engine
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def to_api_json(activities, date_format):
+    """
+    Activities as the API returns them, with dates as ISO 8601 strings.
+    """
+    return activities.with_columns(
+        pl.col("start_date", "start_date_local").dt.strftime(date_format)
+    ).write_json()
+
+
+def models_ingest(data):
+    # Previous implementation, one model per activity
+    return pl.DataFrame(
+        [
+            strava_client.models.api.StravaActivity.model_validate(act)
+            for act in json.loads(data)
+        ]
+    )
+
+
+if __name__ == "__main__":
+    engine = load_engine()
+    read_activities_json = engine.read_activities_json
+
+    print(f"{'activities':>10} {'models ms':>10} {'columns ms':>10} {'speedup':>8}")
+
+    for size in SIZES:
+        # Sports the API models accept, as the synthetic ones all are
+        data = to_api_json(generate_activities(size), engine.DATE_FORMAT).encode()
+
+        # Both paths build the same frame, the models keeping the fields
+        # they don't declare, such as the heart rate, last, and leaving out
+        # the optional ones missing from the data, such as the map
+        models = models_ingest(data)
+        assert read_activities_json(data).select(models.columns).equals(models)
+
+        models = min(timeit.repeat(lambda: models_ingest(data), number=1, repeat=3))
+        columns = min(
+            timeit.repeat(lambda: read_activities_json(data), number=1, repeat=3)
+        )
+
+        print(
+            f"{size:>10} {models * 1e3:>10.1f} {columns * 1e3:>10.1f}"
+            f" {models / columns:>7.1f}x"
+        )
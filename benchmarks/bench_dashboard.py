@@ -0,0 +1,219 @@
+"""
+Benchmark of every stage of the dashboard on synthetic histories, from a
+hundred to a million activities and from 500 to 200k samples per stream.
+
+Results are written as JSON, so that they can be compared between commits.
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_dashboard --output before.json
+    uv run python -m benchmarks.bench_dashboard --compare before.json
+"""
+
+import argparse
+import asyncio
+import calendar
+import datetime
+import json
+import pathlib
+import platform
+import subprocess
+import timeit
+
+import altair as alt
+import marimo as mo
+import polars as pl
+
+from app import activity_frame, date_range_filter, heatmap
+from benchmarks.synthetic import END_DATE, generate_activities, generate_stream
+from engine import load_engine
+
+N_ACTIVITIES = [100, 1_000, 10_000, 100_000, 1_000_000]
+
+N_SAMPLES = [500, 5_000, 50_000, 200_000]
+
+# Same budget as the Activity Focus tab
+FOCUS_POINTS = 4000
+
+# Share of the heatmap cells that are selected
+SELECTED_SHARE = 0.05
+
+
+def run_cell(cell, **refs):
+    _, defs = asyncio.run(cell.run(**refs))
+    return dict(defs)
+
+
+def load_functions():
+    """
+    Run the cells holding the dashboard functions, outside of marimo.
+    """
+    functions = vars(load_engine())
+    functions |= run_cell(
+        heatmap,
+        alt=alt,
+        mo=mo,
+        pl=pl,
+        days=dict(enumerate(calendar.day_name, start=1)),
+        tracer=functions["tracer"],
+    )
+
+    return functions
+
+
+def best_of(fn, repeat):
+    """
+    Best time of `fn` in seconds, and its last result.
+    """
+    result = None
+
+    def _run():
+        nonlocal result
+        result = fn()
+
+    return min(timeit.repeat(_run, number=1, repeat=repeat)), result
+
+
+def bench_activities(functions, n_activities, repeat):
+    activities = generate_activities(n_activities)
+    timings = {}
+
+    def _ingest():
+        whole_df = run_cell(activity_frame, activities=activities, pl=pl)["whole_df"]
+        rollups = functions["build_rollups"](activities)
+        return (
+            whole_df,
+            rollups,
+            functions["TimeIndex"](whole_df, "start_date", descending=True),
+            functions["TimeIndex"](rollups["day"], "period"),
+        )
+
+    timings["ingest"], (whole_df, rollups, activity_index, day_index) = best_of(
+        _ingest, repeat
+    )
+
+    # The last year, as when the dashboard opens
+    def _filter():
+        return run_cell(
+            date_range_filter,
+            activity_index=activity_index,
+            build_rollups=functions["build_rollups"],
+            day_index=day_index,
+            get_start_date=lambda: END_DATE - datetime.timedelta(days=365),
+            get_end_date=lambda: END_DATE,
+            pl=pl,
+            route_ids=None,
+            tracer=functions["tracer"],
+        )
+
+    timings["filtered_df"], filtered = best_of(_filter, repeat)
+    filtered_df, filtered_days = filtered["filtered_df"], filtered["filtered_days"]
+
+    timings["heatmap_chart"], chart = best_of(
+        lambda: functions["heatmap_chart"](filtered_days), repeat
+    )
+
+    # What the chart hands back when some cells are selected
+    selection = chart._chart.data.sample(fraction=SELECTED_SHARE, seed=0)
+
+    def _select():
+        selected_days = filtered_days.join(
+            selection.select(start_date="Date"), on="start_date", how="semi"
+        )
+        return selected_days, activity_index.gather(selected_days["id"].explode())
+
+    timings["selection"], _ = best_of(_select, repeat)
+
+    timings["stats"], _ = best_of(
+        lambda: functions["summarize_rollup"](filtered_days), repeat
+    )
+
+    for name in ["bar_chart_speed", "bar_chart_distance"]:
+        timings[name], _ = best_of(
+            lambda: functions[name](filtered_df).to_dict(), repeat
+        )
+
+    return {
+        "rows": {"whole_df": whole_df.height, "filtered_df": filtered_df.height},
+        "seconds": timings,
+    }
+
+
+def bench_streams(functions, n_samples, repeat):
+    stream = generate_stream(n_samples)
+
+    seconds, trace = best_of(
+        lambda: functions["stream_to_trace"](stream, n_points=FOCUS_POINTS), repeat
+    )
+
+    return {"rows": {"trace": trace.height}, "seconds": {"activity_focus": seconds}}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print the ratio of each timing to the same one in `baseline`.
+    """
+    print(f"\nCompared to {baseline['commit']} (> 1 is slower):")
+
+    for kind in ["activities", "streams"]:
+        for size, result in results[kind].items():
+            for stage, seconds in result["seconds"].items():
+                previous = baseline[kind].get(size, {}).get("seconds", {}).get(stage)
+                if previous:
+                    print(f"{stage:>20} {size:>10} {seconds / previous:>8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--activities", type=int, nargs="*", default=N_ACTIVITIES)
+    parser.add_argument("--samples", type=int, nargs="*", default=N_SAMPLES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--compare", type=pathlib.Path)
+    args = parser.parse_args()
+
+    functions = load_functions()
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "activities": {},
+        "streams": {},
+    }
+
+    print(f"{'stage':>20} {'size':>10} {'ms':>10}")
+
+    for n_activities in args.activities:
+        result = bench_activities(functions, n_activities, args.repeat)
+        results["activities"][str(n_activities)] = result
+
+        for stage, seconds in result["seconds"].items():
+            print(f"{stage:>20} {n_activities:>10} {seconds * 1e3:>10.2f}")
+
+    for n_samples in args.samples:
+        result = bench_streams(functions, n_samples, args.repeat)
+        results["streams"][str(n_samples)] = result
+
+        print(
+            f"{'activity_focus':>20} {n_samples:>10}"
+            f" {result['seconds']['activity_focus'] * 1e3:>10.2f}"
+        )
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
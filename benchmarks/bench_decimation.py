@@ -0,0 +1,85 @@
+"""
+Benchmark of the decimation of the Activity Focus traces, LTTB and min-max
+bucketing, on streams much longer than the point budget.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_decimation
+"""
+
+import asyncio
+import timeit
+
+import numpy as np
+
+from app import decimation
+from benchmarks.bench_focus_transform import make_stream
+
+SIZES = [10_000, 100_000, 1_000_000]
+
+N_POINTS = 2_000
+
+
+def reference_lttb(x, y, n_out):
+    # Textbook implementation, one point at a time
+    n = len(x)
+    every = (n - 2) / (n_out - 2)
+    kept = [0]
+
+    for i in range(n_out - 2):
+        low, high = int(i * every) + 1, int((i + 1) * every) + 1
+        next_low, next_high = high, min(int((i + 2) * every) + 1, n - 1)
+
+        if next_low < next_high:
+            next_x = sum(x[next_low:next_high]) / (next_high - next_low)
+            next_y = sum(y[next_low:next_high]) / (next_high - next_low)
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+
+        previous = kept[-1]
+        areas = [
+            abs(
+                (x[previous] - next_x) * (y[j] - y[previous])
+                - (x[previous] - x[j]) * (next_y - y[previous])
+            )
+            for j in range(low, high)
+        ]
+        kept.append(low + int(np.argmax(areas)))
+
+    return np.array(kept + [n - 1])
+
+
+if __name__ == "__main__":
+    _, defs = asyncio.run(decimation.run(np=np))
+    lttb_indices = defs["DECIMATORS"]["lttb"]
+    minmax_indices = defs["DECIMATORS"]["minmax"]
+
+    # Without min-max preselection, LTTB picks the same points as the
+    # textbook implementation
+    stream = make_stream(3 * N_POINTS)
+    x = stream["distance"].cast(float).to_numpy()
+    y = stream["velocity_smooth"].cast(float).to_numpy()
+    assert np.array_equal(lttb_indices(x, y, N_POINTS), reference_lttb(x, y, N_POINTS))
+
+    # However many traces share the budget, they don't exceed it together
+    rng = np.random.default_rng(0)
+    many = [rng.integers(10, 20_000, size) for size in [1, 10, 100]]
+    for lengths in many + [[1_000_000] + [100] * 99]:
+        shares = defs["split_budget"](lengths, N_POINTS)
+        assert shares.sum() <= N_POINTS and (shares <= np.asarray(lengths)).all()
+
+    print(f"{'samples':>10} {'method':>8} {'points':>8} {'ms':>8}")
+
+    for size in SIZES:
+        stream = make_stream(size)
+        x = stream["distance"].cast(float).to_numpy()
+        y = stream["velocity_smooth"].cast(float).to_numpy()
+
+        for name, fn in [("lttb", lttb_indices), ("minmax", minmax_indices)]:
+            kept = fn(x, y, N_POINTS)
+
+            # Extremes survive decimation
+            assert y[kept].max() == y.max() and y[kept].min() == y.min()
+
+            seconds = min(timeit.repeat(lambda: fn(x, y, N_POINTS), number=3, repeat=3))
+            print(f"{size:>10} {name:>8} {len(kept):>8} {seconds / 3 * 1e3:>8.1f}")
@@ -0,0 +1,88 @@
+"""
+Benchmark of the Activity Focus comparison: the streams of the selected
+activities resampled on a shared distance grid in one pass, with the gaps
+to the first one and the speed envelope, against resampling and summarizing
+them one activity at a time.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_focus_compare
+"""
+
+import timeit
+
+import numpy as np
+
+from benchmarks.synthetic import generate_stream
+from engine import load_engine
+
+# Activities compared, up to what the dropdown allows
+SIZES = [10, 30, 100]
+
+
+def per_activity(streams, step, percentiles):
+    # Previous approach, one interpolation per activity and stream
+    lengths, resampled = [], []
+
+    for stream in streams:
+        distance = np.maximum.accumulate(stream["distance"].to_numpy().astype(float))
+        time = stream["time"].to_numpy().astype(float)
+        lengths.append(distance[-1] - distance[0])
+        resampled.append((distance - distance[0], time - time[0], stream))
+
+    grid = np.arange(max(lengths) // step + 1) * step
+    times = np.full((len(streams), len(grid)), np.nan)
+    velocities = np.full((len(streams), len(grid)), np.nan)
+
+    for i, (distance, time, stream) in enumerate(resampled):
+        reached = grid <= lengths[i]
+        velocity = stream["velocity_smooth"].to_numpy().astype(float)
+        times[i, reached] = np.interp(grid[reached], distance, time)
+        velocities[i, reached] = np.interp(grid[reached], distance, velocity)
+
+    gaps = times - times[:1]
+    low, high = np.nanpercentile(velocities, percentiles, axis=0)
+
+    return gaps, np.nanmean(velocities, axis=0), low, high
+
+
+def one_pass(engine, streams):
+    grid, times, velocities = engine.resample_streams(streams)
+    return engine.compare_streams(grid, times, velocities)
+
+
+if __name__ == "__main__":
+    engine = load_engine()
+    step, percentiles = engine.GRID_STEP, engine.ENVELOPE_PERCENTILES
+
+    print(
+        f"{'activities':>10} {'per activity ms':>16} {'one pass ms':>12}"
+        f" {'speedup':>8}"
+    )
+
+    for size in SIZES:
+        # Runs of 45 minutes to 2 hours, sampled every second
+        streams = [
+            generate_stream(2_700 + 45 * i, seed=i) for i in range(size)
+        ]
+
+        # Both find the same gaps and envelope
+        gaps, mean, low, high = per_activity(streams, step, percentiles)
+        one_gaps, band = one_pass(engine, streams)
+        assert np.allclose(gaps, one_gaps, equal_nan=True)
+        assert np.allclose(mean, band["mean"]) and np.allclose(low, band["low"])
+        assert np.allclose(high, band["high"])
+
+        looped = min(
+            timeit.repeat(
+                lambda: per_activity(streams, step, percentiles), number=1, repeat=5
+            )
+        )
+        vectorized = min(
+            timeit.repeat(lambda: one_pass(engine, streams), number=1, repeat=5)
+        )
+
+        print(
+            f"{size:>10} {looped * 1e3:>16.1f} {vectorized * 1e3:>12.1f}"
+            f" {looped / vectorized:>7.1f}x"
+        )
@@ -0,0 +1,102 @@
+"""
+Microbenchmark of the stream to trace transformation of the Activity Focus
+tab, against the per-sample python implementation it replaced.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_focus_transform
+"""
+
+import math
+import timeit
+
+import numpy as np
+import polars as pl
+
+from engine import load_engine
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def _get_n_digits(_n):
+    if _n == 0:
+        return 1
+
+    return int(math.log10(_n)) + 1
+
+
+def _get_mt_km_speed(v) -> str:
+    min_per_km_dec = 1 / (v * 0.06) if v else 0
+    mins, secs = int(min_per_km_dec), min_per_km_dec % 1 * 60
+
+    mins = int(mins) if _get_n_digits(mins) >= 2 else f"0{int(mins)}"
+    secs = int(secs) if _get_n_digits(secs) >= 2 else f"0{int(secs)}"
+
+    return f"{mins}:{secs}"
+
+
+def legacy_stream_to_trace(stream):
+    # What activity_focus used to do, one sample at a time
+    df = pl.DataFrame(
+        {
+            "Distance": list(
+                map(lambda x: round(x / 1000, 2), stream["distance"][::3])
+            ),
+            "Velocity (minkm)": list(
+                map(_get_mt_km_speed, stream["velocity_smooth"][::3])
+            ),
+            "Velocity": stream["velocity_smooth"][::3],
+        }
+    )
+
+    return df.filter(pl.col("Velocity") >= 1.0)
+
+
+def make_stream(size, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # Run at about 3 m/s with some noise and a few stops
+    velocity = np.clip(rng.normal(3.0, 0.5, size), 0.0, None)
+    velocity[rng.random(size) < 0.02] = 0.0
+
+    return pl.DataFrame(
+        {
+            "distance": np.cumsum(velocity).astype(np.float32),
+            "velocity_smooth": velocity.astype(np.float32),
+        }
+    )
+
+
+if __name__ == "__main__":
+    defs = vars(load_engine())
+
+    def stream_to_trace(stream):
+        # The same stride, without decimation
+        return defs["stream_to_trace"](stream.gather_every(3))
+
+    print(f"{'samples':>10} {'legacy (ns/sample)':>20} {'polars (ns/sample)':>20}")
+
+    for size in SIZES:
+        stream = make_stream(size)
+
+        # Both implementations must plot the same thing. Distances can
+        # differ by a rounding unit on ties, python rounds the exact binary
+        # value while polars rounds half away from zero
+        legacy = legacy_stream_to_trace(stream)
+        trace = stream_to_trace(stream)
+        assert legacy["Velocity (minkm)"].equals(trace["Velocity (minkm)"])
+        assert np.allclose(legacy["Distance"], trace["Distance"], rtol=0, atol=0.0101)
+
+        number = max(1, 200_000 // size)
+        timings = {
+            name: min(timeit.repeat(lambda: fn(stream), number=number, repeat=5))
+            / number
+            / size
+            * 1e9
+            for name, fn in [
+                ("legacy", legacy_stream_to_trace),
+                ("polars", stream_to_trace),
+            ]
+        }
+
+        print(f"{size:>10} {timings['legacy']:>20.1f} {timings['polars']:>20.1f}")
@@ -0,0 +1,64 @@
+"""
+Microbenchmark of the mean-maximal pace curve of a run, against comparing
+every pair of samples.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_pace_curve
+"""
+
+import timeit
+
+import numpy as np
+
+from benchmarks.synthetic import generate_stream
+from engine import load_engine
+
+# A 30 minute, a 1 hour and a 3 hour run, sampled every second
+SIZES = [1_800, 3_600, 10_800]
+
+
+def pairwise_speeds(stream, durations):
+    # Every window starting at a sample, its end interpolated: O(n²)
+    time = stream["time"].to_numpy().astype(np.float64)
+    distance = np.maximum.accumulate(stream["distance"].to_numpy().astype(np.float64))
+    durations = np.asarray(durations, dtype=np.float64)
+    best = np.full(len(durations), np.nan)
+
+    for start in range(len(time)):
+        elapsed = time[start:] - time[start]
+        fits = durations <= elapsed[-1]
+        gained = np.interp(durations[fits], elapsed, distance[start:]) - distance[start]
+        best[fits] = np.fmax(best[fits], gained / durations[fits])
+
+    return best
+
+
+if __name__ == "__main__":
+    engine = load_engine()
+    durations = engine.CURVE_DURATIONS
+
+    print(f"{'samples':>10} {'pairwise ms':>12} {'envelope ms':>12} {'speedup':>8}")
+
+    for size in SIZES:
+        stream = generate_stream(size)
+
+        # Both find the same curve, durations longer than the run being null
+        curve = engine.mean_max_speeds(stream, durations)["speed"].to_numpy()
+        assert np.allclose(curve, pairwise_speeds(stream, durations), equal_nan=True)
+
+        pairwise = min(
+            timeit.repeat(
+                lambda: pairwise_speeds(stream, durations), number=1, repeat=3
+            )
+        )
+        envelope = min(
+            timeit.repeat(
+                lambda: engine.mean_max_speeds(stream, durations), number=1, repeat=3
+            )
+        )
+
+        print(
+            f"{size:>10} {pairwise * 1e3:>12.1f} {envelope * 1e3:>12.1f}"
+            f" {pairwise / envelope:>7.1f}x"
+        )
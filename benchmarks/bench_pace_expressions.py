@@ -0,0 +1,149 @@
+"""
+Benchmark of the pace and duration formatting expressions against the
+python functions previously called on every value through map_elements.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_pace_expressions
+"""
+
+import asyncio
+import math
+import time
+
+import numpy as np
+import polars as pl
+
+from app import formatting
+
+N_ROWS = 1_000_000
+
+
+# === Previous python implementation ===
+
+
+def _get_n_digits(_n):
+    if _n == 0:
+        return 1
+
+    return int(math.log10(_n)) + 1
+
+
+def _from_mt_s_to_min_km(v) -> tuple[int, int]:
+    if v == 0:
+        return 0, 0
+
+    min_per_km_dec = 1 / (v * 0.06)
+
+    return int(min_per_km_dec), min_per_km_dec % 1 * 60
+
+
+def get_mt_km_speed(v) -> str:
+    mins, secs = _from_mt_s_to_min_km(v)
+
+    mins = int(mins) if _get_n_digits(mins) >= 2 else f"0{int(mins)}"
+    secs = int(secs) if _get_n_digits(secs) >= 2 else f"0{int(secs)}"
+
+    return f"{mins}:{secs}"
+
+
+def get_mt_km_speed_tick(v) -> str:
+    mins, secs = _from_mt_s_to_min_km(v)
+
+    mins = int(mins) if _get_n_digits(mins) >= 2 else f"0{int(mins)}"
+    secs = int(secs) if _get_n_digits(secs) >= 2 else f"0{int(secs)}"
+
+    return f"{float(f'{mins}.{secs}'):.2f}"
+
+
+def get_nice_duration(_seconds):
+    secs = int(_seconds)
+
+    hours = secs // 3600
+    minutes = secs % 3600 // 60
+    seconds = secs % 3600 % 60
+
+    hours = hours if _get_n_digits(hours) >= 2 else f"0{hours}"
+    minutes = minutes if _get_n_digits(minutes) >= 2 else f"0{minutes}"
+    seconds = seconds if _get_n_digits(seconds) >= 2 else f"0{seconds}"
+
+    return f"{hours}:{minutes}:{seconds}"
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    _, defs = asyncio.run(formatting.run(pl=pl))
+    pace_expr, duration_expr = defs["pace_expr"], defs["duration_expr"]
+
+    rng = np.random.default_rng(0)
+
+    # Speeds from a slow walk to a sprint, a few stops, and durations
+    # up to a couple of days
+    speeds = rng.uniform(0.5, 8.0, N_ROWS)
+    speeds[rng.random(N_ROWS) < 0.01] = 0.0
+    df = pl.DataFrame(
+        {
+            "speed": speeds,
+            "speed_f32": speeds.astype(np.float32),
+            "seconds": rng.uniform(0, 200_000, N_ROWS),
+        }
+    )
+
+    cases = [
+        (
+            "pace",
+            lambda: df.select(
+                pl.col("speed").map_elements(get_mt_km_speed, return_dtype=pl.String)
+            ),
+            lambda: df.select(pace_expr(pl.col("speed"))),
+        ),
+        (
+            "pace (float32)",
+            lambda: df.select(
+                pl.col("speed_f32").map_elements(
+                    get_mt_km_speed, return_dtype=pl.String
+                )
+            ),
+            lambda: df.select(pace_expr(pl.col("speed_f32"))),
+        ),
+        (
+            "pace tick label",
+            lambda: df.select(
+                pl.col("speed").map_elements(
+                    get_mt_km_speed_tick, return_dtype=pl.String
+                )
+            ),
+            lambda: df.select(
+                pace_expr(pl.col("speed"), pad_minutes=False, separator=".")
+            ),
+        ),
+        (
+            "duration",
+            lambda: df.select(
+                pl.col("seconds").map_elements(
+                    get_nice_duration, return_dtype=pl.String
+                )
+            ),
+            lambda: df.select(duration_expr(pl.col("seconds"))),
+        ),
+    ]
+
+    print(f"{N_ROWS:,} rows")
+    print(f"{'':>16} {'map_elements (s)':>18} {'expression (s)':>16} {'speedup':>8}")
+
+    for name, udf, expression in cases:
+        expected, udf_time = _timed(udf)
+        result, expression_time = _timed(expression)
+
+        # The output must be exactly the same
+        assert expected.to_series().equals(result.to_series(), check_names=False)
+
+        print(
+            f"{name:>16} {udf_time:>18.3f} {expression_time:>16.3f}"
+            f" {udf_time / expression_time:>7.0f}x"
+        )
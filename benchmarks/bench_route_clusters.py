@@ -0,0 +1,81 @@
+"""
+Benchmark of the route clustering: runs are only compared to the routes
+starting and ending near them, found by hashing, against comparing each run
+to every route found so far.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_route_clusters
+"""
+
+import timeit
+
+import polars as pl
+
+from benchmarks.synthetic import add_routes, generate_activities
+from engine import load_engine
+
+SIZES = [1_000, 2_000, 4_000]
+
+
+def compare_all(engine, tracks):
+    # Each run against the first run of every route, lengths aside
+    signatures, routes = [], []
+
+    for _, latlng in tracks:
+        if latlng is None or len(latlng) < 2:
+            routes.append(None)
+            continue
+
+        signature = engine.track_signature(latlng)
+        best, best_similarity = None, engine.ROUTE_SIMILARITY
+
+        for route, other in enumerate(signatures):
+            lengths = sorted([signature["length"], other["length"]])
+            if lengths[0] < engine.ROUTE_LENGTH_RATIO * lengths[1]:
+                continue
+
+            similarity = engine.track_similarity(signature, other)
+            if similarity >= best_similarity:
+                best, best_similarity = route, similarity
+
+        if best is None:
+            best = len(signatures)
+            signatures.append(signature)
+
+        routes.append(best)
+
+    return routes
+
+
+if __name__ == "__main__":
+    engine = load_engine()
+
+    print(
+        f"{'activities':>10} {'routes':>8} {'all ms':>10} {'hashed ms':>10}"
+        f" {'speedup':>8}"
+    )
+
+    for size in SIZES:
+        tracks = engine.activity_tracks(add_routes(generate_activities(size)))
+        empty = pl.DataFrame(schema=engine.SIGNATURES_SCHEMA)
+
+        routes, signatures = engine.assign_routes(tracks, empty)
+
+        # Both group the runs the same way, routes being numbered differently
+        pairs = set(zip(compare_all(engine, tracks), routes["route"].to_list()))
+        assert len(pairs) == signatures.height
+
+        compared = min(
+            timeit.repeat(lambda: compare_all(engine, tracks), number=1, repeat=1)
+        )
+        hashed = min(
+            timeit.repeat(
+                lambda: engine.assign_routes(tracks, empty), number=1, repeat=3
+            )
+        )
+
+        print(
+            f"{size:>10} {signatures.height:>8} {compared * 1e3:>10.0f}"
+            f" {hashed * 1e3:>10.0f} {compared / hashed:>7.1f}x"
+        )
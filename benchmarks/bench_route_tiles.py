@@ -0,0 +1,119 @@
+"""
+Benchmark of the route tiles: rasterizing a history of GPS streams into the
+tile pyramid batch by batch, as the dashboard does, updating the stored
+tiles with new runs, and reading the view of the map.
+
+Streams are generated a batch at a time, so that the memory used is that of
+the tiles, not of the points. Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_route_tiles --points 10000000
+"""
+
+import argparse
+import resource
+import tempfile
+import time
+import pathlib
+
+import numpy as np
+import polars as pl
+
+from benchmarks.synthetic import HOME, generate_stream
+from engine import load_engine
+
+# Samples per run, an hour at one per second
+RUN_SAMPLES = 3600
+
+
+def make_get_streams(seed):
+    def _get_streams(activity_ids):
+        for activity_id in activity_ids:
+            yield activity_id, generate_stream(RUN_SAMPLES, seed=seed + activity_id)
+
+    return _get_streams
+
+
+def check_shared_pixels(engine, store_dir):
+    # Two runs over the same track, rasterized apart as batches or backfill
+    # chunks are, count every point once at every zoom
+    latlng = generate_stream(400, seed=0)["latlng"].to_numpy()
+    pixels = pl.concat([engine.rasterize(latlng), engine.rasterize(latlng)])
+    activities = pl.DataFrame({"id": [0, 1], "sport_type": "Run", "start_date": [0, 1]})
+
+    engine.update_tiles(pixels, [0, 1], activities, store_dir)
+    pyramid = engine.load_tiles(store_dir)
+
+    for zoom in range(engine.MIN_ZOOM, engine.MAX_ZOOM + 1):
+        counts = pl.concat([block.collect() for block in pyramid[zoom].values()])
+        assert counts["count"].sum() == 2 * len(latlng), zoom
+        assert not counts.select("x", "y").is_duplicated().any(), zoom
+
+
+def max_rss_mb():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--points", type=int, default=10_000_000)
+    parser.add_argument("--new-runs", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = load_engine()
+    n_runs = args.points // RUN_SAMPLES
+    activities = pl.DataFrame(
+        {
+            "id": range(n_runs + args.new_runs),
+            "sport_type": "Run",
+            "start_date": range(n_runs + args.new_runs),
+        }
+    )
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        check_shared_pixels(engine, pathlib.Path(store_dir))
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_dir = pathlib.Path(store_dir)
+        rss = max_rss_mb()
+
+        start = time.perf_counter()
+        engine.sync_tiles(
+            activities.head(n_runs), make_get_streams(0), store_dir=store_dir
+        )
+        build = time.perf_counter() - start
+
+        blocks = engine.load_tiles(store_dir)[engine.MAX_ZOOM].values()
+        pixels = sum(block.select(pl.len()).collect().item() for block in blocks)
+        print(
+            f"{n_runs} runs, {n_runs * RUN_SAMPLES / 1e6:.1f}M points:"
+            f" {build:.1f} s, {n_runs * RUN_SAMPLES / build / 1e6:.1f}M points/s,"
+            f" {pixels} pixels at zoom {engine.MAX_ZOOM},"
+            f" +{max_rss_mb() - rss:.0f} MB peak memory"
+        )
+
+        start = time.perf_counter()
+        engine.sync_tiles(activities, make_get_streams(0), store_dir=store_dir)
+        print(
+            f"{args.new_runs} new runs: {time.perf_counter() - start:.2f} s,"
+            " streams of the others not read"
+        )
+
+        pyramid = engine.load_tiles(store_dir)
+        print(f"{'zoom':>6} {'view ms':>10} {'png ms':>10} {'png kB':>10}")
+
+        for zoom in range(engine.MIN_ZOOM, engine.MAX_ZOOM + 1):
+            start = time.perf_counter()
+            grid = engine.density_grid(pyramid, zoom, HOME, 960, 600)
+            view = time.perf_counter() - start
+
+            start = time.perf_counter()
+            png = engine.density_png(grid)
+            encode = time.perf_counter() - start
+
+            print(
+                f"{zoom:>6} {view * 1e3:>10.1f} {encode * 1e3:>10.1f}"
+                f" {len(png) / 1e3:>10.1f}"
+            )
+
+        assert np.any(grid)
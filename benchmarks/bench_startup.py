@@ -0,0 +1,151 @@
+"""
+Benchmark of the cold start of the notebook: time to the first render (the
+header and, in the browser, the credentials form), time until the packages
+of the dashboard are loaded, and time to load plotly when the Activity Focus
+tab is opened.
+
+Startup cells are run in the order marimo runs them, each measurement in a
+fresh interpreter. The first render is compared to importing everything the
+notebook used to import before rendering anything. Run it from the root of
+the repository:
+
+    uv run python -m benchmarks.bench_startup
+
+Under Pyodide there are no subprocesses, so it measures the running
+interpreter: run it first thing in a fresh Pyodide console, with marimo
+installed and the repository in the working directory, where the packages
+cell also installs packages with micropip:
+
+    import benchmarks.bench_startup
+    await benchmarks.bench_startup.main()
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+START = time.perf_counter()
+
+# What the notebook imported before rendering anything, when all of its
+# imports were in a single cell
+EAGER_IMPORTS = [
+    "marimo",
+    "strava_client",
+    "plotly",
+    "plotly.express",
+    "polars",
+    "dotenv",
+    "altair",
+    "pandas",
+    "numpy",
+    "requests",
+]
+
+# Defined by the cell importing the packages of the dashboard
+PACKAGES_DEF = "pl"
+
+
+async def measure_startup():
+    """
+    Seconds from the start of the interpreter to the end of each startup
+    stage, in this interpreter.
+    """
+    import app
+    from marimo._runtime.dataflow import topological_sort
+
+    timings = {"import marimo": time.perf_counter() - START}
+
+    app.app._maybe_initialize()
+    graph = app.app._graph
+    cells = {data.cell_id: data.cell for data in app.app._cell_manager.cell_data()}
+
+    (packages_id,) = graph.get_defining_cells(PACKAGES_DEF)
+    # Everything not waiting on the packages renders first
+    first_screen = set(graph.cells) - graph.descendants(packages_id) - {packages_id}
+
+    namespace = {}
+
+    for cell_id in topological_sort(graph, first_screen | {packages_id}):
+        if cell_id == packages_id:
+            timings["first render"] = time.perf_counter() - START
+
+        cell = cells[cell_id]
+        result = cell.run(
+            **{ref: namespace[ref] for ref in cell.refs if ref in namespace}
+        )
+        if inspect.isawaitable(result):
+            result = await result
+        namespace.update(result[1])
+
+    timings["packages"] = time.perf_counter() - START
+
+    # Plotly imports its figure classes when they are first used
+    start = time.perf_counter()
+    plotly = await namespace["load_plotly"]()
+    plotly.graph_objects.Figure(plotly.graph_objects.Scatter())
+    timings["plotly (focus tab)"] = time.perf_counter() - start
+
+    return timings
+
+
+def measure_eager():
+    """
+    Seconds from the start of the interpreter to the end of the imports the
+    notebook used to run before its first render.
+    """
+    for module in EAGER_IMPORTS:
+        __import__(module)
+
+    return {"eager imports": time.perf_counter() - START}
+
+
+def run_fresh(mode):
+    """
+    Timings of `mode`, measured in a fresh interpreter.
+    """
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_startup", "--child", mode],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def report(runs):
+    print(f"{'stage':>20} {'median ms':>10} {'min ms':>10}")
+
+    for stage in runs[0]:
+        seconds = [run[stage] for run in runs]
+        print(
+            f"{stage:>20} {statistics.median(seconds) * 1e3:>10.1f}"
+            f" {min(seconds) * 1e3:>10.1f}"
+        )
+
+
+async def main(repeat=5):
+    if sys.platform == "emscripten":
+        report([await measure_startup()])
+        return
+
+    runs = [run_fresh("startup") | run_fresh("eager") for _ in range(repeat)]
+    report(runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--child", choices=["startup", "eager"])
+    args = parser.parse_args()
+
+    if args.child == "startup":
+        print(json.dumps(asyncio.run(measure_startup())))
+    elif args.child == "eager":
+        print(json.dumps(measure_eager()))
+    else:
+        asyncio.run(main(args.repeat))
@@ -0,0 +1,70 @@
+"""
+Benchmark of the stream cache over a long browsing session: streams of
+activities opened again and again, with different keys, kept in a bounded
+cache against kept forever, as the fetched streams used to be.
+
+Run it from the root of the repository:
+
+    uv run python -m benchmarks.bench_stream_cache --activities 2000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_stream
+from engine import load_engine
+
+# Keys asked for by the tabs of the dashboard
+TAB_KEYS = [
+    ["time", "distance", "velocity_smooth"],
+    ["time", "distance"],
+    ["latlng"],
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--activities", type=int, default=2_000)
+    parser.add_argument("--opens", type=int, default=20_000)
+    parser.add_argument("--max-mb", type=int, default=32)
+    args = parser.parse_args()
+
+    engine = load_engine()
+    streams = {
+        activity_id: generate_stream(3_600, seed=activity_id)
+        for activity_id in range(args.activities)
+    }
+
+    # Recent activities are opened much more often than old ones
+    rng = np.random.default_rng(0)
+    opened = (
+        rng.geometric(20 / args.activities, args.opens).clip(max=args.activities) - 1
+    )
+    asked = rng.integers(len(TAB_KEYS), size=args.opens)
+
+    cache = engine.StreamCache(args.max_mb * 2**20)
+
+    start = time.perf_counter()
+    for activity_id, tab in zip(opened.tolist(), asked.tolist()):
+        keys = TAB_KEYS[tab]
+        if cache.get(activity_id, keys) is None:
+            cache.put(activity_id, streams[activity_id])
+    elapsed = time.perf_counter() - start
+
+    kept = {activity_id: streams[activity_id] for activity_id in opened.tolist()}
+    unbounded = sum(stream.estimated_size() for stream in kept.values())
+
+    stats = cache.stats
+    print(
+        f"{args.opens} opens of {len(kept)} activities:"
+        f" {elapsed / args.opens * 1e6:.1f} us per open,"
+        f" {stats['hits'] / args.opens:.0%} hits, {stats['evictions']} evictions"
+    )
+    print(
+        f"memory held: {cache.size / 2**20:.1f} MB bounded,"
+        f" {unbounded / 2**20:.1f} MB kept forever"
+    )
+
+    assert cache.size <= cache.max_bytes
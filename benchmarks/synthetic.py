@@ -0,0 +1,247 @@
+"""
+Synthetic Strava activities and streams, shaped like what the dashboard
+gets from the API, to benchmark it on histories much longer than the
+mocked data.
+
+Activities are generated as a polars DataFrame with the same schema as
+`pl.DataFrame(activities)` in the notebook, streams with the schema they
+are stored with.
+"""
+
+import datetime
+
+import numpy as np
+import polars as pl
+
+# Share of the activities, distance in km (median) and speed in m/s
+SPORTS = {
+    "Run": (0.75, 10.0, 3.1),
+    "Ride": (0.10, 40.0, 7.5),
+    "Walk": (0.10, 5.0, 1.4),
+    "Workout": (0.05, 0.0, 0.0),
+}
+
+# Histories longer than this get more activities per day instead
+MAX_YEARS = 30
+
+ACTIVITIES_PER_DAY = 0.8
+
+END_DATE = datetime.datetime(2025, 6, 30)
+
+# Somewhere in Milan
+HOME = (45.46, 9.19)
+
+
+def generate_activities(n_activities, seed=0, end_date=END_DATE):
+    """
+    Generate `n_activities` activities ending at `end_date`, newest first
+    as returned by the API.
+    """
+    rng = np.random.default_rng(seed)
+
+    n_days = min(n_activities / ACTIVITIES_PER_DAY, MAX_YEARS * 365)
+
+    # Mornings and evenings, mostly
+    hours = np.where(rng.random(n_activities) < 0.4, 7.0, 18.0)
+    seconds_ago = (
+        rng.integers(0, int(n_days), n_activities) * 86400
+        + (24 - hours - rng.normal(0, 1.5, n_activities)).clip(0, 24) * 3600
+    ).astype(np.int64)
+    seconds_ago.sort()
+
+    names = list(SPORTS)
+    shares = np.array([SPORTS[name][0] for name in names])
+    sport = rng.choice(len(names), n_activities, p=shares / shares.sum())
+    median_km = np.array([SPORTS[name][1] for name in names])[sport]
+    median_speed = np.array([SPORTS[name][2] for name in names])[sport]
+
+    distance = (median_km * 1000 * rng.lognormal(0, 0.35, n_activities)).round(1)
+    average_speed = (median_speed * rng.normal(1, 0.08, n_activities)).clip(0)
+    moving_time = np.where(
+        average_speed > 0,
+        distance / np.where(average_speed > 0, average_speed, 1),
+        rng.normal(2700, 600, n_activities).clip(600),
+    ).astype(np.int64)
+    elapsed_time = (moving_time * rng.uniform(1.0, 1.15, n_activities)).astype(np.int64)
+
+    start_lat = HOME[0] + rng.normal(0, 0.02, n_activities)
+    start_lng = HOME[1] + rng.normal(0, 0.02, n_activities)
+    elev_low = rng.normal(120, 5, n_activities).round(1)
+
+    end = pl.lit(end_date)
+
+    return pl.DataFrame(
+        {
+            # Strava ids grow with time
+            "id": 10_000_000_000 + np.arange(n_activities, 0, -1),
+            "name": pl.Series(sport).replace_strict(
+                dict(enumerate(names)), return_dtype=pl.String
+            ),
+            "athlete_id": np.ones(n_activities, dtype=np.int64),
+            "distance": distance,
+            "moving_time": moving_time,
+            "elapsed_time": elapsed_time,
+            "total_elevation_gain": rng.gamma(2, 10, n_activities).round(1),
+            "elev_high": elev_low + rng.gamma(2, 5, n_activities).round(1),
+            "elev_low": elev_low,
+            "seconds_ago": seconds_ago,
+            "average_speed": average_speed.round(3),
+            "max_speed": (average_speed * rng.uniform(1.3, 2.0, n_activities)).round(3),
+            # Harder efforts, higher heart rates
+            "average_heartrate": (
+                110 + 12 * average_speed + rng.normal(0, 5, n_activities)
+            ).round(1),
+            "start_lat": start_lat,
+            "start_lng": start_lng,
+            "end_lat": start_lat + rng.normal(0, 0.001, n_activities),
+            "end_lng": start_lng + rng.normal(0, 0.001, n_activities),
+        }
+    ).select(
+        "id",
+        external_id=pl.lit(None, dtype=pl.String),
+        name=pl.concat_str(pl.col("name"), pl.lit(" "), pl.col("id")),
+        athlete=pl.struct(id="athlete_id"),
+        distance="distance",
+        moving_time="moving_time",
+        elapsed_time="elapsed_time",
+        total_elevation_gain="total_elevation_gain",
+        elev_high="elev_high",
+        elev_low="elev_low",
+        sport_type="name",
+        start_date=end - pl.duration(seconds="seconds_ago"),
+        start_date_local=end
+        - pl.duration(seconds="seconds_ago")
+        + pl.duration(hours=1),
+        timezone=pl.lit("(GMT+01:00) Europe/Rome"),
+        average_speed="average_speed",
+        max_speed="max_speed",
+        average_heartrate="average_heartrate",
+        start_latlng=pl.concat_list("start_lat", "start_lng"),
+        end_latlng=pl.concat_list("end_lat", "end_lng"),
+    )
+
+
+def generate_stream(n_samples, seed=0, speed=3.1):
+    """
+    Generate the streams of an activity sampled every second, with pace
+    variations, a few stops and a wandering GPS track.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Pace drifts around the average speed, with short stops
+    drift = np.zeros(n_samples)
+    noise = rng.normal(0, 0.05, n_samples)
+    for start in range(0, n_samples, 1024):
+        # Blocked to keep the recursion vectorized: x[t] = 0.99 x[t-1] + e
+        block = noise[start : start + 1024]
+        decay = 0.99 ** np.arange(len(block))
+        previous = 0.99 * drift[start - 1] if start else 0.0
+        drift[start : start + len(block)] = decay * (
+            previous + np.cumsum(block / decay)
+        )
+
+    velocity = (speed + drift).clip(0.5)
+    stopped = np.repeat(rng.random(n_samples // 60 + 1) < 0.03, 60)[:n_samples]
+    velocity[stopped] = 0.0
+
+    heading = np.cumsum(rng.normal(0, 0.05, n_samples))
+    meters_per_degree = 111_000
+
+    return pl.DataFrame(
+        {
+            "time": np.arange(n_samples, dtype=np.int32),
+            "distance": np.cumsum(velocity).astype(np.float32),
+            "velocity_smooth": velocity.astype(np.float32),
+            "heartrate": (120 + 12 * velocity + rng.normal(0, 3, n_samples)).astype(
+                np.int16
+            ),
+            "latlng": np.stack(
+                [
+                    HOME[0] + np.cumsum(velocity * np.cos(heading)) / meters_per_degree,
+                    HOME[1] + np.cumsum(velocity * np.sin(heading)) / meters_per_degree,
+                ],
+                axis=1,
+            ),
+        },
+        schema_overrides={"latlng": pl.Array(pl.Float64, 2)},
+    )
+
+
+def encode_polylines(tracks):
+    """
+    Encode `(n, 2)` arrays of latitudes and longitudes as polylines, as
+    in the summaries of activities.
+    """
+    tracks = [np.round(np.asarray(track) * 1e5).astype(np.int64) for track in tracks]
+    lengths = np.array([2 * len(track) for track in tracks])
+
+    deltas = np.concatenate(
+        [np.diff(track, axis=0, prepend=0).ravel() for track in tracks]
+    )
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # Chunks of 5 bits, low ones first, all but the last flagged with 0x20
+    chunks = np.arange(7)
+    n_chunks = 1 + ((values[:, None] >> (5 * chunks[1:])) > 0).sum(axis=1)
+    bits = (values[:, None] >> (5 * chunks)) & 0x1F
+    flags = np.where(chunks < n_chunks[:, None] - 1, 0x20, 0)
+    chars = (bits | flags) + 63
+
+    encoded = chars[chunks < n_chunks[:, None]].astype(np.uint8).tobytes().decode()
+    sizes = np.add.reduceat(n_chunks, np.cumsum(lengths) - lengths)
+
+    return [
+        encoded[start : start + size]
+        for start, size in zip(np.cumsum(sizes) - sizes, sizes)
+    ]
+
+
+def add_routes(activities, n_routes=50, one_off=0.2, seed=0):
+    """
+    Add the summary polylines of the runs of `activities`: most of them
+    follow one of `n_routes` loops around HOME, the `one_off` share goes
+    anywhere. Other activities have none.
+    """
+    rng = np.random.default_rng(seed)
+
+    def _loop(n_points, start):
+        # A wandering walk, closed back to where it started
+        heading = np.cumsum(rng.normal(0, 0.3, n_points))
+        steps = np.stack([np.cos(heading), np.sin(heading)], axis=1) * 0.001
+        track = np.cumsum(steps, axis=0)
+        track -= np.linspace(0, 1, n_points)[:, None] * track[-1]
+        return start + track
+
+    routes = [
+        _loop(rng.integers(30, 200), np.array(HOME) + rng.normal(0, 0.02, 2))
+        for _ in range(n_routes)
+    ]
+
+    is_run = (activities["sport_type"] == "Run").to_numpy()
+    tracks = []
+
+    for run in is_run:
+        if not run:
+            continue
+
+        if rng.random() < one_off:
+            track = _loop(
+                rng.integers(30, 200), np.array(HOME) + rng.normal(0, 0.02, 2)
+            )
+        else:
+            # GPS noise of a few meters
+            track = routes[rng.integers(n_routes)]
+            track = track + rng.normal(0, 0.00003, track.shape)
+
+        tracks.append(track)
+
+    polylines = iter(encode_polylines(tracks))
+
+    return activities.with_columns(
+        map=pl.struct(
+            summary_polyline=pl.Series(
+                [next(polylines) if run else None for run in is_run],
+                dtype=pl.String,
+            )
+        )
+    )
@@ -0,0 +1,144 @@
+"""
+The data pipeline of the dashboard, without the dashboard.
+
+The functions live in named cells of `app.py`: they are run here outside of
+marimo, so that activities can be fetched, stored and aggregated from plain
+python, e.g. by `engine.report`.
+
+    from engine import load_engine
+
+    engine = load_engine()
+    rollups = engine.build_rollups(activities)
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import pathlib
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+
+import altair as alt
+import marimo as mo
+import numpy as np
+import polars as pl
+import requests
+import strava_client
+import strava_client.client
+from strava_client import client as s_client
+
+import app
+
+# Named cells of the pipeline, in dependency order
+CELLS = [
+    "perf",
+    "formatting",
+    "decimation",
+    "focus_transforms",
+    "focus_comparison",
+    "time_index",
+    "stream_storage",
+    "api_limits",
+    "activity_store",
+    "rollup_functions",
+    "training_load",
+    "efforts",
+    "pace_curves",
+    "route_tiles",
+    "route_clusters",
+    "authentication",
+    "activity_schema",
+    "activity_api",
+    "club",
+    "histograms",
+    "load_charts",
+]
+
+# Rollups included in reports
+ROLLUPS = ["day", "week", "month", "year"]
+
+
+def load_engine():
+    """
+    Run the pipeline cells and return everything they define.
+    """
+    namespace = {
+        "alt": alt,
+        "collections": collections,
+        "concurrent": concurrent,
+        "datetime": datetime,
+        "json": json,
+        "mo": mo,
+        "np": np,
+        "os": os,
+        "pathlib": pathlib,
+        "pl": pl,
+        "requests": requests,
+        "s_client": s_client,
+        "strava_client": strava_client,
+        "struct": struct,
+        "sys": sys,
+        "tempfile": tempfile,
+        "threading": threading,
+        "time": time,
+        "zlib": zlib,
+    }
+
+    for name in CELLS:
+        cell = getattr(app, name)
+        _, defs = asyncio.run(
+            cell.run(**{ref: namespace[ref] for ref in cell.refs if ref in namespace})
+        )
+        namespace.update(defs)
+
+    return types.SimpleNamespace(**namespace)
+
+
+def whole_frame(activities):
+    """
+    Activities as the dashboard holds them, see `whole_df` in `app.py`.
+    """
+    _, defs = asyncio.run(app.activity_frame.run(activities=activities, pl=pl))
+    return defs["whole_df"]
+
+
+def compute_report(engine, whole_df, rollups, start, end, sport="Run"):
+    """
+    Every aggregate the dashboard shows for a sport and a date range, both
+    included, as a dict of DataFrames. Rollups cover the whole periods
+    overlapping the range.
+    """
+    report = {}
+
+    for name in ROLLUPS:
+        period_start = pl.select(
+            pl.lit(start).dt.truncate(engine.ROLLUP_PERIODS[name])
+        ).item()
+
+        report[name] = (
+            engine.TimeIndex(rollups[name], "period")
+            .slice(sport, period_start, end)
+            .drop("id")
+        )
+
+    report["stats"] = pl.DataFrame([engine.summarize_rollup(report["day"])])
+
+    selected = engine.TimeIndex(whole_df, "start_date", descending=True).slice(
+        sport,
+        datetime.datetime.combine(start, datetime.time.min),
+        datetime.datetime.combine(end, datetime.time.max),
+    )
+
+    if selected.height:
+        report["speed_histogram"] = engine.speed_histogram(selected)
+        report["distance_histogram"] = engine.distance_histogram(selected)
+
+    return report
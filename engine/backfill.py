@@ -0,0 +1,218 @@
+"""
+Compute the best efforts, splits, pace curves and route tiles of every run
+of a store at once, in a pool of processes, e.g. after syncing a long
+history.
+
+The dashboard only processes the newest runs without them each time it is
+opened, as their streams may have to be downloaded. This processes every
+run whose streams are already on disk: those of the store, as downloaded by
+the dashboard, and those of the given Arrow files. Run it from the root of
+the repository:
+
+    uv run python -m engine.backfill --store .strava_store
+"""
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+import sys
+
+import polars as pl
+
+import engine
+
+# Chunks per worker, so that workers finishing early get more to do
+CHUNKS_PER_WORKER = 4
+
+# Loaded once per worker process
+_engine = None
+
+
+def _load_engine():
+    global _engine
+    _engine = engine.load_engine()
+
+
+def analyze_chunk(chunk):
+    """
+    Efforts, splits and pace curves of the `(activity_id, path)` pairs of
+    `chunk`, each file being mapped once.
+    """
+    files = {}
+    streams = []
+
+    for activity_id, path in chunk:
+        if path not in files:
+            files[path] = _engine.MappedStreams(path)
+
+        if files[path].has_keys(_engine.EFFORT_KEYS):
+            streams.append(
+                (activity_id, files[path].get(activity_id, _engine.EFFORT_KEYS))
+            )
+
+    activity_ids = [activity_id for activity_id, _ in chunk]
+
+    return (
+        *_engine.analyze_activities(activity_ids, lambda _: streams),
+        _engine.analyze_curves(activity_ids, lambda _: streams),
+    )
+
+
+def rasterize_chunk(chunk):
+    """
+    Route pixels of the `(activity_id, path)` pairs of `chunk`, and the ids
+    of the runs rasterized.
+    """
+    files = {}
+
+    def _get_streams(activity_ids):
+        for activity_id, path in chunk:
+            if path not in files:
+                files[path] = _engine.MappedStreams(path)
+
+            if files[path].has_keys(_engine.TILE_KEYS):
+                yield activity_id, files[path].get(activity_id, _engine.TILE_KEYS)
+
+    return _engine.rasterize_activities(
+        [activity_id for activity_id, _ in chunk], _get_streams
+    )
+
+
+def make_chunks(pending, paths, n_workers):
+    """
+    Contiguous chunks of the `(activity_id, path)` pairs of the pending
+    runs with streams on disk, so that runs of a file go to the same worker.
+    """
+    available = sorted(
+        (
+            (activity_id, paths[activity_id])
+            for activity_id in pending
+            if activity_id in paths
+        ),
+        key=lambda item: str(item[1]),
+    )
+
+    if not available:
+        return []
+
+    n_chunks = max(1, min(len(available), n_workers * CHUNKS_PER_WORKER))
+    size = -(-len(available) // n_chunks)
+
+    return [available[i : i + size] for i in range(0, len(available), size)]
+
+
+def stream_paths(store_dir, extra_files):
+    """
+    File holding the streams of each activity, from the store first.
+    """
+    paths = {}
+
+    for path in extra_files:
+        paths |= dict.fromkeys(_engine.MappedStreams(path).index, path)
+
+    # Streams are stored one file per activity, named after it
+    for path in (store_dir / "streams").glob("*.arrow"):
+        if path.stem.isdigit():
+            paths[int(path.stem)] = path
+
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--store", type=pathlib.Path, default=pathlib.Path(".strava_store")
+    )
+    parser.add_argument(
+        "--streams",
+        type=pathlib.Path,
+        nargs="*",
+        default=[],
+        help="Other Arrow files of streams, as stored by the dashboard.",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    _load_engine()
+
+    activities, _ = _engine.load_activity_store(args.store)
+
+    if activities is None:
+        print(
+            f"No activities in {args.store}, open the dashboard first", file=sys.stderr
+        )
+        return 1
+
+    efforts, splits = _engine.load_efforts(args.store)
+    curves = _engine.load_curves(args.store)
+
+    # Runs missing either are processed again entirely
+    pending = set(_engine.pending_efforts(activities, efforts)) | set(
+        _engine.pending_curves(activities, curves)
+    )
+
+    # Tiles only take the runs they don't have: counts add up
+    pending_tiles = _engine.pending_tiles(
+        activities, _engine.load_tiled(args.store)
+    )
+
+    if not pending and not pending_tiles:
+        print("Every run has its best efforts, pace curve and tiles already")
+        return 0
+
+    paths = stream_paths(args.store, args.streams)
+    chunks = make_chunks(pending, paths, args.workers)
+    tile_chunks = make_chunks(pending_tiles, paths, args.workers)
+
+    if not chunks and not tile_chunks:
+        n_left = len(pending | set(pending_tiles))
+        print(f"No streams on disk for the {n_left} runs left to process")
+        return 0
+
+    # Polars is already running in this process: forking it could deadlock
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=_load_engine,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        results = list(executor.map(analyze_chunk, chunks))
+        tile_results = list(executor.map(rasterize_chunk, tile_chunks))
+
+    if tile_results:
+        # Chunks share pixels: the pyramid sums their counts
+        _engine.update_tiles(
+            pl.concat([pixels for pixels, _ in tile_results]),
+            [activity_id for _, done in tile_results for activity_id in done],
+            activities,
+            args.store,
+        )
+
+    new_efforts = pl.concat([efforts.clear(), *(result[0] for result in results)])
+    new_splits = pl.concat([splits.clear(), *(result[1] for result in results)])
+    new_curves = pl.concat([curves.clear(), *(result[2] for result in results)])
+
+    efforts, splits = _engine.update_efforts(
+        efforts, splits, new_efforts, new_splits, activities
+    )
+    _engine.save_efforts(efforts, splits, args.store)
+    _engine.save_curves(
+        _engine.update_curves(curves, new_curves, activities), args.store
+    )
+
+    n_processed = new_efforts["activity_id"].n_unique()
+    n_tiled = len(pending_tiles) - len(
+        _engine.pending_tiles(activities, _engine.load_tiled(args.store))
+    )
+    print(
+        f"{n_processed}/{len(pending)} runs processed,"
+        f" {n_tiled}/{len(pending_tiles)} added to the tiles,"
+        " the others have no streams on disk"
+    )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
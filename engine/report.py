@@ -0,0 +1,143 @@
+"""
+Compute the dashboard aggregates of many athletes and date ranges at once,
+in a pool of processes, and write them to Parquet or JSON.
+
+Athletes are listed in a JSON file, as the members of a club in the
+notebook. Those with credentials are synced with Strava first, those with
+an export are loaded from it, the others are read from their store:
+
+    [
+        {"name": "alice", "client_id": "...", "client_secret": "...",
+         "access_token": "...", "refresh_token": "..."},
+        {"name": "bob", "export": "exports/bob.json"},
+        {"name": "carol"}
+    ]
+
+Each athlete has its own store in `--stores/<name>`, and reports are written
+to `--output/<name>/<start>_<end>/` (`all` without ranges). Run it from the root of the repository:
+
+    uv run python -m engine.report athletes.json --range 2025-01-01 2025-06-30
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import pathlib
+import sys
+import traceback
+
+import engine
+
+WHOLE_HISTORY = (datetime.date.min, datetime.date.max)
+
+# Loaded once per worker process
+_engine = None
+
+
+def _load_engine():
+    global _engine
+    _engine = engine.load_engine()
+
+
+def write_report(report, path, output_format):
+    path.mkdir(parents=True, exist_ok=True)
+
+    if output_format == "parquet":
+        for name, table in report.items():
+            table.write_parquet(path / f"{name}.parquet")
+    else:
+        (path / "report.json").write_text(
+            json.dumps(
+                {name: table.to_dicts() for name, table in report.items()},
+                default=str,
+            )
+        )
+
+
+def run_athlete(athlete, ranges, sport, stores_dir, output_dir, output_format):
+    """
+    Sync or load an athlete and write a report for each date range.
+    Returns the name of the athlete and the error, if any.
+    """
+    name = athlete["name"]
+
+    try:
+        activities, rollups = _engine.sync_member(athlete, stores_dir)
+        whole_df = engine.whole_frame(activities)
+
+        for start, end in ranges:
+            report = engine.compute_report(
+                _engine, whole_df, rollups, start, end, sport
+            )
+            if (start, end) == WHOLE_HISTORY:
+                label = "all"
+            else:
+                label = f"{start.isoformat()}_{end.isoformat()}"
+
+            write_report(report, output_dir / name / label, output_format)
+
+        return name, None
+
+    except Exception:
+        return name, traceback.format_exc()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("athletes", type=pathlib.Path)
+    parser.add_argument(
+        "--range",
+        nargs=2,
+        action="append",
+        metavar=("START", "END"),
+        type=datetime.date.fromisoformat,
+        dest="ranges",
+        help="Date range of a report, both included. Can be repeated.",
+    )
+    parser.add_argument("--sport", default="Run")
+    parser.add_argument("--stores", type=pathlib.Path, default=pathlib.Path("stores"))
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("reports"))
+    parser.add_argument("--format", choices=["parquet", "json"], default="parquet")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    athletes = json.loads(args.athletes.read_text())
+
+    ranges = args.ranges or [WHOLE_HISTORY]
+
+    failures = 0
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers, initializer=_load_engine
+    ) as executor:
+        futures = [
+            executor.submit(
+                run_athlete,
+                athlete,
+                ranges,
+                args.sport,
+                args.stores,
+                args.output,
+                args.format,
+            )
+            for athlete in athletes
+        ]
+
+        for future in concurrent.futures.as_completed(futures):
+            name, error = future.result()
+
+            if error:
+                failures += 1
+                print(f"{name}: failed\n{error}", file=sys.stderr)
+            else:
+                print(f"{name}: done")
+
+    print(f"{len(athletes) - failures}/{len(athletes)} athletes reported")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
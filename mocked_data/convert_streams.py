@@ -0,0 +1,33 @@
+"""
+Convert the streams of the mocked activities from the legacy json format
+(a list of single key dicts, from the activity id to its stream serialized
+as json) to the Arrow IPC format read by the notebook.
+
+Run it from the root of the repository:
+
+    uv run python -m mocked_data.convert_streams path/to/mocked_streams.json
+"""
+
+import asyncio
+import json
+import pathlib
+import sys
+
+import polars as pl
+import strava_client
+import strava_client.client  # noqa: F401 (loads strava_client.models)
+
+from app import stream_storage
+
+
+if __name__ == "__main__":
+    json_path = pathlib.Path(sys.argv[1])
+    ipc_path = json_path.with_suffix(".arrow")
+
+    # Run the notebook cell defining the storage format
+    _, defs = asyncio.run(
+        stream_storage.run(json=json, pl=pl, strava_client=strava_client, sys=sys)
+    )
+    defs["convert_json_streams"](json_path, ipc_path)
+
+    print(f"Streams written to {ipc_path}")